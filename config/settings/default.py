@@ -221,11 +221,92 @@ USE_REDIS_CACHE = False
 # mongo conf
 MONGO_HOST = 'localhost'
 MONGO_PORT = 27017
+# one shared MongoClient per worker process: max sockets per client,
+# default write concern and read preference of the staging collections
+ETL_MONGO_POOL_SIZE = 100
+ETL_MONGO_WRITE_CONCERN = {'w': 1}
+ETL_MONGO_READ_PREFERENCE = 'primary'
+# write concern profiles of the staging collections, which can be rebuilt
+# from the source at any time: 'fast' - acknowledged by the primary without
+# journal, 'safe' - acknowledged by the majority and journaled.
+# Bulk writes are unordered in both profiles
+ETL_STAGING_DURABILITY_PROFILES = {
+    'fast': {'w': 1, 'j': False},
+    'safe': {'w': 'majority', 'j': True},
+}
+# default profile and per-stage profiles by task class name,
+# the datasource setting 'staging_durability' takes precedence
+ETL_STAGING_DURABILITY = 'fast'
+ETL_STAGING_STAGE_DURABILITY = {}
+# staging documents keep column values in one array, column names are
+# stored once per collection; documents with named fields stay readable
+ETL_STAGING_COMPACT_DOCUMENTS = True
+
+# staging backend: 'mongodb' - collections of the MONGO_HOST server,
+# 'segments' - append-only memory-mapped segment files in ETL_STAGING_DIR
+# for single-node installations without mongodb (all workers must see
+# the same directory)
+ETL_STAGING_BACKEND = 'mongodb'
+ETL_STAGING_DIR = os.path.join(BASE_DIR, 'data', 'staging')
+# documents are appended to the current segment file until it reaches
+# this size (bytes), then the next segment is started
+ETL_STAGING_SEGMENT_SIZE = 64 * 1024 * 1024
+# bulk loads create secondary indexes of the staging collections after
+# the load instead of updating them on every insert
+ETL_STAGING_DEFERRED_INDEXES = True
 
 # rows select limit
 ETL_COLLECTION_PREVIEW_LIMIT = 1000
 # rows load limit
 ETL_COLLECTION_LOAD_ROWS_LIMIT = 1000
+# keyset (seek) pagination by primary keys while extracting source rows,
+# LIMIT/OFFSET is used for tables without a primary key
+ETL_KEYSET_PAGINATION = True
+# read source rows with one server-side cursor instead of paged queries,
+# takes precedence over ETL_KEYSET_PAGINATION when enabled. Off by default:
+# the cursor holds one long-running query (and, on postgresql, a snapshot)
+# open on the source for the whole load
+ETL_STREAM_EXTRACTION = False
+# parallel initial load: number of primary key ranges of the root table
+# and minimal estimated rows count to split the load
+ETL_EXTRACT_PARTITIONS = 4
+ETL_EXTRACT_PARTITION_MIN_ROWS = 1000000
+# per-process pool of source and warehouse connections:
+# max idle connections per connection params and idle timeout in seconds
+ETL_DB_POOL_SIZE = 5
+ETL_DB_POOL_IDLE_TIMEOUT = 300
+# rows count for progress is estimated by the planner/catalog stats;
+# exact count(1) over the whole join runs in background when enabled
+ETL_EXACT_ROWS_COUNT = False
+# adaptive batch size: ETL_COLLECTION_LOAD_ROWS_LIMIT is the initial size,
+# the batch grows or shrinks to fit the memory budget (bytes)
+# and the target batch processing time (seconds)
+ETL_ADAPTIVE_BATCH = True
+ETL_BATCH_MIN_ROWS = 100
+ETL_BATCH_MAX_ROWS = 50000
+ETL_BATCH_MEMORY_BUDGET = 64 * 1024 * 1024
+ETL_BATCH_TARGET_LATENCY = 2.0
+# extraction reads the source, computes keys and writes to mongodb
+# concurrently: number of writer threads and depth of the stage queues
+ETL_PIPELINE_EXTRACTION = True
+ETL_PIPELINE_WRITERS = 2
+ETL_PIPELINE_DEPTH = 4
+# warehouse bulk inserts go through COPY FROM STDIN: 'text' or 'binary'
+# (binary falls back to text when a column type has no binary encoder)
+ETL_COPY_FORMAT = 'text'
+# delta refresh: keys already loaded to mongodb are put into an in-memory
+# bloom filter, so only possibly existing keys are checked with $in
+ETL_DELTA_BLOOM_FILTER = False
+ETL_DELTA_BLOOM_ERROR_RATE = 0.01
+# snapshots of source row keys (sorted int64 files), compared between loads
+# to find new and deleted rows. Load partitions, DetectRedundant and
+# UpdateMongodb may run on different celery hosts, so the directory must be
+# shared by all workers (e.g. an NFS mount); a snapshot with missing parts
+# fails the load instead of marking loaded rows deleted
+ETL_KEYS_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'data', 'snapshots')
+# trigger mode refresh: delete applied rows from the source change tables
+# instead of marking them synced
+ETL_CDC_PURGE_SYNCED = False
 
 # host, port for websockets
 SOCKET_HOST = ''  # localhost
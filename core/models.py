@@ -82,6 +82,18 @@ class DatasourceSettings(models.Model):
     TRIGGERS = 'apply_triggers'
     CHECKSUM = 'apply_checksum'
     SETTING_CDC_NAME = 'cdc_type'
+    # первичная загрузка через Mongodb или напрямую в хранилище
+    STAGING = 'staging'
+    DIRECT = 'direct'
+    SETTING_LOAD_MODE_NAME = 'load_mode'
+    # дозагрузка всех строк или только добавленных по первичному ключу
+    EXTRACT_FULL = 'extract_full'
+    EXTRACT_APPEND = 'extract_append'
+    SETTING_EXTRACT_MODE_NAME = 'extract_mode'
+    # профиль надежности записи промежуточных коллекций Mongodb
+    DURABILITY_FAST = 'fast'
+    DURABILITY_SAFE = 'safe'
+    SETTING_DURABILITY_NAME = 'staging_durability'
     name = models.CharField(max_length=255, verbose_name=u'Название', db_index=True)
     value = models.TextField(verbose_name=u'Значение')
     datasource = models.ForeignKey(Datasource, verbose_name=u'Источник')
@@ -18,13 +18,23 @@ REQUIRED_INDEXES = {
     '{0}_cdc_created_at_index_bi': ['cdc_created_at', ],
     '{0}_cdc_synced_index_bi': ['cdc_synced', ],
     '{0}_together_index_bi': ['cdc_synced', 'cdc_updated_at', ],
+    # применяемые строки читаются по порядку записи
+    '{0}_cdc_id_index_bi': ['cdc_synced', 'cdc_id', ],
 }
 
+# операции в таблице изменений триггеров (cdc_delta_flag)
+CDC_INSERT, CDC_UPDATE, CDC_DELETE = 1, 2, 3
+# состояния строк таблицы изменений (cdc_synced):
+# новая, примененная к хранилищу, применяемая
+CDC_NOT_SYNCED, CDC_SYNCED, CDC_PROCESSING = 0, 1, 2
+
 
 # Название задач
 CREATE_DATASET = 'etl:database:create_dataset'
 MONGODB_DATA_LOAD = 'etl:load_data:mongo'
+MONGODB_DATA_LOAD_PARTITION = 'etl:load_data:mongo_partition'
 DB_DATA_LOAD = 'etl:cdc:load_data'
+DB_DIRECT_LOAD = 'etl:load_data:direct'
 MONGODB_DELTA_LOAD = 'etl:cdc:load_delta'
 DB_DETECT_REDUNDANT = 'etl:cdc:detect_redundant'
 DB_DELETE_REDUNDANT = 'etl:cdc:delete_redundant'
@@ -32,6 +42,8 @@ GENERATE_DIMENSIONS = 'etl:database:generate_dimensions'
 GENERATE_MEASURES = 'etl:database:generate_measures'
 CREATE_TRIGGERS = 'etl.tasks.create_triggers'
 CREATE_CUBE = 'etl:database:generate_cube'
+ROWS_COUNT_EXACT = 'etl:database:rows_count_exact'
+DB_CDC_APPLY = 'etl:cdc:apply_changes'
 
 # Префиксы названий таблиц
 STTM_DATASOURCE = 'sttm_datasource'  # Временная загружаемая таблица
@@ -40,3 +52,4 @@ STTM_DATASOURCE_KEYS = 'sttm_datasource_keys'  # Текущее состояни
 STTM_DATASOURCE_KEYSALL = 'sttm_datasource_keysall'  # Таблица всех ключей
 DIMENSIONS = 'dimensions'  # Таблица размерностей
 MEASURES = 'measures'  # Таблица мер
+CDC_TABLE = '_etl_datasource_cdc'  # Таблица изменений триггеров в базе источника
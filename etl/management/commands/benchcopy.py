@@ -0,0 +1,79 @@
+# coding: utf-8
+import time
+import datetime
+
+from django.core.management.base import BaseCommand
+from etl.services.datasource.base import DataSourceService
+from etl.services.queue.base import InsertQuery, CopyQuery
+
+TABLE_NAME = 'sttm_benchcopy'
+COL_TYPES = ['text', 'integer', 'double precision', 'text', 'timestamp',
+             'bytea']
+
+
+class Command(BaseCommand):
+
+    help = u'Сравнивает скорость вставки в хранилище через executemany ' \
+           u'и COPY! Запускать python manage.py benchcopy [--rows N] [--batch N]'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--batch', type=int, default=1000)
+
+    def get_rows(self, count):
+        """
+        Тестовые строки в формате InsertQuery, каждая десятая с NULL
+        """
+        now = datetime.datetime.now()
+        rows = []
+        for i in xrange(count):
+            rows.append({
+                '0': 'key_%s' % i,
+                '1': i,
+                '2': i / 3.0,
+                '3': None if i % 10 == 0 else u'значение\t%s' % i,
+                '4': now,
+                '5': b'\x00\x01\x02' * (i % 50),
+            })
+        return rows
+
+    def handle(self, *args, **options):
+        rows = self.get_rows(options['rows'])
+        batch = options['batch']
+        binary_types_dict = {'5': True}
+
+        instance = DataSourceService.get_local_instance()
+        cursor = instance.connection.cursor()
+
+        cases = [
+            ('executemany', InsertQuery, {}),
+            ('copy text', CopyQuery, {'copy_format': CopyQuery.TEXT}),
+            ('copy binary', CopyQuery, {'copy_format': CopyQuery.BINARY}),
+        ]
+        for name, query_class, params in cases:
+            cursor.execute('DROP TABLE IF EXISTS {0}'.format(TABLE_NAME))
+            cursor.execute('CREATE TABLE {0} ({1})'.format(TABLE_NAME, ', '.join(
+                ['"{0}" {1}'.format(i, t) for i, t in enumerate(COL_TYPES)])))
+            instance.connection.commit()
+
+            query = query_class(DataSourceService())
+            query.set_query(table_name=TABLE_NAME, cols_nums=len(COL_TYPES),
+                            col_types=COL_TYPES, **params)
+
+            # InsertQuery меняет строки на месте, передаем копии
+            batches = [[dict(x) for x in rows[i:i + batch]]
+                       for i in xrange(0, len(rows), batch)]
+
+            start = time.time()
+            for data in batches:
+                query.execute(data=data, binary_types_dict=binary_types_dict)
+            elapsed = time.time() - start
+            query.release()
+
+            print '{0}: {1} rows in {2:.2f}s, {3:.0f} rows/s'.format(
+                name, len(rows), elapsed, len(rows) / elapsed)
+
+        cursor.execute('DROP TABLE IF EXISTS {0}'.format(TABLE_NAME))
+        instance.connection.commit()
+        cursor.close()
+        DataSourceService.release_instance(instance)
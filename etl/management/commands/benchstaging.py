@@ -0,0 +1,81 @@
+# coding: utf-8
+import time
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from etl.services.queue.staging import STAGING_BACKENDS
+
+COLLECTION_NAME = 'sttm_benchstaging'
+
+
+class Command(BaseCommand):
+
+    help = u'Сравнивает скорость записи в промежуточные хранилища ' \
+           u'и коллекции Mongodb с разными профилями надежности! ' \
+           u'Запускать python manage.py benchstaging [--rows N] [--batch N] ' \
+           u'[--profiles fast safe] [--backends mongodb segments]'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--batch', type=int, default=1000)
+        parser.add_argument(
+            '--profiles', nargs='+',
+            default=sorted(settings.ETL_STAGING_DURABILITY_PROFILES))
+        parser.add_argument(
+            '--backends', nargs='+', default=[settings.ETL_STAGING_BACKEND],
+            choices=sorted(STAGING_BACKENDS))
+
+    def get_documents(self, count):
+        """
+        Тестовые документы в формате промежуточной коллекции
+        """
+        now = datetime.datetime.now()
+        return [{
+            '_id': i,
+            '_state': 'idle',
+            '_date': now,
+            'table__id': i,
+            'table__name': u'значение %s' % i,
+            'table__value': i / 3.0,
+        } for i in xrange(count)]
+
+    def handle(self, *args, **options):
+        documents = self.get_documents(options['rows'])
+        batch = options['batch']
+
+        for backend in options['backends']:
+            # профили надежности есть только у коллекций Mongodb
+            profiles = options['profiles'] if backend == 'mongodb' else [None]
+            for profile in profiles:
+                name = '{0} {1}'.format(backend, profile or '')
+                store = STAGING_BACKENDS[backend](COLLECTION_NAME, profile)
+                store.drop()
+                store.create()
+
+                timings = []
+                start = time.time()
+                for i in xrange(0, len(documents), batch):
+                    store.append(documents[i:i + batch])
+                timings.append(('insert', time.time() - start))
+
+                start = time.time()
+                store.set_state('loaded', 'idle')
+                timings.append(('update', time.time() - start))
+
+                start = time.time()
+                for _ in store.scan(batch_size=batch):
+                    pass
+                timings.append(('scan', time.time() - start))
+
+                start = time.time()
+                for i in xrange(0, len(documents), batch):
+                    store.delete([x['_id'] for x in documents[i:i + batch]])
+                timings.append(('delete', time.time() - start))
+
+                for action, elapsed in timings:
+                    print '{0} {1}: {2} rows in {3:.2f}s, {4:.0f} rows/s'.format(
+                        name, action, len(documents), elapsed,
+                        len(documents) / elapsed)
+
+                store.drop()
@@ -50,3 +50,6 @@ class Command(BaseCommand):
 
         meta_keys.delete()
         metas.delete()
+
+        cursor.close()
+        DataSourceService.release_instance(instance)
@@ -4,6 +4,7 @@ from etl.services.datasource.repository import r_server
 from etl.services.db.factory import DatabaseService
 from etl.services.datasource.repository.storage import RedisSourceService
 from etl.models import TablesTree, TableTreeRepository
+from etl.services.middleware.base import split_key_range
 from core.helpers import get_utf8_string
 from django.conf import settings
 from itertools import groupby
@@ -56,7 +57,7 @@ class DataSourceService(object):
             'conn_type': get_utf8_string(post.get('conn_type')),
         }
 
-        return DatabaseService.get_connection_by_dict(conn_info)
+        return DatabaseService.check_connection_by_dict(conn_info)
 
     @classmethod
     def get_columns_info(cls, source, tables):
@@ -321,19 +322,111 @@ class DataSourceService(object):
             local_instance, source_table_name)
 
     @classmethod
-    def get_rows_query_for_loading_task(cls, source, structure, cols):
+    def get_rows_query_for_loading_task(cls, source, structure, cols,
+                                        condition=None):
         """
         Получение предзапроса данных указанных
         колонок и таблиц для селери задачи
         :param source:
         :param structure:
         :param cols:
+        :param condition: дополнительное условие выборки
         :return:
         """
 
-        rows_query = DatabaseService.get_rows_query(source, cols, structure)
+        rows_query = DatabaseService.get_rows_query(
+            source, cols, structure, condition)
         return rows_query
 
+    @classmethod
+    def get_keyset_rows_query_for_loading_task(
+            cls, source, structure, cols, key_cols):
+        """
+        Получение предзапроса данных с keyset-пагинацией
+        и условия продолжения выборки для селери задачи
+        :param source:
+        :param structure:
+        :param cols:
+        :param key_cols:
+        :return: tuple
+        """
+        return DatabaseService.get_keyset_rows_query(
+            source, cols, structure, key_cols)
+
+    @classmethod
+    def get_rows_stream_for_loading_task(cls, source, structure, cols,
+                                         batch_size, condition=None):
+        """
+        Потоковое чтение данных указанных колонок и таблиц
+        для селери задачи
+        :param source:
+        :param structure:
+        :param cols:
+        :param batch_size:
+        :param condition: дополнительное условие выборки
+        :return: generator
+        """
+        return DatabaseService.stream_rows(
+            source, cols, structure, batch_size, condition)
+
+    @classmethod
+    def get_key_range_conditions(cls, source, table, key_col, parts):
+        """
+        Разбиение целочисленного ключа таблицы на диапазоны
+        для параллельной загрузки
+        :param source: Datasource
+        :param table: str
+        :param key_col: dict
+        :param parts: int число диапазонов
+        :return: list of str условий выборки, пустой для пустой таблицы
+        """
+        min_key, max_key = DatabaseService.get_key_range(source, table, key_col)
+        if min_key is None:
+            return []
+        return DatabaseService.get_key_range_conditions(
+            source, key_col, split_key_range(min_key, max_key, parts))
+
+    @classmethod
+    def get_key_range(cls, source, table, key_col):
+        """
+        Минимальное и максимальное значения ключа таблицы источника
+        :param source: Datasource
+        :param table: str
+        :param key_col: dict
+        :return: tuple
+        """
+        return DatabaseService.get_key_range(source, table, key_col)
+
+    @classmethod
+    def get_key_range_condition(cls, source, key_col, start, end=None):
+        """
+        Условие выборки диапазона ключа [start, end)
+        :param source: Datasource
+        :param key_col: dict
+        :param start: int
+        :param end: int
+        :return: str
+        """
+        return DatabaseService.get_key_range_conditions(
+            source, key_col, [(start, end)])[0]
+
+    @staticmethod
+    def get_watermark(source, table, key):
+        """
+        Сохраненная граница ключа корневой таблицы набора данных,
+        строки до нее включительно уже загружены
+        :param source: Datasource
+        :param table: str корневая таблица
+        :param key: str ключ (checksum) набора данных
+        :return: int or None
+        """
+        stats = DatasourceMeta.objects.filter(
+            datasource_id=source.id, collection_name=table).values_list(
+            'stats', flat=True).first()
+        if not stats:
+            return None
+        return json.loads(stats).get('watermarks', {}).get(key)
+
     @classmethod
     def check_existing_table(cls, table_name):
         """
@@ -345,12 +438,21 @@ class DataSourceService(object):
         return table_name in connection.introspection.table_names()
 
     @classmethod
-    def get_source_connection(cls, source):
+    def check_source_connection(cls, source):
+        """
+        Проверка соединения источника данных
+        :type source: Datasource
+        :raise ValueError: источник недоступен
+        """
+        DatabaseService.check_connection(source)
+
+    @classmethod
+    def source_instance(cls, source):
         """
-        Получить объект соединения источника данных
+        Инстанс базы источника из пула на время блока with
         :type source: Datasource
         """
-        return DatabaseService.get_connection(source)
+        return DatabaseService.source_instance(source)
 
     @classmethod
     def get_local_instance(cls):
@@ -361,6 +463,14 @@ class DataSourceService(object):
         """
         return DatabaseService.get_local_instance()
 
+    @classmethod
+    def release_instance(cls, instance):
+        """
+        Возврат инстанса базы данных в пул подключений
+        :type instance: Database
+        """
+        DatabaseService.release_instance(instance)
+
     @classmethod
     def tables_info_for_metasource(cls, source, tables):
         """
@@ -394,8 +504,8 @@ class DataSourceService(object):
 
     @staticmethod
     # @transaction.atomic()
-    def update_datasource_meta(key, source, cols,
-                               tables_info_for_meta, last_row, dataset_id):
+    def update_datasource_meta(key, source, cols, tables_info_for_meta,
+                               last_row, dataset_id, watermark=None):
         """
         Создание DatasourceMeta для Datasource
 
@@ -406,6 +516,8 @@ class DataSourceService(object):
             cols(list): Список колонок
             last_row(str or None): Последняя запись
             tables_info_for_meta: Данные о таблицах
+            watermark(tuple or None): Новая граница ключа набора данных
+                (<корневая таблица>, <значение>)
 
         Returns:
             DatasourceMeta: Объект мета-данных
@@ -415,7 +527,8 @@ class DataSourceService(object):
         for table, col_group in groupby(cols, lambda x: x['table']):
             with transaction.atomic():
                 try:
-                    source_meta = DatasourceMeta.objects.get(
+                    source_meta = DatasourceMeta.objects.select_for_update(
+                    ).get(
                         datasource_id=source.id,
                         collection_name=table,
                     )
@@ -429,6 +542,14 @@ class DataSourceService(object):
                     'row_key': [],
                     'row_key_value': []
                 }
+
+                # границы ключа наборов данных сохраняются между загрузками
+                watermarks = json.loads(source_meta.stats).get(
+                    'watermarks', {}) if source_meta.stats else {}
+                if watermark and watermark[0] == table:
+                    watermarks[key] = watermark[1]
+                if watermarks:
+                    stats['watermarks'] = watermarks
                 fields = {'columns': [], }
 
                 table_info = tables_info_for_meta[table]
@@ -473,16 +594,17 @@ class DataSourceService(object):
         return res
 
     @classmethod
-    def get_structure_rows_number(cls, source, structure,  cols):
+    def get_structure_rows_number(cls, source, structure,  cols, exact=False):
         """
         возвращает примерное кол-во строк в запросе селекта для планирования
         :param source:
         :param structure:
         :param cols:
+        :param exact: bool точный подсчет count-запросом
         :return:
         """
         return DatabaseService.get_structure_rows_number(
-            source, structure,  cols)
+            source, structure,  cols, exact)
 
     @classmethod
     def get_remote_table_create_query(cls, source):
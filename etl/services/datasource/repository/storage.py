@@ -134,6 +134,20 @@ class RedisCacheKeys(object):
         """
         return 'queue:{0}'.format(task_id)
 
+    @staticmethod
+    def get_queue_partitions(task_id):
+        """
+        ключ информации о ходе работы частей параллельной загрузки таска
+        """
+        return '{0}:partitions'.format(RedisCacheKeys.get_queue(task_id))
+
+    @staticmethod
+    def get_rows_count(key):
+        """
+        ключ точного числа строк загрузки
+        """
+        return 'rows_count:{0}'.format(key)
+
 
 class RedisSourceService(object):
     """
@@ -800,6 +814,87 @@ class RedisSourceService(object):
         queue_str = RedisCacheKeys.get_queue(task_id)
         r_server.delete(queue_str)
 
+    @staticmethod
+    def init_queue_partitions(task_id, count):
+        """
+        счетчики частей параллельной загрузки таска
+        :param task_id: int id родительского таска
+        :param count: int число частей
+        """
+        partitions_str = RedisCacheKeys.get_queue_partitions(task_id)
+        r_server.hmset(partitions_str, {'count': count, 'done': 0, 'loaded': 0})
+
+    @staticmethod
+    def add_partition_loaded(task_id, rows_count):
+        """
+        учет загруженных частью строк
+        :param task_id: int id родительского таска
+        :param rows_count: int
+        :return: int всего загружено строк всеми частями
+        """
+        partitions_str = RedisCacheKeys.get_queue_partitions(task_id)
+        return r_server.hincrby(partitions_str, 'loaded', rows_count)
+
+    @staticmethod
+    def finish_queue_partition(task_id, failed=False):
+        """
+        отметка о завершении части параллельной загрузки,
+        часть с ошибкой тоже считается завершенной
+        :param task_id: int id родительского таска
+        :param failed: bool часть завершилась с ошибкой
+        :return: bool завершилась ли последняя часть
+        """
+        partitions_str = RedisCacheKeys.get_queue_partitions(task_id)
+        if failed:
+            r_server.hincrby(partitions_str, 'failed', 1)
+        done = r_server.hincrby(partitions_str, 'done', 1)
+        return done >= int(r_server.hget(partitions_str, 'count'))
+
+    @staticmethod
+    def get_failed_partitions(task_id):
+        """
+        число частей параллельной загрузки, завершившихся с ошибкой
+        :param task_id: int id родительского таска
+        :return: int
+        """
+        partitions_str = RedisCacheKeys.get_queue_partitions(task_id)
+        return int(r_server.hget(partitions_str, 'failed') or 0)
+
+    @staticmethod
+    def delete_queue_partitions(task_id):
+        """
+        удаляет информацию о частях параллельной загрузки
+        :param task_id: int id родительского таска
+        """
+        r_server.delete(RedisCacheKeys.get_queue_partitions(task_id))
+
+    @staticmethod
+    def set_rows_count(key, rows_count):
+        """
+        сохраняет точное число строк загрузки
+        :param key: str ключ загрузки
+        :param rows_count: int
+        """
+        r_server.set(RedisCacheKeys.get_rows_count(key), rows_count)
+
+    @staticmethod
+    def get_rows_count(key):
+        """
+        точное число строк загрузки
+        :param key: str ключ загрузки
+        :return: int или None, если подсчет еще не закончен
+        """
+        rows_count = r_server.get(RedisCacheKeys.get_rows_count(key))
+        return int(rows_count) if rows_count is not None else None
+
+    @staticmethod
+    def delete_rows_count(key):
+        """
+        удаляет точное число строк загрузки
+        :param key: str ключ загрузки
+        """
+        r_server.delete(RedisCacheKeys.get_rows_count(key))
+
     @classmethod
     def get_next_user_collection_counter(cls, user_id, source_id):
         """
@@ -1,13 +1,19 @@
 # coding: utf-8
+from contextlib import contextmanager
 from django.conf import settings
 
 from core.models import ConnectionChoices
 from etl.services.db import mysql, postgresql
+from etl.services.db.pool import ConnectionPool
 
 
 class DatabaseService(object):
     """Сервис для источников данных"""
 
+    # общий для вьюх и задач процесса пул подключений
+    pool = ConnectionPool(settings.ETL_DB_POOL_SIZE,
+                          settings.ETL_DB_POOL_IDLE_TIMEOUT)
+
     @staticmethod
     def factory(**connection):
         """
@@ -31,6 +37,37 @@ class DatabaseService(object):
         else:
             raise ValueError("Неизвестный тип подключения!")
 
+    @classmethod
+    def get_instance(cls, connection):
+        """
+        инстанс бд из пула подключений процесса,
+        после работы возвращается в пул через release_instance
+        :param connection: dict
+        :return: instance
+        """
+        return cls.pool.acquire(connection, cls.factory)
+
+    @classmethod
+    def release_instance(cls, instance):
+        """
+        возврат инстанса бд в пул подключений
+        :param instance: Database
+        """
+        cls.pool.release(instance)
+
+    @classmethod
+    @contextmanager
+    def instance(cls, connection):
+        """
+        инстанс бд из пула на время блока with
+        :param connection: dict
+        """
+        instance = cls.get_instance(connection)
+        try:
+            yield instance
+        finally:
+            cls.release_instance(instance)
+
     @classmethod
     def get_source_instance(cls, source):
         """
@@ -38,9 +75,15 @@ class DatabaseService(object):
         :param source: Datasource
         :return: instance
         """
-        data = cls.get_source_data(source)
-        instance = cls.factory(**data)
-        return instance
+        return cls.get_instance(cls.get_source_data(source))
+
+    @classmethod
+    def source_instance(cls, source):
+        """
+        инстанс бд соурса на время блока with
+        :param source: Datasource
+        """
+        return cls.instance(cls.get_source_data(source))
 
     @classmethod
     def get_tables(cls, source):
@@ -48,8 +91,8 @@ class DatabaseService(object):
         возвращает таблицы соурса
         :type source: Datasource
         """
-        instance = cls.get_source_instance(source)
-        return instance.get_tables(source)
+        with cls.source_instance(source) as instance:
+            return instance.get_tables(source)
 
     @classmethod
     def get_source_data(cls, source):
@@ -69,8 +112,8 @@ class DatabaseService(object):
         :param tables:
         :return:
         """
-        instance = cls.get_source_instance(source)
-        return instance.get_columns(source, tables)
+        with cls.source_instance(source) as instance:
+            return instance.get_columns(source, tables)
 
     @classmethod
     def get_stats_info(cls, source, tables):
@@ -80,18 +123,79 @@ class DatabaseService(object):
         :param tables:
         :return:
         """
-        instance = cls.get_source_instance(source)
-        return instance.get_statistic(source, tables)
+        with cls.source_instance(source) as instance:
+            return instance.get_statistic(source, tables)
 
     @classmethod
-    def get_rows_query(cls, source, cols, structure):
+    def get_rows_query(cls, source, cols, structure, condition=None):
         """
         Получение запроса выбранных колонок из указанных таблиц выбранного источника
         :param source: Datasource
+        :param condition: str дополнительное условие выборки
         :return:
         """
-        instance = cls.get_source_instance(source)
-        return instance.get_rows_query(cols, structure)
+        with cls.source_instance(source) as instance:
+            return instance.get_rows_query(cols, structure, condition)
+
+    @classmethod
+    def get_keyset_rows_query(cls, source, cols, structure, key_cols):
+        """
+        Получение запроса с keyset-пагинацией и условия продолжения выборки
+        :param source: Datasource
+        :param cols: list
+        :param structure: dict
+        :param key_cols: list колонки ключа сортировки
+        :return: tuple
+        """
+        with cls.source_instance(source) as instance:
+            return (instance.get_keyset_rows_query(cols, structure, key_cols),
+                    instance.get_keyset_condition(key_cols))
+
+    @classmethod
+    def stream_rows(cls, source, cols, structure, batch_size, condition=None):
+        """
+        Потоковое чтение значений выбранных колонок одним запросом
+        :param source: Datasource
+        :param cols: list
+        :param structure: dict
+        :param batch_size: int
+        :param condition: str дополнительное условие выборки
+        :return: generator пакетов строк
+        """
+        with cls.source_instance(source) as instance:
+            rows_stream = instance.stream_rows(
+                cols, structure, batch_size, condition)
+            try:
+                for rows in rows_stream:
+                    yield rows
+            finally:
+                # курсор закрываем до возврата соединения в пул
+                rows_stream.close()
+
+    @classmethod
+    def get_key_range(cls, source, table, key_col):
+        """
+        Минимальное и максимальное значения ключа таблицы источника
+        :param source: Datasource
+        :param table: str
+        :param key_col: dict
+        :return: tuple
+        """
+        with cls.source_instance(source) as instance:
+            return instance.get_key_range(table, key_col)
+
+    @classmethod
+    def get_key_range_conditions(cls, source, key_col, ranges):
+        """
+        Условия выборки для диапазонов ключа
+        :param source: Datasource
+        :param key_col: dict
+        :param ranges: list of tuple (start, end)
+        :return: list of str
+        """
+        with cls.source_instance(source) as instance:
+            return [instance.get_key_range_condition(key_col, start, end)
+                    for (start, end) in ranges]
 
     @classmethod
     def get_rows(cls, source, cols, structure):
@@ -102,8 +206,8 @@ class DatabaseService(object):
         :param cols: list
         :return:
         """
-        instance = cls.get_source_instance(source)
-        return instance.get_rows(cols, structure)
+        with cls.source_instance(source) as instance:
+            return instance.get_rows(cols, structure)
 
     @classmethod
     def get_table_create_query(cls, local_instance, key_str, cols_str):
@@ -137,33 +241,29 @@ class DatabaseService(object):
         :param structure: dict
         :return: str
         """
-        instance = cls.get_source_instance(source)
-        return instance.generate_join(structure)
+        with cls.source_instance(source) as instance:
+            return instance.generate_join(structure)
 
     @classmethod
-    def get_connection(cls, source):
+    def check_connection(cls, source):
         """
-        Получение соединения источника
+        Проверка соединения источника
         :type source: Datasource
+        :raise ValueError: источник недоступен
         """
-        conn_info = source.get_connection_dict()
-        return cls.get_connection_by_dict(conn_info)
+        cls.check_connection_by_dict(cls.get_source_data(source))
 
     @classmethod
-    def get_connection_by_dict(cls, conn_info):
+    def check_connection_by_dict(cls, conn_info):
         """
-        Получение соединения источника
+        Проверка соединения источника, соединение возвращается в пул
         :type conn_info: dict
+        :raise ValueError: источник недоступен
         """
-        instance = cls.factory(**conn_info)
-
-        del conn_info['conn_type']
-        conn_info['port'] = int(conn_info['port'])
-
-        conn = instance.get_connection(conn_info)
-        if conn is None:
-            raise ValueError("Сбой при подключении!")
-        return conn
+        # соединение уже открыто при создании инстанса
+        with cls.instance(conn_info) as instance:
+            if instance.connection is None:
+                raise ValueError("Сбой при подключении!")
 
     @classmethod
     def processing_records(cls, source, col_records, index_records, const_records):
@@ -174,8 +274,8 @@ class DatabaseService(object):
         :param const_records: str
         :return: tuple
         """
-        instance = cls.get_source_instance(source)
-        return instance.processing_records(col_records, index_records, const_records)
+        with cls.source_instance(source) as instance:
+            return instance.processing_records(col_records, index_records, const_records)
 
     @classmethod
     def get_local_connection_dict(cls):
@@ -201,40 +301,53 @@ class DatabaseService(object):
         :rtype : object Postgresql()
         :return:
         """
-        local_data = cls.get_local_connection_dict()
-        instance = cls.factory(**local_data)
-        return instance
+        return cls.get_instance(cls.get_local_connection_dict())
+
+    @classmethod
+    def local_instance(cls):
+        """
+        инстанс локального хранилища данных на время блока with
+        """
+        return cls.instance(cls.get_local_connection_dict())
 
     # fixme: не использутеся
     @classmethod
     def get_separator(cls, source):
-        instance = cls.get_source_instance(source)
-        return instance.get_separator()
+        with cls.source_instance(source) as instance:
+            return instance.get_separator()
 
     @classmethod
-    def get_structure_rows_number(cls, source, structure, cols):
+    def get_structure_rows_number(cls, source, structure, cols, exact=False):
         """
-        возвращает примерное кол-во строк в запросе селекта для планирования
+        возвращает примерное кол-во строк в запросе селекта для планирования:
+        оценку планировщика, а без нее статистику каталога
         :param source:
         :param structure:
         :param cols:
+        :param exact: bool точный подсчет count-запросом
         :return:
         """
-        instance = cls.get_source_instance(source)
-        return instance.get_structure_rows_number(structure, cols)
+        with cls.source_instance(source) as instance:
+            if exact:
+                return instance.get_exact_rows_number(structure)
+            rows_count = instance.get_structure_rows_number(structure, cols)
+            if rows_count is None:
+                rows_count = instance.get_catalog_rows_number(
+                    source, structure)
+            return rows_count
 
     @classmethod
     def get_remote_table_create_query(cls, source):
         """
         возвращает запрос на создание таблицы в БД клиента
         """
-        instance = cls.get_source_instance(source)
-        return instance.remote_table_create_query()
+        with cls.source_instance(source) as instance:
+            return instance.remote_table_create_query()
 
     @classmethod
     def get_remote_triggers_create_query(cls, source):
         """
         возвращает запрос на создание григгеров в БД клиента
         """
-        instance = cls.get_source_instance(source)
-        return instance.remote_triggers_create_query()
+        with cls.source_instance(source) as instance:
+            return instance.remote_triggers_create_query()
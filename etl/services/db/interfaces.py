@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 from collections import defaultdict
 from itertools import groupby
 from django.conf import settings
+from etl.constants import CDC_NOT_SYNCED, CDC_SYNCED, CDC_PROCESSING
 
 
 class BaseEnum(object):
@@ -91,6 +92,198 @@ class Database(object):
         cursor.execute(query)
         return cursor.fetchall()
 
+    @staticmethod
+    def get_ping_query():
+        """
+        Запрос проверки соединения
+        """
+        return "SELECT 1"
+
+    def is_alive(self):
+        """
+        Проверка работоспособности соединения
+
+        Returns:
+            bool: Соединение отвечает на запросы
+        """
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute(self.get_ping_query())
+            cursor.fetchall()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def get_stream_cursor(self, batch_size):
+        """
+        Курсор для потокового чтения больших выборок.
+        По умолчанию обычный курсор с размером пакета выборки arraysize
+
+        Args:
+            batch_size(int): Число строк, получаемых за одно обращение к базе
+
+        Returns:
+            Курсор
+        """
+        cursor = self.connection.cursor()
+        cursor.arraysize = batch_size
+        return cursor
+
+    def stream_rows(self, cols, structure, batch_size, condition=None):
+        """
+        Потоковое чтение данных одним запросом без пагинации.
+        Память ограничена размером пакета, а не размером выборки
+
+        Args:
+            cols(list): Название колонок
+            structure(dict): Структура данных
+            batch_size(int or `BatchSizer`): Размер пакета, у адаптивного
+                размер перечитывается перед каждым пакетом
+            condition(str): Дополнительное условие выборки
+
+        Returns:
+            generator: Пакеты строк (list of tuple)
+        """
+        query = self.get_select_query().format(
+            self.get_select_cols_str(cols),
+            self.get_filtered_join(structure, condition))
+        return self.stream_query(query, batch_size)
+
+    def stream_query(self, query, batch_size):
+        """
+        Потоковое чтение результата запроса пакетами
+
+        Args:
+            query(str): Запрос
+            batch_size(int or `BatchSizer`): Размер пакета
+
+        Returns:
+            generator: Пакеты строк (list of tuple)
+        """
+        cursor = self.get_stream_cursor(getattr(batch_size, 'size', batch_size))
+        try:
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(getattr(batch_size, 'size', batch_size))
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def claim_cdc_rows(self, table_name):
+        """
+        Отметка новых строк таблицы изменений триггеров как применяемых.
+        Строки, записанные триггерами позже, остаются до следующей дозагрузки
+
+        Args:
+            table_name(str): Таблица изменений
+
+        Returns:
+            int: Число применяемых строк
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "UPDATE {sep}{0}{sep} SET {sep}cdc_synced{sep} = {1} "
+            "WHERE {sep}cdc_synced{sep} = {2}".format(
+                table_name, CDC_PROCESSING, CDC_NOT_SYNCED,
+                sep=self.get_separator()))
+        self.connection.commit()
+
+        # вместе с непримененными строками прерванной дозагрузки
+        cursor.execute(
+            "SELECT count(1) FROM {sep}{0}{sep} "
+            "WHERE {sep}cdc_synced{sep} = {1}".format(
+                table_name, CDC_PROCESSING, sep=self.get_separator()))
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    def get_cdc_compact_query(self, table_name, key_cols):
+        """
+        Запрос свертки применяемых строк таблицы изменений: строки,
+        после которых по тому же ключу записана более поздняя операция,
+        отмечаются примененными
+
+        Args:
+            table_name(str): Таблица изменений
+            key_cols(list): Колонки первичного ключа
+
+        Returns:
+            str: Запрос
+        """
+        sep = self.get_separator()
+        keys = ' AND '.join(['t.{sep}{0}{sep} = n.{sep}{0}{sep}'.format(
+            x, sep=sep) for x in key_cols])
+        return self.db_map.cdc_compact_query.format(
+            table_name, keys, processing=CDC_PROCESSING, synced=CDC_SYNCED)
+
+    def compact_cdc_rows(self, table_name, key_cols):
+        """
+        Свертка применяемых строк таблицы изменений до последней
+        операции по каждому ключу на стороне источника
+
+        Args:
+            table_name(str): Таблица изменений
+            key_cols(list): Колонки первичного ключа
+
+        Returns:
+            int: Число свернутых строк
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(self.get_cdc_compact_query(table_name, key_cols))
+        count = cursor.rowcount
+        self.connection.commit()
+        cursor.close()
+        return count
+
+    def stream_cdc_rows(self, table_name, cols, batch_size):
+        """
+        Применяемые строки таблицы изменений в порядке записи
+
+        Args:
+            table_name(str): Таблица изменений
+            cols(list): Названия колонок
+            batch_size(int or `BatchSizer`): Размер пакета
+
+        Returns:
+            generator: Пакеты строк, последнее значение строки - операция
+        """
+        sep = self.get_separator()
+        query = (
+            "SELECT {1}, {sep}cdc_delta_flag{sep} FROM {sep}{0}{sep} "
+            "WHERE {sep}cdc_synced{sep} = {2} "
+            "ORDER BY {sep}cdc_id{sep}").format(
+            table_name, ', '.join(['{sep}{0}{sep}'.format(x, sep=sep)
+                                   for x in cols]),
+            CDC_PROCESSING, sep=sep)
+        return self.stream_query(query, batch_size)
+
+    def finish_cdc_rows(self, table_name, purge=False):
+        """
+        Отметка примененных строк таблицы изменений либо их удаление
+        вместе со свернутыми строками
+
+        Args:
+            table_name(str): Таблица изменений
+            purge(bool): Удалять примененные строки
+        """
+        sep = self.get_separator()
+        if purge:
+            query = ("DELETE FROM {sep}{0}{sep} "
+                     "WHERE {sep}cdc_synced{sep} IN ({1}, {2})")
+        else:
+            query = (
+                "UPDATE {sep}{0}{sep} SET {sep}cdc_synced{sep} = {2}, "
+                "{sep}cdc_updated_at{sep} = now() "
+                "WHERE {sep}cdc_synced{sep} = {1}")
+        cursor = self.connection.cursor()
+        cursor.execute(query.format(
+            table_name, CDC_PROCESSING, CDC_SYNCED, sep=sep))
+        self.connection.commit()
+        cursor.close()
+
     @staticmethod
     def _get_columns_query(source, tables):
         """
@@ -241,18 +434,19 @@ class Database(object):
 
         return query_join
 
-    def get_rows_query(self, cols, structure):
+    def get_rows_query(self, cols, structure, condition=None):
         """
         Формирования строки запроса на получение данных из базы
 
         Args:
             cols(dict): Название колонок
             structure(dict): Структура данных
+            condition(str): Дополнительное условие выборки
 
         Returns:
             str: Строка запроса на получения данных без пагинации
         """
-        query_join = self.generate_join(structure,)
+        query_join = self.get_filtered_join(structure, condition)
 
         separator = self.get_separator()
 
@@ -266,6 +460,146 @@ class Database(object):
             cols_str, query_join,
             '{0}', '{1}')
 
+    def get_filtered_join(self, structure, condition=None):
+        """
+        Соединение таблиц с дополнительным условием выборки
+
+        Args:
+            structure(dict): Структура данных
+            condition(str): Условие выборки
+
+        Returns:
+            str: Часть запроса после FROM
+        """
+        query_join = self.generate_join(structure)
+        if condition:
+            query_join += ' WHERE ' + condition
+        return query_join
+
+    def get_key_range(self, table, key_col):
+        """
+        Минимальное и максимальное значения ключа таблицы
+
+        Args:
+            table(str): Название таблицы
+            key_col(dict): Колонка ключа
+
+        Returns:
+            tuple: (min, max), (None, None) для пустой таблицы
+        """
+        query = 'SELECT MIN({0}), MAX({0}) FROM {sep}{1}{sep}'.format(
+            self.get_col_str(key_col), table, sep=self.get_separator())
+        return tuple(self.get_query_result(query)[0])
+
+    def get_key_range_condition(self, key_col, start, end=None):
+        """
+        Условие выборки диапазона целочисленного ключа [start, end)
+
+        Args:
+            key_col(dict): Колонка ключа
+            start(int): Начало диапазона включительно
+            end(int): Конец диапазона не включительно, None - без ограничения
+
+        Returns:
+            str: Условие выборки
+        """
+        col_str = self.get_col_str(key_col)
+        condition = '{0} >= {1}'.format(col_str, int(start))
+        if end is not None:
+            condition += ' AND {0} < {1}'.format(col_str, int(end))
+        return condition
+
+    def get_col_str(self, col):
+        """
+        Полное название колонки для запроса
+
+        Args:
+            col(dict): Колонка вида {'table': <table>, 'col': <col>}
+
+        Returns:
+            str: Название колонки вида "table"."col"
+        """
+        return '{sep}{table}{sep}.{sep}{col}{sep}'.format(
+            sep=self.get_separator(), **col)
+
+    def get_select_cols_str(self, cols):
+        """
+        Список колонок для выборки
+
+        Args:
+            cols(list): Название колонок
+
+        Returns:
+            str: Перечисление колонок через запятую
+        """
+        return ', '.join([self.get_col_str(x) for x in cols])
+
+    def get_keyset_condition(self, key_cols):
+        """
+        Условие продолжения выборки после последней прочитанной строки.
+        Для составного ключа (k1, k2) условие раскрывается в
+        (k1 > v1) OR (k1 = v1 AND k2 > v2), так как сравнение кортежей
+        поддерживается не всеми базами
+
+        Args:
+            key_cols(list): Колонки ключа сортировки
+
+        Returns:
+            str: Условие с маркерами параметров. Порядок параметров
+            см. `get_keyset_params`
+        """
+        marker = self.db_map.param_marker
+        number = 0
+        conditions = []
+        for i, key_col in enumerate(key_cols):
+            parts = []
+            for prev_col in key_cols[:i]:
+                number += 1
+                parts.append('{0} = {1}'.format(
+                    self.get_col_str(prev_col), marker.format(number)))
+            number += 1
+            parts.append('{0} > {1}'.format(
+                self.get_col_str(key_col), marker.format(number)))
+            conditions.append('({0})'.format(' AND '.join(parts)))
+        return ' OR '.join(conditions)
+
+    @staticmethod
+    def get_keyset_params(last_values):
+        """
+        Параметры для условия `get_keyset_condition`
+
+        Args:
+            last_values(list): Значения ключа последней прочитанной строки
+
+        Returns:
+            list: Значения в порядке следования маркеров в условии
+        """
+        params = []
+        for i in xrange(len(last_values)):
+            params.extend(last_values[:i + 1])
+        return params
+
+    def get_keyset_rows_query(self, cols, structure, key_cols):
+        """
+        Формирование строки запроса на получение данных из базы
+        с keyset-пагинацией (WHERE pk > last_seen ORDER BY pk LIMIT n)
+
+        Args:
+            cols(list): Название колонок
+            structure(dict): Структура данных
+            key_cols(list): Колонки ключа сортировки
+
+        Returns:
+            str: Строка запроса с местами {0} под условие продолжения
+            и {1} под лимит
+        """
+        query_join = self.generate_join(structure)
+        key_str = ', '.join([self.get_col_str(x) for x in key_cols])
+
+        return self.db_map.keyset_row_query.format(
+            self.get_select_cols_str(cols), query_join,
+            '{0}', key_str, '{1}')
+
     def get_rows(self, cols, structure):
         """
         Получаем записи из клиентской базы для предварительного показа
@@ -368,6 +702,67 @@ class Database(object):
         return {x[0].lower(): ({'count': int(x[1]), 'size': x[2]}
                 if (x[1] and x[2]) else None) for x in records}
 
+    @staticmethod
+    def get_structure_tables(structure):
+        """
+        Список таблиц дерева
+
+        Args:
+            structure(dict): Структура дерева таблиц
+
+        Returns:
+            list: Названия таблиц
+        """
+        tables = [structure['val']]
+        for child in structure['childs']:
+            tables.extend(Database.get_structure_tables(child))
+        return tables
+
+    def get_structure_rows_number(self, structure, cols):
+        """
+        Быстрая оценка числа строк запроса по плану выполнения
+
+        Args:
+            structure(dict): Структура дерева таблиц
+            cols(list): Выбранные колонки
+
+        Returns:
+            int: Оценка планировщика, None если она недоступна
+        """
+        return None
+
+    def get_catalog_rows_number(self, source, structure):
+        """
+        Оценка числа строк запроса по статистике каталога:
+        число строк самой большой таблицы дерева
+
+        Args:
+            source(`Datasource`): Источник
+            structure(dict): Структура дерева таблиц
+
+        Returns:
+            int: Оценка числа строк
+        """
+        stats = self.get_statistic(
+            source, self.get_structure_tables(structure))
+        counts = [x['count'] for x in stats.itervalues() if x]
+        return max(counts) if counts else 0
+
+    def get_exact_rows_number(self, structure):
+        """
+        Точное число строк запроса. Выполняет count(1) по всему
+        соединению таблиц, поэтому может работать долго
+
+        Args:
+            structure(dict): Структура дерева таблиц
+
+        Returns:
+            int: Число строк
+        """
+        count_query = self.get_select_query().format(
+            'count(1)', self.generate_join(structure))
+        return int(self.get_query_result(count_query)[0][0])
+
     def get_columns(self, source, tables):
         """
         Получение списка колонок в таблицах
@@ -123,3 +123,11 @@ rows_query = """
     WHERE RowNum > {3}
     AND RowNum <= {2}+{3}
 """
+
+# выборка с keyset-пагинацией: {2} - условие продолжения, {3} - ключ сортировки
+keyset_row_query = """
+    SELECT TOP {4} {0} FROM {1} {2} ORDER BY {3}
+"""
+
+# маркер параметра запроса
+param_marker = '%s'
@@ -122,6 +122,7 @@ stat_query = """
 remote_table_query = """
     CREATE TABLE IF NOT EXISTS `{0}` (
         {1}
+        `cdc_id` bigint NOT NULL AUTO_INCREMENT UNIQUE,
         `cdc_created_at` timestamp NOT NULL,
         `cdc_updated_at` timestamp,
         `cdc_delta_flag` smallint NOT NULL,
@@ -129,7 +130,9 @@ remote_table_query = """
     );
 """
 
+# cdc_id - порядковый номер изменения, порядок операций по ключу
 cdc_required_types = {
+    "cdc_id": {"type": "bigint", "nullable": "NOT NULL AUTO_INCREMENT UNIQUE"},
     "cdc_created_at": {"type": "timestamp", "nullable": "NOT NULL"},
     "cdc_updated_at": {"type": "timestamp", "nullable": ""},
     "cdc_delta_flag": {"type": "smallint", "nullable": "NOT NULL"},
@@ -161,10 +164,24 @@ remote_triggers_query = """
     END
 """
 
+cdc_compact_query = """
+    UPDATE `{0}` t JOIN `{0}` n ON {1} AND n.`cdc_id` > t.`cdc_id`
+    SET t.`cdc_synced` = {synced}, t.`cdc_updated_at` = now()
+    WHERE t.`cdc_synced` = {processing} AND n.`cdc_synced` = {processing};
+"""
+
 row_query = """
     SELECT {0} FROM {1} LIMIT {2} OFFSET {3};
 """
 
+# выборка с keyset-пагинацией: {2} - условие продолжения, {3} - ключ сортировки
+keyset_row_query = """
+    SELECT {0} FROM {1} {2} ORDER BY {3} LIMIT {4};
+"""
+
+# маркер параметра запроса
+param_marker = '%s'
+
 
 pr_key_query = """
     select a.constraint_name
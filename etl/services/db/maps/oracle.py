@@ -77,6 +77,16 @@ row_query = """
     WHERE rn BETWEEN {3} AND {4}
 """
 
+# выборка с keyset-пагинацией: {2} - условие продолжения, {3} - ключ сортировки
+keyset_row_query = """
+    SELECT * FROM (
+    SELECT {0} FROM {1} {2} ORDER BY {3})
+    WHERE ROWNUM <= {4}
+"""
+
+# маркер параметра запроса (нумерованный)
+param_marker = ':{0}'
+
 stat_query = """
     SELECT ut.table_name, ut.num_rows, s.t_size
       FROM user_tables ut
@@ -154,6 +154,7 @@ stat_query = """
 remote_table_query = """
     CREATE TABLE IF NOT EXISTS "{0}" (
         {1}
+        "cdc_id" bigserial NOT NULL,
         "cdc_created_at" timestamp NOT NULL,
         "cdc_updated_at" timestamp,
         "cdc_delta_flag" smallint NOT NULL,
@@ -161,7 +162,11 @@ remote_table_query = """
     );
 """
 
+# cdc_id - порядковый номер изменения, порядок операций по ключу,
+# add_type - тип при добавлении колонки, если он отличается от типа колонки
 cdc_required_types = {
+    "cdc_id": {"type": "bigint", "add_type": "bigserial",
+               "nullable": "NOT NULL"},
     "cdc_created_at": {"type": "timestamp", "nullable": "NOT NULL"},
     "cdc_updated_at": {"type": "timestamp", "nullable": ""},
     "cdc_delta_flag": {"type": "smallint", "nullable": "NOT NULL"},
@@ -174,15 +179,15 @@ remote_triggers_query = """
     BEGIN
         IF (TG_OP = 'DELETE') THEN
             INSERT INTO "{new_table}" ({cols} "cdc_created_at", "cdc_updated_at", "cdc_delta_flag", "cdc_synced")
-            SELECT {old} now(), null, 3, 0;
+            SELECT {old} clock_timestamp(), null, 3, 0;
             RETURN OLD;
         ELSIF (TG_OP = 'UPDATE') THEN
             INSERT INTO "{new_table}" ({cols} "cdc_created_at", "cdc_updated_at", "cdc_delta_flag", "cdc_synced")
-            SELECT {new} now(), null, 2, 0;
+            SELECT {new} clock_timestamp(), null, 2, 0;
             RETURN NEW;
         ELSIF (TG_OP = 'INSERT') THEN
             INSERT INTO "{new_table}" ({cols} "cdc_created_at", "cdc_updated_at", "cdc_delta_flag", "cdc_synced")
-            SELECT {new} now(), null, 1, 0;
+            SELECT {new} clock_timestamp(), null, 1, 0;
             RETURN NEW;
         END IF;
         RETURN NULL;
@@ -196,10 +201,25 @@ AFTER INSERT OR UPDATE OR DELETE ON "{orig_table}"
     FOR EACH ROW EXECUTE PROCEDURE process_{new_table}_audit();
 """
 
+cdc_compact_query = """
+    UPDATE "{0}" t SET "cdc_synced" = {synced}, "cdc_updated_at" = now()
+    FROM "{0}" n
+    WHERE t."cdc_synced" = {processing} AND n."cdc_synced" = {processing}
+        AND {1} AND n."cdc_id" > t."cdc_id";
+"""
+
 row_query = """
         SELECT {0} FROM {1} LIMIT {2} OFFSET {3};
 """
 
+# выборка с keyset-пагинацией: {2} - условие продолжения, {3} - ключ сортировки
+keyset_row_query = """
+        SELECT {0} FROM {1} {2} ORDER BY {3} LIMIT {4};
+"""
+
+# маркер параметра запроса
+param_marker = '%s'
+
 pr_key_query = """
     SELECT c.conname AS constraint_name FROM pg_constraint c
         LEFT JOIN pg_class t  ON c.conrelid  = t.oid
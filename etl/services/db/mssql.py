@@ -16,6 +16,8 @@ from etl.services.db.maps import mssql as mssql_map
 class MsSql(Database):
     """Управление источником данных MSSQL"""
 
+    db_map = mssql_map
+
     @staticmethod
     def get_connection(conn_info):
         """
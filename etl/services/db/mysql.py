@@ -2,6 +2,7 @@
 
 from .interfaces import Database
 import MySQLdb
+from MySQLdb.cursors import SSCursor
 from collections import defaultdict
 from itertools import groupby
 from etl.services.db.maps import mysql as mysql_map
@@ -39,10 +40,18 @@ class Mysql(Database):
         """
         return '`'
 
+    def get_stream_cursor(self, batch_size):
+        """
+        Небуферизованный курсор, результат не загружается в память целиком
+        """
+        cursor = self.connection.cursor(SSCursor)
+        cursor.arraysize = batch_size
+        return cursor
+
     def get_structure_rows_number(self, structure, cols):
 
         """
-        возвращает примерное кол-во строк в запросе для планирования
+        возвращает примерное кол-во строк в запросе по плану выполнения
         :param structure:
         :param cols:
         :return:
@@ -61,18 +70,11 @@ class Mysql(Database):
             cols_str, query_join)
 
         records = self.get_query_result(explain_query)
+        # перемноженное кол-во в каждой строке, возвращенной EXPLAIN-ом,
+        # точный count делается только в get_exact_rows_number
         total = 1
         for rec in records:
-            total *= int(rec[8])
-        # если total меньше 100000, то делаем count запрос
-        # иначе возвращаем перемноженное кол-во в каждой строке,
-        # возвращенной EXPLAIN-ом
-        if total < 100000:
-            rows_count_query = select_query.format(
-                'count(1) ', query_join)
-            records = self.get_query_result(rows_count_query)
-            # records = ((100L,),)
-            return int(records[0][0])
+            total *= int(rec[8] or 1)
         return total
 
     @staticmethod
@@ -35,6 +35,21 @@ class Oracle(Database):
         except cx_Oracle.OperationalError:
             return None
 
+    @staticmethod
+    def get_select_query():
+        """
+        возвращает селект запрос
+        :return: str
+        """
+        return "SELECT {0} FROM {1}"
+
+    @staticmethod
+    def get_ping_query():
+        """
+        Запрос проверки соединения
+        """
+        return "SELECT 1 FROM DUAL"
+
     @staticmethod
     def _get_columns_query(source, tables):
         """
@@ -180,11 +195,20 @@ class Oracle(Database):
                     })
         return columns, indexes, foreigns
 
-    def get_rows_query(self, cols, structure):
+    def get_select_cols_str(self, cols):
+        """
+        Список колонок с алиасами, чтобы одноименные колонки разных таблиц
+        не конфликтовали во внешнем запросе
+        """
+        pre_cols_str = '{sep}{0}{sep}.{sep}{1}{sep} {0}__{1}'.format(
+            '{table}', '{col}', sep=self.get_separator())
+        return ', '.join([pre_cols_str.format(**x) for x in cols])
+
+    def get_rows_query(self, cols, structure, condition=None):
         """
         Формирования строки запроса на получение данных из базы
         """
-        query_join = self.generate_join(structure,)
+        query_join = self.get_filtered_join(structure, condition)
 
         separator = self.get_separator()
 
@@ -0,0 +1,213 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import os
+import time
+import threading
+from collections import defaultdict
+
+
+class ConnectionPool(object):
+    """
+    Пул подключений к базам данных в пределах процесса.
+    Хранит свободные инстансы `Database` по параметрам подключения,
+    чтобы вьюхи и задачи celery не открывали новое соединение
+    на каждый запрос к источнику или хранилищу
+
+    Attributes:
+        max_size(int): Максимум свободных соединений на одно подключение
+        idle_timeout(int): Время простоя соединения в секундах,
+            после которого оно закрывается
+    """
+
+    def __init__(self, max_size, idle_timeout):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def get_key(connection):
+        """
+        Ключ пула по параметрам подключения
+
+        Args:
+            connection(dict): Параметры подключения
+
+        Returns:
+            tuple: Отсортированные пары параметров
+        """
+        return tuple(sorted(
+            (k, unicode(v)) for k, v in connection.iteritems()))
+
+    def _check_pid(self):
+        """
+        После форка воркера соединения родителя не используем и не закрываем,
+        они принадлежат другому процессу
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                self._idle = defaultdict(list)
+                self._pid = os.getpid()
+
+    @staticmethod
+    def close(instance):
+        """
+        Закрытие соединения инстанса, ошибки закрытия игнорируются
+        """
+        try:
+            instance.connection.close()
+        except Exception:
+            pass
+
+    def acquire(self, connection, factory):
+        """
+        Получение инстанса из пула. Свободный инстанс проверяется
+        на время простоя и работоспособность, иначе создается новый
+
+        Args:
+            connection(dict): Параметры подключения
+            factory(function): Создание инстанса по параметрам подключения
+
+        Returns:
+            `Database`: Инстанс базы данных
+        """
+        self._check_pid()
+        key = self.get_key(connection)
+
+        while True:
+            with self._lock:
+                if not self._idle[key]:
+                    break
+                instance, released_at = self._idle[key].pop()
+
+            if (time.time() - released_at > self.idle_timeout or
+                    not instance.is_alive()):
+                self.close(instance)
+                continue
+            return instance
+
+        instance = factory(**dict(connection))
+        # без соединения инстанс в пул не возвращается
+        if instance.connection is not None:
+            instance.pool_key = key
+        return instance
+
+    def release(self, instance):
+        """
+        Возврат инстанса в пул. Незавершенная транзакция откатывается,
+        лишние соединения сверх max_size закрываются
+
+        Args:
+            instance(`Database`): Инстанс базы данных
+        """
+        key = getattr(instance, 'pool_key', None)
+        if key is None:
+            return
+        self._check_pid()
+
+        try:
+            instance.connection.rollback()
+        except Exception:
+            self.close(instance)
+            return
+
+        with self._lock:
+            if len(self._idle[key]) < self.max_size:
+                self._idle[key].append((instance, time.time()))
+                return
+        self.close(instance)
+
+    def clear(self):
+        """
+        Закрытие всех свободных соединений пула
+        """
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for instances in idle.itervalues():
+            for instance, released_at in instances:
+                self.close(instance)
+
+
+class MongoClientRegistry(object):
+    """
+    Клиенты Mongodb в пределах процесса, по одному на адрес сервера.
+    Клиент потокобезопасен и сам держит пул сокетов, поэтому
+    подключения и задачи воркера используют общий клиент
+
+    Attributes:
+        factory(function): Создание клиента по адресу сервера
+        options(dict): Параметры клиента (размер пула сокетов,
+            write concern, read preference)
+        created(int): Число созданных клиентов
+        borrowed(int): Число обращений к клиентам
+    """
+
+    def __init__(self, factory, **options):
+        self.factory = factory
+        self.options = options
+        self.created = 0
+        self.borrowed = 0
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        """
+        После форка воркера клиенты родителя не используем и не закрываем,
+        их потоки мониторинга остались в другом процессе
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                self._clients = {}
+                self._pid = os.getpid()
+
+    def get_client(self, host, port):
+        """
+        Клиент сервера, создается при первом обращении
+
+        Args:
+            host(str): Хост
+            port(int): Порт
+
+        Returns:
+            `MongoClient`: Клиент
+        """
+        self._check_pid()
+        key = (host, int(port))
+        with self._lock:
+            self.borrowed += 1
+            client = self._clients.get(key)
+            if client is None:
+                client = self.factory(host, int(port), **self.options)
+                self._clients[key] = client
+                self.created += 1
+            return client
+
+    def get_stats(self):
+        """
+        Счетчики использования для мониторинга
+
+        Returns:
+            dict: {'clients': <открытые клиенты>, 'created': <создано>,
+                'borrowed': <обращений>, 'pool_size': <сокетов на клиент>}
+        """
+        return {
+            'clients': len(self._clients),
+            'created': self.created,
+            'borrowed': self.borrowed,
+            'pool_size': self.options.get('maxPoolSize'),
+        }
+
+    def clear(self):
+        """
+        Закрытие всех клиентов процесса
+        """
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.itervalues():
+            try:
+                client.close()
+            except Exception:
+                pass
@@ -3,6 +3,7 @@ from .interfaces import Database
 from etl.services.db.maps import postgresql as pgsql_map
 from collections import defaultdict
 from itertools import groupby
+import uuid
 import psycopg2
 
 
@@ -31,9 +32,18 @@ class Postgresql(Database):
         """
         return '\"'
 
+    def get_stream_cursor(self, batch_size):
+        """
+        Именованный (серверный) курсор, строки передаются пакетами по itersize
+        """
+        cursor = self.connection.cursor(
+            name='etl_stream_{0}'.format(uuid.uuid4().hex))
+        cursor.itersize = batch_size
+        return cursor
+
     def get_structure_rows_number(self, structure, cols):
         """
-        возвращает примерное кол-во строк в запросе для планирования
+        возвращает примерное кол-во строк в запросе по плану выполнения
         :param structure:
         :param cols:
         :return:
@@ -49,14 +59,15 @@ class Postgresql(Database):
         select_query = self.get_select_query().format(
             cols_str, query_join)
 
-        explain_query = 'explain analyze ' + select_query
+        # без analyze запрос не выполняется, берется оценка планировщика
+        explain_query = 'explain ' + select_query
         records = self.get_query_result(explain_query)
         data = records[0][0].split()
         count = None
         for d in data:
             if d.startswith('rows='):
                 count = d
-        return int(count[5:])
+        return int(count[5:]) if count else None
 
     @staticmethod
     def _get_columns_query(source, tables):
@@ -7,12 +7,15 @@ import operator
 
 
 class EtlEncoder:
+    # формат, в котором даты хранятся в промежуточных коллекциях
+    date_format = '%d.%m.%Y'
+
     @staticmethod
     def encode(obj):
         if isinstance(obj, datetime.datetime):
-            return obj.strftime('%d.%m.%Y')
+            return obj.strftime(EtlEncoder.date_format)
         elif isinstance(obj, datetime.date):
-            return obj.strftime('%d.%m.%Y')
+            return obj.strftime(EtlEncoder.date_format)
         elif isinstance(obj, decimal.Decimal):
             return float(obj)
         return obj
@@ -63,6 +66,32 @@ def get_table_name(prefix, key):
         prefix, key)
 
 
+def split_key_range(min_key, max_key, parts):
+    """
+    Разбиение диапазона целочисленного ключа на равные части
+
+    Args:
+        min_key(int): Минимальное значение ключа
+        max_key(int): Максимальное значение ключа
+        parts(int): Число частей
+
+    Returns:
+        list of tuple: Диапазоны [start, end), у последнего end=None
+    """
+    min_key, max_key = int(min_key), int(max_key)
+    parts = max(1, min(parts, max_key - min_key + 1))
+    step = -(-(max_key - min_key + 1) // parts)
+
+    ranges = []
+    for i in xrange(parts):
+        start = min_key + i * step
+        if start > max_key:
+            break
+        ranges.append((start, start + step))
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
 def datetime_now_str():
     """
     Нынешнее время в строковой форме
@@ -6,17 +6,30 @@ import brukva
 from pymongo import IndexModel
 from psycopg2 import Binary
 import pymongo
-from etl.constants import TYPES_MAP
-from etl.services.db.interfaces import BaseEnum
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+from etl.constants import TYPES_MAP, FIELD_NAME_SEP
+from etl.services.db.interfaces import BaseEnum, Database, JoinTypes
+from etl.services.db.pool import MongoClientRegistry
 from etl.services.datasource.repository.storage import RedisSourceService
 from core.models import (QueueList, Queue, QueueStatus)
 from core.exceptions import TaskError
 import json
+import sys
+import time
+import hashlib
+import math
 import datetime
-from itertools import izip
+import threading
+import struct
+import Queue as queue
+from cStringIO import StringIO
+from collections import OrderedDict
+from operator import itemgetter
+from itertools import izip, islice, repeat
 from bson import binary
 
-from etl.services.middleware.base import datetime_now_str
+from etl.services.middleware.base import datetime_now_str, EtlEncoder
 
 client = brukva.Client(host=settings.REDIS_HOST,
                        port=int(settings.REDIS_PORT),
@@ -212,60 +225,168 @@ def get_group_tasks(task_params):
     return group(group_tasks), channels
 
 
-class RowKeysCreator(object):
+class RowKeyEngine(object):
     """
-    Расчет ключа для таблицы
+    Расчет 64-битных ключей строк источника.
+    Номера колонок каждой таблицы определяются один раз, значения строки
+    сериализуются за один проход (бинарные данные без перекодирования)
+    и хэшируются одним вызовом md5
+
+    Attributes:
+        plans(list): Планы таблиц [(<номера колонок>, <есть первичный ключ>)]
+        collisions(int): Число совпавших ключей
     """
+    # разделители значений и таблиц в хэшируемой строке
+    value_sep = b'\x1f'
+    table_sep = b'\x1e'
+    null_value = b'\x00'
 
-    def __init__(self, table, cols, primary_keys=None):
+    def __init__(self, cols, meta_info):
         """
         Args:
-            table(str): Название таблицы
-            cols(list): Список словарей с названиями колонок и соотв. таблиц
-            primary_keys(list): Список уникальных ключей
+            cols(list): Выбранные колонки
+            meta_info(dict): Метаданные по таблицам
         """
-        self.table = table
-        self.cols = cols
-        self.primary_keys = primary_keys
-        # primary_keys_indexes(list): Порядковые номера первичных ключей
-        self.primary_keys_indexes = list()
-
-    def calc_key(self, row, row_num):
+        self.plans = []
+        for table in sorted(meta_info):
+            indexes = [ind for ind, x in enumerate(cols) if x['table'] == table]
+            has_primary = any(
+                x['is_primary'] for x in meta_info[table]['indexes'])
+            self.plans.append((indexes, has_primary))
+        self.collisions = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def to_bytes(cls, value):
         """
-        Расчет ключа для строки таблицы либо по первичному ключу
-        либо по номеру и значениям этой строки
+        Значение колонки для хэширования
+        """
+        if value is None:
+            return cls.null_value
+        if isinstance(value, unicode):
+            return value.encode('utf8')
+        if isinstance(value, (str, buffer, bytearray)):
+            return str(value)
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    def key_for_row(self, row, row_num):
+        """
+        Ключ строки. Без первичного ключа у таблицы в расчет
+        добавляется номер строки
 
         Args:
             row(tuple): Строка данных
             row_num(int): Номер строки
 
         Returns:
-            int: Ключ строки для таблицы
+            int: Ключ строки
         """
-        l = [y for (x, y) in zip(self.cols, row) if x['table'] == self.table]
-        if self.primary_keys:
-            l.append(binascii.crc32(''.join(
-                [str(row[index]) for index in self.primary_keys_indexes])))
-        else:
-            l.append(row_num)
-        return binascii.crc32(
-                reduce(lambda res, x: '%s%s' % (res, x), l).encode("utf8"))
+        to_bytes = self.to_bytes
+        tables = []
+        for indexes, has_primary in self.plans:
+            values = [to_bytes(row[ind]) for ind in indexes]
+            if not has_primary:
+                values.append(str(row_num))
+            tables.append(self.value_sep.join(values))
+        return struct.unpack(
+            b'<q', hashlib.md5(self.table_sep.join(tables)).digest()[:8])[0]
+
+    def keys_for_batch(self, rows, start_row_num):
+        """
+        Ключи пакета строк. Совпадения ключей внутри пакета
+        учитываются в счетчике коллизий
+
+        Args:
+            rows(list): Строки данных
+            start_row_num(int): Номер первой строки пакета
+
+        Returns:
+            list: Ключи строк
+        """
+        keys = [self.key_for_row(row, row_num)
+                for row_num, row in enumerate(rows, start=start_row_num)]
+        self.add_collisions(len(keys) - len(set(keys)))
+        return keys
 
-    def set_primary_key(self, data):
+    def add_collisions(self, count):
         """
-        Установка первичного ключа, если есть
+        Учет совпавших ключей, в том числе найденных при записи
+        """
+        if count:
+            with self._lock:
+                self.collisions += count
+
+
+class KeysBloomFilter(object):
+    """
+    Фильтр Блума по ключам строк. Отсутствие ключа в фильтре означает,
+    что ключа точно нет, наличие - что ключ возможно есть
+
+    Attributes:
+        size(int): Число бит фильтра
+        hashes(int): Число хэш-функций
+        bits(bytearray): Биты фильтра
+    """
 
+    def __init__(self, capacity, error_rate):
+        """
         Args:
-            data(dict): метаданные по колонкам таблицы
+            capacity(int): Ожидаемое число ключей
+            error_rate(float): Доля ложноположительных ответов
+        """
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(
+            float(self.size) / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def get_indexes(self, key):
         """
+        Номера бит ключа. Ключи уже являются хэшами,
+        поэтому номера получаются двойным хэшированием из половин ключа
+        """
+        key &= 0xffffffffffffffff
+        first, second = key & 0xffffffff, (key >> 32) | 1
+        return [(first + i * second) % self.size for i in xrange(self.hashes)]
 
-        for record in data['indexes']:
-            if record['is_primary']:
-                self.primary_keys = record['columns']
-                for ind, value in enumerate(self.cols):
-                    if value['table'] == self.table and value['col'] in self.primary_keys:
-                        self.primary_keys_indexes.append(ind)
-                break
+    def add(self, key):
+        for index in self.get_indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[index >> 3] & (1 << (index & 7))
+                   for index in self.get_indexes(key))
+
+
+# код ошибки Mongodb о существующем ключе
+DUPLICATE_KEY_ERROR = 11000
+
+
+def insert_documents(collection, documents):
+    """
+    Вставка документов в коллекцию Mongodb. Документы с уже существующим
+    ключом пропускаются
+
+    Args:
+        collection(`Collection`): Коллекция
+        documents(list): Документы
+
+    Returns:
+        int: Число пропущенных документов с существующим ключом
+    """
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if (e.details.get('writeConcernErrors') or
+                any(x['code'] != DUPLICATE_KEY_ERROR for x in errors)):
+            raise
+        return len(errors)
+    return 0
 
 
 def process_binary_data(record, binary_types_list):
@@ -281,41 +402,189 @@ def process_binary_data(record, binary_types_list):
     return new_record
 
 
-def process_binaries_for_row(row, binary_types_list):
+def to_binary(value):
     """
-    Если пришли бинарные данные,
-    то вычисляем ключ отдельный для каждого из них
+    Бинарные данные оборачиваем в bson.binary.Binary, NULL оставляем
     """
-    new_row = []
-    for i, r in enumerate(row):
-        if binary_types_list[i]:
-            r = binascii.b2a_base64(r)
-        new_row.append(r)
-    return tuple(new_row)
+    return value if value is None else binary.Binary(value)
 
 
-def calc_key_for_row(row, tables_key_creators, row_num, binary_types_list):
+class RowNormalizer(object):
     """
-    Расчет ключа для отдельно взятой строки
+    Приведение строк источника к документам Mongodb.
+    Преобразование каждой колонки выбирается один раз по ее типу,
+    колонки, не требующие преобразования (целые, строки), не обрабатываются.
+    Пакет преобразуется по колонкам, а не по строкам
+
+    Компактный документ хранит значения колонок массивом в поле 'v',
+    названия колонок хранятся один раз в схеме коллекции
+    (`MongodbConnection.set_schema`)
+
+    Attributes:
+        col_names(list): Названия полей документа для колонок
+        converters(list): Преобразования колонок [(<номер>, <функция>), ...]
+        compact(bool): Значения колонок массивом
+        rows_count(int): Число обработанных строк
+        elapsed(float): Время обработки в секундах
+    """
+    # преобразования по типу колонки, None - без преобразования
+    type_converters = {
+        'integer': None,
+        'text': None,
+        'binary': to_binary,
+    }
+    # служебные поля документа
+    service_names = ['_id', '_state', '_date']
+    # поле значений компактного документа
+    values_name = 'v'
+
+    def __init__(self, cols, col_types, compact=False):
+        """
+        Args:
+            cols(list): Выбранные колонки
+            col_types(dict): Типы колонок
+            compact(bool): Значения колонок массивом
+        """
+        self.col_names = self.service_names + get_field_names(cols)
+        self.compact = compact
+        self.converters = []
+        for ind, obj in enumerate(cols):
+            col_type = col_types['{0}.{1}'.format(obj['table'], obj['col'])]
+            # даты, decimal и неизвестные типы приводим общим кодировщиком
+            converter = self.type_converters.get(col_type, EtlEncoder.encode)
+            if converter is not None:
+                self.converters.append((ind, converter))
+        self.rows_count = 0
+        self.elapsed = 0.0
+
+    def get_documents(self, rows, keys, state, date):
+        """
+        Документы Mongodb для пакета строк
+
+        Args:
+            rows(list): Строки источника
+            keys(list): Ключи строк
+            state(str): Статус документов
+            date(str): Дата загрузки
+
+        Returns:
+            list: Документы
+        """
+        if not rows:
+            return []
+        start = time.time()
+
+        columns = zip(*rows)
+        for ind, converter in self.converters:
+            columns[ind] = map(converter, columns[ind])
+        if self.compact:
+            documents = [
+                {'_id': key, '_state': state, '_date': date,
+                 self.values_name: list(values)}
+                for key, values in izip(keys, izip(*columns))]
+        else:
+            documents = [dict(izip(self.col_names, values)) for values in izip(
+                keys, repeat(state), repeat(date), *columns)]
+
+        self.elapsed += time.time() - start
+        self.rows_count += len(documents)
+        return documents
+
+    def get_rows(self, rows, keys):
+        """
+        Строки для записи в хранилище без промежуточной коллекции,
+        значения приводятся так же, как в документах
+
+        Args:
+            rows(list): Строки источника
+            keys(list): Ключи строк
+
+        Returns:
+            list: Кортежи из ключа и значений колонок
+        """
+        if not rows:
+            return []
+        start = time.time()
+
+        columns = zip(*rows)
+        for ind, converter in self.converters:
+            columns[ind] = map(converter, columns[ind])
+        result = zip(keys, *columns)
+
+        self.elapsed += time.time() - start
+        self.rows_count += len(result)
+        return result
+
+    @property
+    def speed(self):
+        """
+        Скорость обработки, строк в секунду
+        """
+        return int(self.rows_count / self.elapsed) if self.elapsed else 0
+
+
+class StagingReader(object):
+    """
+    Чтение значений колонок из документов промежуточной коллекции.
+    Читаются компактные документы (значения массивом по схеме коллекции)
+    и документы со значениями в полях по названиям колонок
+
+    Attributes:
+        fields(list): Названия читаемых колонок по порядку
+        projection(dict): Поля документа, нужные для чтения
+    """
+
+    def __init__(self, fields, schema=None):
+        """
+        Args:
+            fields(list): Названия читаемых колонок по порядку
+            schema(list): Схема коллекции - названия колонок массива
+                значений, None, если компактных документов нет
+        """
+        self.fields = fields
+        self.projection = dict.fromkeys(
+            ['_id', RowNormalizer.values_name] + fields, True)
+        self.get_field_values = self.get_getter(fields)
+        self.get_array_values = self.get_getter(
+            [schema.index(x) for x in fields]) if schema else None
+
+    @staticmethod
+    def get_getter(items):
+        """
+        Получение кортежа значений по ключам или номерам
+        """
+        if len(items) == 1:
+            item = items[0]
+            return lambda obj: (obj[item], )
+        return itemgetter(*items)
+
+    def get_row(self, document):
+        """
+        Строка для записи в хранилище
+
+        Args:
+            document(dict): Документ
+
+        Returns:
+            tuple: Ключ документа и значения колонок
+        """
+        values = document.get(RowNormalizer.values_name)
+        if values is None:
+            return (document['_id'], ) + self.get_field_values(document)
+        return (document['_id'], ) + self.get_array_values(values)
+
+
+def get_field_names(cols):
+    """
+    Названия полей колонок в документах и таблицах хранилища
 
     Args:
-        row(tuple): строка данных
-        tables_key_creators(list of RowKeysCreator()): список экземпляров
-        класса, создающие ключи для строки конкретной таблицы
-        row_num(int): Номер строки
+        cols(list): Выбранные колонки
 
     Returns:
-        int: Ключ для строки
+        list: Названия вида <table>__<col>
     """
-    # преобразуем бинары в строку, если они есть
-    row = process_binaries_for_row(row, binary_types_list)
-
-    if len(tables_key_creators) > 1:
-        row_values_for_calc = [
-            str(each.calc_key(row, row_num)) for each in tables_key_creators]
-        return binascii.crc32(''.join(row_values_for_calc))
-    else:
-        return tables_key_creators[0].calc_key(row, row_num)
+    return [x['table'] + FIELD_NAME_SEP + x['col'] for x in cols]
 
 
 def get_binary_types_list(cols, col_types):
@@ -342,6 +611,509 @@ def get_binary_types_dict(cols, col_types):
     return binary_types_dict
 
 
+def get_keyset_columns(structure, meta_info):
+    """
+    Колонки ключа для keyset-пагинации: первичные ключи всех таблиц дерева,
+    начиная с корневой. Кортеж первичных ключей однозначно определяет строку
+    результата соединения
+
+    Args:
+        structure(dict): Структура дерева таблиц
+        meta_info(dict): Метаданные по таблицам (индексы)
+
+    Returns:
+        list or None: Список колонок вида {'table': <table>, 'col': <col>},
+        None, если у какой-либо таблицы нет первичного ключа или соединение
+        не внутреннее (при LEFT/RIGHT JOIN ключи могут быть NULL)
+    """
+    key_cols = []
+    nodes = [structure]
+    while nodes:
+        node = nodes.pop(0)
+        if node is not structure and node['join_type'] != JoinTypes.INNER:
+            return None
+        table_info = meta_info.get(node['val'])
+        if not table_info:
+            return None
+        primary_keys = None
+        for record in table_info['indexes']:
+            if record['is_primary']:
+                primary_keys = record['columns']
+                break
+        if not primary_keys:
+            return None
+        key_cols.extend(
+            [{'table': node['val'], 'col': col} for col in primary_keys])
+        nodes.extend(node['childs'])
+    return key_cols
+
+
+def get_root_key_column(structure, meta_info, col_types):
+    """
+    Целочисленный первичный ключ корневой таблицы для выборки
+    по диапазонам ключа. Первичные ключи нужны у всех таблиц дерева,
+    иначе ключ строки зависит от ее номера в выборке
+
+    Args:
+        structure(dict): Структура дерева таблиц
+        meta_info(dict): Метаданные по таблицам (индексы)
+        col_types(dict): Типы колонок
+
+    Returns:
+        dict or None: Колонка вида {'table': <table>, 'col': <col>},
+        None, если ключ составной или не целочисленный
+    """
+    key_cols = get_keyset_columns(structure, meta_info)
+    if not key_cols:
+        return None
+
+    root_keys = [x for x in key_cols if x['table'] == structure['val']]
+    if len(root_keys) != 1 or col_types.get(
+            '{table}.{col}'.format(**root_keys[0])) != 'integer':
+        return None
+    return root_keys[0]
+
+
+class BatchSizer(object):
+    """
+    Адаптивный размер пакета строк для загрузочных задач.
+    После каждого пакета замеряются средний размер строки и время
+    обработки пакета, размер следующего пакета подбирается так,
+    чтобы пакет укладывался в бюджет памяти и целевое время
+
+    Attributes:
+        size(int): Текущий размер пакета
+        min_size(int): Минимальный размер пакета
+        max_size(int): Максимальный размер пакета
+        memory_budget(int): Бюджет памяти на пакет в байтах
+        target_latency(float): Целевое время обработки пакета в секундах
+        history(list): Выбранные размеры пакетов для диагностики
+            [(<size>, <rows>, <bytes_per_row>, <latency>), ...]
+    """
+    # число строк пакета, по которым оценивается размер строки
+    sample_size = 20
+    # сколько последних замеров хранится в истории
+    history_size = 100
+
+    def __init__(self, size=None):
+        self.min_size = settings.ETL_BATCH_MIN_ROWS
+        self.max_size = settings.ETL_BATCH_MAX_ROWS
+        self.memory_budget = settings.ETL_BATCH_MEMORY_BUDGET
+        self.target_latency = settings.ETL_BATCH_TARGET_LATENCY
+        self.size = size or settings.ETL_COLLECTION_LOAD_ROWS_LIMIT
+        self.history = []
+        self.started = time.time()
+
+    @staticmethod
+    def get_row_size(row):
+        """
+        Примерный размер строки в памяти
+
+        Args:
+            row(tuple or dict): Строка источника или документ коллекции
+
+        Returns:
+            int: Размер в байтах
+        """
+        values = row.itervalues() if isinstance(row, dict) else row
+        size = 0
+        for value in values:
+            size += sys.getsizeof(value)
+            # буфер не учитывает размер самих данных
+            if isinstance(value, buffer):
+                size += len(value)
+        return size
+
+    def update(self, rows):
+        """
+        Замер обработанного пакета и выбор размера следующего
+
+        Args:
+            rows(list): Строки обработанного пакета
+
+        Returns:
+            int: Размер следующего пакета
+        """
+        now = time.time()
+        latency, self.started = now - self.started, now
+        if not rows or not settings.ETL_ADAPTIVE_BATCH:
+            return self.size
+
+        sample = list(islice(rows, self.sample_size))
+        bytes_per_row = max(
+            sum(self.get_row_size(x) for x in sample) / len(sample), 1)
+
+        by_memory = self.memory_budget // bytes_per_row
+        by_latency = (int(len(rows) * self.target_latency / latency)
+                      if latency > 0 else self.max_size)
+        # растем не больше чем вдвое за шаг, уменьшаемся сразу
+        size = min(by_memory, by_latency, self.size * 2)
+        self.size = int(max(self.min_size, min(self.max_size, size)))
+
+        self.history.append(
+            (self.size, len(rows), bytes_per_row, round(latency, 3)))
+        del self.history[:-self.history_size]
+        return self.size
+
+
+class RowsPager(object):
+    """
+    Постраничная выборка данных из источника через LIMIT/OFFSET.
+    Соединение берется из пула на время чтения и возвращается
+    по окончании данных, ошибке или закрытию итератора
+
+    Attributes:
+        source_service(`DataSourceService`): Сервис источников
+        source(`Datasource`): Источник
+        connection: Соединение с источником на время чтения
+        query(str): Строка запроса с местами {0} под лимит и {1} под оффсет
+        limit(int or `BatchSizer`): Размер страницы
+        fetched(int): Число прочитанных строк
+    """
+
+    def __init__(self, source_service, source, query, limit):
+        self.source_service = source_service
+        self.source = source
+        self.connection = None
+        self.query = query
+        self.limit = limit
+        self.fetched = 0
+
+    def get_limit(self):
+        """
+        Размер очередной страницы
+        """
+        return getattr(self.limit, 'size', self.limit)
+
+    def get_page(self):
+        """
+        Следующая страница данных
+
+        Returns:
+            list: Строки страницы, пустой список, если данные закончились
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(self.query.format(self.get_limit(), self.fetched))
+        rows = cursor.fetchall()
+        self.fetched += len(rows)
+        return rows
+
+    def __iter__(self):
+        with self.source_service.source_instance(self.source) as instance:
+            if instance.connection is None:
+                raise ValueError("Сбой при подключении!")
+            self.connection = instance.connection
+            try:
+                while True:
+                    rows = self.get_page()
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                self.connection = None
+
+
+class KeysetRowsPager(RowsPager):
+    """
+    Постраничная выборка данных из источника по ключу:
+    WHERE pk > last_seen ORDER BY pk LIMIT n.
+    В отличие от OFFSET, каждая страница читается по индексу
+    без пересканирования предыдущих строк
+
+    Attributes:
+        condition(str): Условие продолжения выборки
+        key_indexes(list): Порядковые номера колонок ключа в строке
+        cols_count(int): Число колонок, запрошенных пользователем.
+            Колонки ключа, не выбранные пользователем, добавляются
+            в конец запроса и отрезаются от результата
+        filter_condition(str): Дополнительное условие выборки
+        last_key(list): Значения ключа последней прочитанной строки
+    """
+
+    def __init__(self, source_service, source, query, limit, condition,
+                 key_indexes, cols_count, filter_condition=None):
+        super(KeysetRowsPager, self).__init__(
+            source_service, source, query, limit)
+        self.condition = condition
+        self.key_indexes = key_indexes
+        self.cols_count = cols_count
+        self.filter_condition = filter_condition
+        self.last_key = None
+
+    def get_where(self):
+        """
+        Условие выборки очередной страницы
+
+        Returns:
+            str: WHERE-часть запроса, либо пустая строка
+        """
+        conditions = []
+        if self.filter_condition:
+            conditions.append(self.filter_condition)
+        if self.last_key is not None:
+            conditions.append(self.condition)
+        if not conditions:
+            return ''
+        return 'WHERE ' + ' AND '.join(
+            ['({0})'.format(x) for x in conditions])
+
+    def get_page(self):
+        cursor = self.connection.cursor()
+        query = self.query.format(self.get_where(), self.get_limit())
+        if self.last_key is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(
+                query,
+                Database.get_keyset_params(self.last_key))
+        rows = cursor.fetchall()
+        if rows:
+            self.last_key = [rows[-1][i] for i in self.key_indexes]
+            if len(rows[0]) > self.cols_count:
+                rows = [row[:self.cols_count] for row in rows]
+        self.fetched += len(rows)
+        return rows
+
+
+class StreamRowsPager(object):
+    """
+    Выборка данных источника одним запросом через серверный курсор,
+    страницы - пакеты строк потока
+
+    Attributes:
+        rows_stream(generator): Поток пакетов строк `Database.stream_rows`
+        fetched(int): Число прочитанных строк
+    """
+
+    def __init__(self, rows_stream):
+        self.rows_stream = rows_stream
+        self.fetched = 0
+
+    def __iter__(self):
+        for rows in self.rows_stream:
+            self.fetched += len(rows)
+            yield rows
+
+
+def get_rows_pager(source_service, source, structure, cols, meta_info, limit,
+                   condition=None):
+    """
+    Постраничная выборка данных источника для загрузочных задач.
+    При settings.ETL_STREAM_EXTRACTION данные читаются одним потоком,
+    иначе при settings.ETL_KEYSET_PAGINATION и наличии первичных ключей
+    используется keyset-пагинация, в остальных случаях LIMIT/OFFSET
+
+    Args:
+        source_service(`DataSourceService`): Сервис источников
+        source(`Datasource`): Источник
+        structure(dict): Структура дерева таблиц
+        cols(list): Выбранные колонки
+        meta_info(dict): Метаданные по таблицам
+        limit(int or `BatchSizer`): Размер страницы
+        condition(str): Дополнительное условие выборки
+
+    Returns:
+        `RowsPager` or `StreamRowsPager`: Итератор по страницам данных
+    """
+    if settings.ETL_STREAM_EXTRACTION:
+        return StreamRowsPager(source_service.get_rows_stream_for_loading_task(
+            source, structure, cols, limit, condition))
+
+    key_cols = (get_keyset_columns(structure, meta_info)
+                if settings.ETL_KEYSET_PAGINATION else None)
+    if not key_cols:
+        query = source_service.get_rows_query_for_loading_task(
+            source, structure, cols, condition)
+        return RowsPager(source_service, source, query, limit)
+
+    # колонки ключа, которых нет среди выбранных, дописываем в конец
+    select_cols = list(cols)
+    key_indexes = []
+    for key_col in key_cols:
+        for ind, col in enumerate(select_cols):
+            if (col['table'], col['col']) == (key_col['table'], key_col['col']):
+                key_indexes.append(ind)
+                break
+        else:
+            key_indexes.append(len(select_cols))
+            select_cols.append(key_col)
+
+    query, keyset_condition = (
+        source_service.get_keyset_rows_query_for_loading_task(
+            source, structure, select_cols, key_cols))
+    return KeysetRowsPager(
+        source_service, source, query, limit, keyset_condition, key_indexes,
+        len(cols), filter_condition=condition)
+
+
+class BatchPipeline(object):
+    """
+    Конвейер обработки пакетов строк: чтение источника в отдельном потоке,
+    преобразование в вызывающем потоке и запись в потоках-писателях.
+    Стадии связаны очередями ограниченной длины, поэтому быстрая стадия
+    ждет медленную, а в памяти не больше depth пакетов на очередь.
+    Без settings.ETL_PIPELINE_EXTRACTION стадии выполняются по очереди
+
+    Attributes:
+        transform(function): Преобразование пакета, вызывается по порядку
+        write(function): Запись преобразованного пакета
+        writers(int): Число потоков записи
+        depth(int): Длина очередей между стадиями
+    """
+    # признак окончания данных в очереди
+    END = object()
+    # период проверки остановки конвейера при ожидании очереди, сек
+    poll_timeout = 0.1
+
+    def __init__(self, transform, write, writers=None, depth=None):
+        self.transform = transform
+        self.write = write
+        self.writers = writers or settings.ETL_PIPELINE_WRITERS
+        self.depth = depth or settings.ETL_PIPELINE_DEPTH
+        self.stopped = threading.Event()
+        self.errors = []
+
+    def run(self, batches, on_written=None, on_error=None):
+        """
+        Обработка всех пакетов
+
+        Args:
+            batches(iterable): Пакеты строк
+            on_written(function): Вызывается с результатом write
+                в вызывающем потоке
+            on_error(function): Вызывается с исключением записи,
+                без него исключение пробрасывается
+        """
+        if not settings.ETL_PIPELINE_EXTRACTION:
+            for batch in batches:
+                try:
+                    result = self.write(self.transform(batch))
+                except Exception as e:
+                    self.handle_result((None, e), on_written, on_error)
+                else:
+                    self.handle_result((result, None), on_written, on_error)
+            return
+
+        read_queue = queue.Queue(self.depth)
+        write_queue = queue.Queue(self.depth)
+        done_queue = queue.Queue()
+
+        threads = [threading.Thread(
+            target=self.read_worker, args=(batches, read_queue))]
+        for i in xrange(self.writers):
+            threads.append(threading.Thread(
+                target=self.write_worker, args=(write_queue, done_queue)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                batch = self.get(read_queue)
+                if batch is self.END:
+                    break
+                self.put(write_queue, self.transform(batch))
+                self.drain(done_queue, on_written, on_error)
+
+            for i in xrange(self.writers):
+                self.put(write_queue, self.END)
+            for thread in threads[1:]:
+                thread.join()
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+
+        self.drain(done_queue, on_written, on_error)
+        if self.errors:
+            raise self.errors[0]
+
+    def get(self, from_queue):
+        """
+        Получение из очереди, при остановке конвейера - END
+        """
+        while not self.stopped.is_set():
+            try:
+                return from_queue.get(timeout=self.poll_timeout)
+            except queue.Empty:
+                continue
+        return self.END
+
+    def put(self, to_queue, item):
+        """
+        Запись в очередь с ожиданием места, пока конвейер не остановлен
+        """
+        while not self.stopped.is_set():
+            try:
+                to_queue.put(item, timeout=self.poll_timeout)
+                return
+            except queue.Full:
+                continue
+
+    def stop(self, error):
+        """
+        Остановка конвейера из-за ошибки стадии
+        """
+        self.errors.append(error)
+        self.stopped.set()
+
+    def read_worker(self, batches, read_queue):
+        """
+        Поток чтения пакетов
+        """
+        iterator = iter(batches)
+        try:
+            for batch in iterator:
+                self.put(read_queue, batch)
+                if self.stopped.is_set():
+                    break
+            self.put(read_queue, self.END)
+        except Exception as e:
+            self.stop(e)
+        finally:
+            # закрываем курсор источника в том же потоке, где он читался
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def write_worker(self, write_queue, done_queue):
+        """
+        Поток записи пакетов
+        """
+        while True:
+            data = self.get(write_queue)
+            if data is self.END:
+                break
+            try:
+                done_queue.put((self.write(data), None))
+            except Exception as e:
+                done_queue.put((None, e))
+
+    def drain(self, done_queue, on_written, on_error):
+        """
+        Обработка результатов записанных пакетов в вызывающем потоке
+        """
+        while True:
+            try:
+                result = done_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_result(result, on_written, on_error)
+
+    def handle_result(self, result, on_written, on_error):
+        """
+        Передача результата записи или ее ошибки обработчикам
+        """
+        written, error = result
+        if error is not None:
+            if on_error is None:
+                self.stop(error)
+                raise error
+            on_error(error)
+        elif on_written is not None:
+            on_written(written)
+
+
 class Query(object):
     """
     Класс формирования и совершения запроса
@@ -351,6 +1123,7 @@ class Query(object):
         self.source_service = source_service
         self.cursor = cursor
         self.query = query
+        self.local_instance = None
 
     def set_query(self, **kwargs):
         raise NotImplemented
@@ -362,18 +1135,26 @@ class Query(object):
 class TableCreateQuery(Query):
 
     def set_connection(self):
-        local_instance = self.source_service.get_local_instance()
-        self.connection = local_instance.connection
+        if self.local_instance is None:
+            self.local_instance = self.source_service.get_local_instance()
+        self.connection = self.local_instance.connection
+
+    def release(self):
+        """
+        Возврат соединения с хранилищем в пул
+        """
+        if self.local_instance is not None:
+            self.source_service.release_instance(self.local_instance)
+            self.local_instance = None
 
     def set_query(self, **kwargs):
-        local_instance = self.source_service.get_local_instance()
+        self.set_connection()
 
         self.query = self.source_service.get_table_create_query(
-            local_instance,
+            self.local_instance,
             kwargs['table_name'],
             ', '.join(kwargs['cols'])
         )
-        self.set_connection()
 
     def execute(self):
         self.cursor = self.connection.cursor()
@@ -384,16 +1165,80 @@ class TableCreateQuery(Query):
         return
 
 
+class TableDropQuery(TableCreateQuery):
+    """
+    Удаление таблиц хранилища
+    """
+
+    def set_query(self, **kwargs):
+        """
+        Args:
+            table_names(list): Названия таблиц
+        """
+        self.set_connection()
+        self.query = 'DROP TABLE IF EXISTS {0}'.format(
+            ', '.join(kwargs['table_names']))
+
+
+class TableIndexQuery(TableCreateQuery):
+    """
+    Создание индекса таблицы хранилища, существующий индекс не пересоздается
+    """
+
+    def set_query(self, **kwargs):
+        """
+        Args:
+            table_name(str): Название таблицы
+            index_name(str): Название индекса
+            columns(list): Колонки индекса
+        """
+        self.set_connection()
+        self.index_name = kwargs['index_name']
+        self.query = 'CREATE INDEX {0} ON {1} ({2})'.format(
+            self.index_name, kwargs['table_name'],
+            ', '.join(['"{0}"'.format(x) for x in kwargs['columns']]))
+
+    def execute(self):
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(
+            "SELECT 1 FROM pg_class WHERE relname = %s", (self.index_name, ))
+        if not self.cursor.fetchall():
+            self.cursor.execute(self.query)
+        self.connection.commit()
+
+
+def split_cdc_key_tables(cursor, table_names):
+    """
+    Разделение существующих таблиц хранилища на таблицы с колонкой cdc_key
+    и таблицы, созданные до ее появления. Строки вторых по ключу
+    не изменить, таблицы пересоздаются
+
+    Args:
+        cursor: Курсор хранилища
+        table_names(list): Названия таблиц
+
+    Returns:
+        tuple: (<таблицы с cdc_key>, <таблицы без cdc_key>),
+            несуществующие таблицы пропускаются
+    """
+    cursor.execute(
+        "SELECT table_name, bool_or(column_name = 'cdc_key') "
+        "FROM information_schema.columns WHERE table_name IN %s "
+        "GROUP BY table_name", (tuple(table_names), ))
+    has_key = dict(cursor.fetchall())
+    return ([x for x in table_names if has_key.get(x)],
+            [x for x in table_names if has_key.get(x) is False])
+
+
 class InsertQuery(TableCreateQuery):
 
     def set_query(self, **kwargs):
-        local_instance = self.source_service.get_local_instance()
+        self.set_connection()
         insert_table_query = self.source_service.get_table_insert_query(
-            local_instance, kwargs['table_name'])
+            self.local_instance, kwargs['table_name'])
         self.query = insert_table_query.format(
             '(%s)' % ','.join(['%({0})s'.format(i) for i in xrange(
                 kwargs['cols_nums'])]))
-        self.set_connection()
 
     def execute(self, **kwargs):
         self.cursor = self.connection.cursor()
@@ -413,28 +1258,426 @@ class InsertQuery(TableCreateQuery):
         return
 
 
-class DeleteQuery(TableCreateQuery):
+class CopyQuery(TableCreateQuery):
+    """
+    Пакетная вставка в таблицу хранилища через COPY ... FROM STDIN.
+    Пакет передается одним потоком данных, а не отдельным INSERT
+    на каждую строку, как при executemany.
+
+    Текстовый формат не требует типов колонок. Бинарный формат
+    требует типы всех колонок (col_types), иначе используется текстовый
+    """
+    TEXT, BINARY = ('text', 'binary')
+
+    # начало и конец потока бинарного COPY
+    binary_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+    binary_trailer = struct.pack('>h', -1)
+    # 2000-01-01, начало отсчета дат и времени в бинарном формате
+    pg_epoch = datetime.datetime(2000, 1, 1)
+
+    text_escapes = [
+        (b'\\', b'\\\\'), (b'\t', b'\\t'), (b'\n', b'\\n'), (b'\r', b'\\r')]
 
     def set_query(self, **kwargs):
-        delete_table_query = "DELETE from {0} where cdc_key in ('{1}');"
-        self.query = delete_table_query.format(
-            kwargs['table_name'], '{0}')
+        """
+        Args:
+            table_name(str): Название таблицы
+            cols_nums(int): Число колонок
+            col_types(list): Типы колонок таблицы, нужны для бинарного формата
+            copy_format(str): Формат COPY, по умолчанию settings.ETL_COPY_FORMAT
+        """
         self.set_connection()
+        self.cols_nums = kwargs['cols_nums']
+        self.col_types = kwargs.get('col_types')
+        self.copy_format = kwargs.get('copy_format', settings.ETL_COPY_FORMAT)
+
+        if self.copy_format == self.BINARY and not (
+                self.col_types and all(
+                    t in self.binary_packers for t in self.col_types)):
+            self.copy_format = self.TEXT
+
+        if self.copy_format == self.BINARY:
+            self.query = "COPY {0} FROM STDIN WITH BINARY".format(
+                kwargs['table_name'])
+        else:
+            self.query = "COPY {0} FROM STDIN".format(kwargs['table_name'])
+
+    def get_values(self, row):
+        """
+        Значения строки по порядку колонок.
+        Строка - кортеж либо словарь {'0': .., '1': .., ...}, как у InsertQuery
+        """
+        if isinstance(row, dict):
+            return [row[str(i)] for i in xrange(self.cols_nums)]
+        return row
+
+    @staticmethod
+    def to_bytes(value):
+        """
+        Байты бинарного значения
+        """
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return bytes(value)
+
+    @classmethod
+    def to_timestamp(cls, value):
+        """
+        Микросекунды от начала отсчета PostgreSQL
+        """
+        if isinstance(value, basestring):
+            value = datetime.datetime.strptime(value, EtlEncoder.date_format)
+        elif not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+        if value.tzinfo is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        delta = value - cls.pg_epoch
+        return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+    @classmethod
+    def text_value(cls, value, is_binary):
+        """
+        Значение колонки в текстовом формате COPY
+        """
+        if value is None:
+            return b'\\N'
+        if is_binary:
+            # bytea в hex-формате, обратный слеш экранируется
+            return b'\\\\x' + binascii.hexlify(cls.to_bytes(value))
+        if isinstance(value, bool):
+            return b't' if value else b'f'
+        if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, float):
+            return repr(value)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        for char, escaped in cls.text_escapes:
+            if char in value:
+                value = value.replace(char, escaped)
+        return value
+
+    def get_text_stream(self, rows, binary_cols):
+        """
+        Поток пакета строк в текстовом формате COPY
+        """
+        stream = StringIO()
+        for row in rows:
+            stream.write(b'\t'.join(
+                [self.text_value(value, is_binary) for value, is_binary in
+                 izip(self.get_values(row), binary_cols)]))
+            stream.write(b'\n')
+        stream.seek(0)
+        return stream
+
+    def get_binary_stream(self, rows):
+        """
+        Поток пакета строк в бинарном формате COPY
+        """
+        packers = [self.binary_packers[t] for t in self.col_types]
+        row_header = struct.pack('>h', self.cols_nums)
+        null = struct.pack('>i', -1)
+
+        stream = StringIO()
+        stream.write(self.binary_header)
+        for row in rows:
+            stream.write(row_header)
+            for value, packer in izip(self.get_values(row), packers):
+                if value is None:
+                    stream.write(null)
+                else:
+                    data = packer(self, value)
+                    stream.write(struct.pack('>i', len(data)))
+                    stream.write(data)
+        stream.write(self.binary_trailer)
+        stream.seek(0)
+        return stream
+
+    # упаковка значений в бинарный формат по типу колонки хранилища
+    binary_packers = {
+        'integer': lambda self, v: struct.pack('>i', int(v)),
+        'bigint': lambda self, v: struct.pack('>q', int(v)),
+        'double precision': lambda self, v: struct.pack('>d', float(v)),
+        'text': lambda self, v: (
+            v.encode('utf-8') if isinstance(v, unicode) else str(v)),
+        'bytea': lambda self, v: self.to_bytes(v),
+        'timestamp': lambda self, v: struct.pack('>q', self.to_timestamp(v)),
+    }
 
     def execute(self, **kwargs):
+        """
+        Args:
+            data(list): Строки пакета
+            binary_types_dict(dict): Признаки бинарных колонок по номеру
+            commit(bool): Фиксировать транзакцию, по умолчанию да
+        """
+        binary_types_dict = kwargs.get('binary_types_dict') or {}
+
+        if self.copy_format == self.BINARY:
+            stream = self.get_binary_stream(kwargs['data'])
+        else:
+            binary_cols = [binary_types_dict.get(str(i), False)
+                           for i in xrange(self.cols_nums)]
+            stream = self.get_text_stream(kwargs['data'], binary_cols)
+
         self.cursor = self.connection.cursor()
-        [str(a) for a in kwargs['keys']]
-        self.query = self.query.format(
-            "','".join([str(a) for a in kwargs['keys']]))
-        self.cursor.execute(self.query)
+        self.cursor.copy_expert(self.query, stream)
+        if kwargs.get('commit', True):
+            self.connection.commit()
+        return
+
+
+class MergeQuery(CopyQuery):
+    """
+    Вставка с обновлением существующих строк по cdc_key.
+    Пакет загружается через COPY во временную таблицу и переносится
+    в таблицу одним INSERT ... ON CONFLICT, на серверах до 9.5 -
+    UPDATE существующих и INSERT новых строк
+    """
+    # версия Postgresql с INSERT ... ON CONFLICT
+    upsert_version = 90500
+
+    def set_query(self, **kwargs):
+        """
+        Args:
+            table_name(str): Название таблицы
+            col_names(list): Названия колонок, первая - cdc_key
+            col_types(list): Типы колонок таблицы
+            copy_format(str): Формат COPY
+        """
+        table_name = kwargs['table_name']
+        merge_table = 'etl_merge_{0}'.format(table_name)
+        col_names = kwargs['col_names']
+
+        kwargs.update(table_name=merge_table, cols_nums=len(col_names))
+        super(MergeQuery, self).set_query(**kwargs)
+
+        # строки временной таблицы удаляются при каждой фиксации
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS {0} "
+            "(LIKE {1} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS".format(
+                merge_table, table_name))
+        self.connection.commit()
+
+        # повторы ключа в пакете не допускаются ни одним из способов
+        source = "(SELECT DISTINCT ON (cdc_key) * FROM {0}) s".format(
+            merge_table)
+        update_cols = ['"{0}"'.format(x) for x in col_names if x != 'cdc_key']
+        if self.connection.server_version >= self.upsert_version:
+            self.merge_queries = [
+                "INSERT INTO {0} SELECT s.* FROM {1} "
+                "ON CONFLICT (cdc_key) DO UPDATE SET {2}".format(
+                    table_name, source, ', '.join(
+                        ['{0} = EXCLUDED.{0}'.format(x) for x in update_cols]))]
+        else:
+            self.merge_queries = [
+                "UPDATE {0} t SET {2} FROM {1} "
+                "WHERE t.cdc_key = s.cdc_key".format(
+                    table_name, source, ', '.join(
+                        ['{0} = s.{0}'.format(x) for x in update_cols])),
+                "INSERT INTO {0} SELECT s.* FROM {1} WHERE NOT EXISTS "
+                "(SELECT 1 FROM {0} t WHERE t.cdc_key = s.cdc_key)".format(
+                    table_name, source),
+            ]
+
+    def execute(self, **kwargs):
+        """
+        Args:
+            data(list): Строки пакета
+            binary_types_dict(dict): Признаки бинарных колонок по номеру
+        """
+        kwargs['commit'] = False
+        super(MergeQuery, self).execute(**kwargs)
+        for query in self.merge_queries:
+            self.cursor.execute(query)
         self.connection.commit()
         return
 
 
+class CdcApplyQuery(CopyQuery):
+    """
+    Применение изменений источника к таблице хранилища: строки измененных
+    и удаленных записей удаляются по первичному ключу источника,
+    новые значения вставляются через COPY. Строки размерностей и мер
+    удаляются по cdc_key и вставляются из таблицы хранилища,
+    все одной транзакцией
+    """
+    cube_tables = []
+    legacy_tables = []
+
+    def set_query(self, **kwargs):
+        """
+        Args:
+            table_name(str): Название таблицы
+            cols_nums(int): Число колонок
+            col_types(list): Типы колонок таблицы
+            key_cols(list): Колонки первичного ключа источника в таблице
+            cube_tables(dict): Колонки таблиц размерностей и мер
+                {<таблица>: [<колонки>], ...}, несуществующие таблицы
+                и таблицы без cdc_key (`legacy_tables`) пропускаются
+        """
+        super(CdcApplyQuery, self).set_query(**kwargs)
+        table_name = kwargs['table_name']
+        self.delete_query = (
+            'DELETE FROM {0} WHERE ({1}) IN %s RETURNING cdc_key'.format(
+                table_name,
+                ', '.join(['"{0}"'.format(x) for x in kwargs['key_cols']])))
+
+        cube_tables = kwargs.get('cube_tables') or {}
+        self.cube_tables, self.legacy_tables = [], []
+        if cube_tables:
+            self.cube_tables, self.legacy_tables = split_cdc_key_tables(
+                self.connection.cursor(), list(cube_tables))
+        self.cube_queries = []
+        for cube_table in self.cube_tables:
+            columns = ', '.join(
+                ['"{0}"'.format(x) for x in cube_tables[cube_table]])
+            self.cube_queries.append((
+                'DELETE FROM {0} WHERE cdc_key IN %s'.format(cube_table),
+                'INSERT INTO {0} ({1}) SELECT {1} FROM {2} '
+                'WHERE cdc_key IN %s'.format(cube_table, columns, table_name)))
+
+    def execute(self, **kwargs):
+        """
+        Args:
+            keys(list): Значения первичного ключа измененных записей
+            data(list): Новые строки, первое значение - cdc_key
+            binary_types_dict(dict): Признаки бинарных колонок по номеру
+
+        Returns:
+            list: cdc_key удаленных строк
+        """
+        cursor = self.connection.cursor()
+        removed = []
+        if kwargs['keys']:
+            cursor.execute(self.delete_query, (tuple(kwargs['keys']), ))
+            removed = [x[0] for x in cursor.fetchall()]
+        if removed:
+            for delete_query, insert_query in self.cube_queries:
+                cursor.execute(delete_query, (tuple(removed), ))
+        if kwargs['data']:
+            super(CdcApplyQuery, self).execute(
+                data=kwargs['data'],
+                binary_types_dict=kwargs.get('binary_types_dict'),
+                commit=False)
+            added = tuple(x[0] for x in kwargs['data'])
+            for delete_query, insert_query in self.cube_queries:
+                cursor.execute(insert_query, (added, ))
+        self.connection.commit()
+        return removed
+
+
+def collapse_changes(rows, key_indexes):
+    """
+    Свертка изменений по ключу записи: остается последняя операция
+
+    Args:
+        rows(list): Строки таблицы изменений, последнее значение - операция
+        key_indexes(list): Номера колонок первичного ключа
+
+    Returns:
+        OrderedDict: {<ключ>: (<операция>, <значения>), ...}
+    """
+    changes = OrderedDict()
+    for row in rows:
+        values = row[:-1]
+        key = tuple(values[ind] for ind in key_indexes)
+        changes.pop(key, None)
+        changes[key] = (row[-1], values)
+    return changes
+
+
+class DeleteQuery(TableCreateQuery):
+    """
+    Удаление строк таблиц хранилища по ключам cdc_key.
+    Ключи загружаются через COPY во временную таблицу, строки удаляются
+    одним DELETE ... USING на таблицу и одной фиксацией
+    """
+    keys_table = 'etl_deleted_keys'
+    legacy_tables = []
+
+    def set_query(self, **kwargs):
+        """
+        Args:
+            table_names(list): Таблицы, из которых удаляются строки,
+                несуществующие таблицы и таблицы без cdc_key
+                (`legacy_tables`) пропускаются
+        """
+        self.set_connection()
+        self.cursor = self.connection.cursor()
+
+        self.table_names, self.legacy_tables = split_cdc_key_tables(
+            self.cursor, kwargs['table_names'])
+
+        # временная таблица удаляется вместе с фиксацией удаления
+        self.cursor.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS {0} (cdc_key text) "
+            "ON COMMIT DROP".format(self.keys_table))
+        self.query = (
+            "DELETE FROM {0} t USING {1} k WHERE t.cdc_key = k.cdc_key")
+
+    def add_keys(self, keys):
+        """
+        Загрузка пакета удаляемых ключей во временную таблицу
+
+        Args:
+            keys(list): Ключи строк
+        """
+        stream = StringIO(''.join(['%s\n' % key for key in keys]))
+        self.cursor.copy_expert(
+            "COPY {0} (cdc_key) FROM STDIN".format(self.keys_table), stream)
+
+    def execute(self, **kwargs):
+        """
+        Удаление строк по загруженным ключам
+
+        Returns:
+            dict: Число удаленных строк по таблицам
+        """
+        self.cursor.execute("ANALYZE {0}".format(self.keys_table))
+        deleted = {}
+        for table_name in self.table_names:
+            self.cursor.execute(
+                self.query.format(table_name, self.keys_table))
+            deleted[table_name] = self.cursor.rowcount
+        self.connection.commit()
+        return deleted
+
+
 class MongodbConnection(object):
+    """
+    Работа с коллекциями Mongodb через общий клиент процесса
+
+    Attributes:
+        durability(str): Профиль надежности записи коллекций
+            из settings.ETL_STAGING_DURABILITY_PROFILES, None - write concern
+            клиента
+    """
+    registry = MongoClientRegistry(
+        pymongo.MongoClient,
+        maxPoolSize=settings.ETL_MONGO_POOL_SIZE,
+        readPreference=settings.ETL_MONGO_READ_PREFERENCE,
+        **settings.ETL_MONGO_WRITE_CONCERN)
 
-    def __init__(self):
+    # коллекция схем компактных документов
+    schemas_name = 'sttm_schemas'
+
+    def __init__(self, durability=None):
         self.collection = None
+        self.durability = durability
+
+    @classmethod
+    def get_client(cls):
+        """
+        Клиент Mongodb из реестра процесса
+
+        Returns:
+            `MongoClient`: Клиент
+        """
+        return cls.registry.get_client(settings.MONGO_HOST, settings.MONGO_PORT)
 
     def get_collection(self, db_name, collection_name):
         """
@@ -444,20 +1687,44 @@ class MongodbConnection(object):
             db_name(str): Название базы
             collection_name(str): Название коллекции
         """
-        connection = pymongo.MongoClient(
-            settings.MONGO_HOST, settings.MONGO_PORT)
         # database name
-        db = connection[db_name]
+        db = self.get_client()[db_name]
         self.collection = db[collection_name]
+        if self.durability:
+            self.collection = self.collection.with_options(
+                write_concern=WriteConcern(
+                    **settings.ETL_STAGING_DURABILITY_PROFILES[
+                        self.durability]))
         return self.collection
 
-    @staticmethod
-    def drop(db_name, collection_name):
-        connection = pymongo.MongoClient(
-            settings.MONGO_HOST, settings.MONGO_PORT)
+    @classmethod
+    def drop(cls, db_name, collection_name):
         # database name
-        db = connection[db_name]
+        db = cls.get_client()[db_name]
         db.drop_collection(collection_name)
+        db[cls.schemas_name].delete_one({'_id': collection_name})
+
+    def set_schema(self, fields):
+        """
+        Сохранение схемы компактных документов коллекции
+
+        Args:
+            fields(list): Названия колонок массива значений
+        """
+        self.collection.database[self.schemas_name].replace_one(
+            {'_id': self.collection.name},
+            {'_id': self.collection.name, 'fields': fields}, upsert=True)
+
+    def get_schema(self):
+        """
+        Схема компактных документов коллекции
+
+        Returns:
+            list: Названия колонок массива значений, None, если схемы нет
+        """
+        schema = self.collection.database[self.schemas_name].find_one(
+            {'_id': self.collection.name})
+        return schema['fields'] if schema else None
 
     def set_indexes(self, index_list):
         """
@@ -0,0 +1,203 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import os
+import glob
+import threading
+
+import numpy
+from django.conf import settings
+
+from core.exceptions import TaskError
+
+
+class KeysSnapshot(object):
+    """
+    Снимок ключей строк источника на момент загрузки.
+    Ключи хранятся в локальном файле отсортированным массивом int64
+    и читаются через memory map, сравнение снимков выполняется numpy
+
+    Файлы снимка в каталоге `ETL_KEYS_SNAPSHOT_DIR/<checksum>`, каталог
+    общий для всех celery-воркеров:
+        <run>.<part>.part - ключи, записанные частью загрузки
+        <run>.keys - собранный снимок загрузки
+        <run>.synced - снимок, по которому выявлены удаленные строки,
+            соответствует строкам промежуточной коллекции
+
+    Attributes:
+        key(str): Ключ (checksum) набора данных
+        run(int): Номер загрузки
+    """
+    dtype = numpy.int64
+    PART, FINISHED, SYNCED = ('part', 'keys', 'synced')
+
+    def __init__(self, key, run):
+        """
+        Args:
+            key(str): Ключ (checksum) набора данных
+            run(int): Номер загрузки
+        """
+        self.key = key
+        self.run = int(run)
+
+    @staticmethod
+    def get_dir(key):
+        return os.path.join(settings.ETL_KEYS_SNAPSHOT_DIR, key)
+
+    def get_path(self, state, part=None):
+        """
+        Путь к файлу снимка
+
+        Args:
+            state(str): Состояние снимка
+            part(int): Номер части для несобранного снимка
+        """
+        name = '{0}.{1}'.format(self.run, state) if part is None else \
+            '{0}.{1}.{2}'.format(self.run, part, state)
+        return os.path.join(self.get_dir(self.key), name)
+
+    @classmethod
+    def get_synced(cls, key):
+        """
+        Последний синхронизированный снимок набора данных
+
+        Returns:
+            `KeysSnapshot`: Снимок или None, если его нет
+        """
+        runs = [int(os.path.basename(path).split('.')[0]) for path in
+                glob.glob(os.path.join(cls.get_dir(key), '*.' + cls.SYNCED))]
+        return cls(key, max(runs)) if runs else None
+
+    def get_writer(self, part):
+        """
+        Запись ключей части загрузки
+
+        Args:
+            part(int): Номер части
+
+        Returns:
+            `KeysSnapshotWriter`
+        """
+        path = self.get_path(self.PART, part)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # каталог создан параллельной частью
+                if not os.path.isdir(directory):
+                    raise
+        return KeysSnapshotWriter(path)
+
+    def finish(self, parts_count=1):
+        """
+        Сборка снимка из записанных частей: ключи сортируются,
+        повторы удаляются, части удаляются.
+        Снимок без части ключей отметил бы загруженные строки удаленными,
+        поэтому число частей проверяется
+
+        Args:
+            parts_count(int): Число частей загрузки
+
+        Raises:
+            TaskError: Найдены не все части, каталог снимков
+                не общий для воркеров
+        """
+        parts = glob.glob(self.get_path(self.PART, '*'))
+        if len(parts) != parts_count:
+            raise TaskError(
+                'Найдено {0} из {1} частей снимка ключей в {2}, каталог '
+                'ETL_KEYS_SNAPSHOT_DIR должен быть общим для воркеров'.format(
+                    len(parts), parts_count, self.get_dir(self.key)))
+        keys = numpy.unique(numpy.concatenate(
+            [numpy.fromfile(path, dtype=self.dtype) for path in parts] or
+            [numpy.empty(0, dtype=self.dtype)]))
+
+        path = self.get_path(self.FINISHED)
+        tmp_path = path + '.tmp'
+        keys.tofile(tmp_path)
+        os.rename(tmp_path, path)
+        for part_path in parts:
+            os.remove(part_path)
+
+    def load(self, state=FINISHED):
+        """
+        Ключи снимка
+
+        Returns:
+            numpy.ndarray: Отсортированные ключи (memory map файла)
+        """
+        path = self.get_path(state)
+        if not os.path.getsize(path):
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.memmap(path, dtype=self.dtype, mode='r')
+
+    def sync(self):
+        """
+        Отметка снимка синхронизированным с промежуточной коллекцией,
+        снимки предыдущих загрузок удаляются
+        """
+        os.rename(self.get_path(self.FINISHED), self.get_path(self.SYNCED))
+        for path in glob.glob(os.path.join(self.get_dir(self.key), '*')):
+            if int(os.path.basename(path).split('.')[0]) < self.run:
+                os.remove(path)
+
+    @staticmethod
+    def contains(snapshot_keys, keys):
+        """
+        Наличие ключей в снимке
+
+        Args:
+            snapshot_keys(numpy.ndarray): Отсортированные ключи снимка
+            keys(list): Проверяемые ключи
+
+        Returns:
+            numpy.ndarray: Маска наличия ключей
+        """
+        keys = numpy.asarray(keys, dtype=KeysSnapshot.dtype)
+        if not len(snapshot_keys):
+            return numpy.zeros(len(keys), dtype=bool)
+        indexes = numpy.searchsorted(snapshot_keys, keys)
+        indexes[indexes == len(snapshot_keys)] = 0
+        return snapshot_keys[indexes] == keys
+
+    @staticmethod
+    def difference(keys, other_keys):
+        """
+        Ключи, отсутствующие в другом снимке
+
+        Returns:
+            numpy.ndarray: Отсортированные ключи
+        """
+        return numpy.setdiff1d(keys, other_keys, assume_unique=True)
+
+    @classmethod
+    def delete(cls, key):
+        """
+        Удаление всех снимков набора данных
+        """
+        for path in glob.glob(os.path.join(cls.get_dir(key), '*')):
+            os.remove(path)
+
+
+class KeysSnapshotWriter(object):
+    """
+    Дозапись ключей части загрузки в файл,
+    писатели конвейера загрузки пишут из разных потоков
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def write(self, keys):
+        """
+        Args:
+            keys(list): Ключи пакета
+        """
+        data = numpy.asarray(keys, dtype=KeysSnapshot.dtype)
+        with self._lock:
+            data.tofile(self.file)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,729 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import os
+import glob
+import json
+import mmap
+import time
+import heapq
+import shutil
+import fcntl
+import threading
+import cPickle
+from itertools import count, izip, islice
+
+import numpy
+from django.conf import settings
+
+from etl.constants import STTM_DATASOURCE, STTM_DATASOURCE_DELTA, \
+    STTM_DATASOURCE_KEYSALL
+from etl.services.queue.base import MongodbConnection, insert_documents
+
+ASCENDING = 1
+
+# индексы промежуточных коллекций, которые читают следующие задачи,
+# ключ _id индексируется всегда. Поле _date ни одна задача не читает,
+# индекс по нему не строится
+STAGING_INDEXES = {
+    # LoadDb: документы IDLE и перевод в LOADED,
+    # DetectRedundant: ключи LOADED
+    STTM_DATASOURCE: [('_state', ASCENDING)],
+    # UpdateMongodb: документы NEW и перевод в SYNCED
+    STTM_DATASOURCE_DELTA: [('_state', ASCENDING)],
+    # DeleteRedundant: ключи удаленных строк
+    STTM_DATASOURCE_KEYSALL: [('_state', ASCENDING)],
+}
+
+
+class StagingStore(object):
+    """
+    Промежуточное хранилище документов загрузки.
+    Документ - словарь с ключом строки '_id' (int64) и статусом '_state'
+
+    Attributes:
+        name(str): Название коллекции
+    """
+
+    def __init__(self, name, durability=None):
+        """
+        Args:
+            name(str): Название коллекции
+            durability(str): Профиль надежности записи
+        """
+        self.name = name
+        self.durability = durability
+
+    def create(self, indexes=None, schema=None):
+        """
+        Создание коллекции. Повторный вызов достраивает
+        недостающие индексы
+
+        Args:
+            indexes(list): Индексы полей [('_state', ASCENDING), ...]
+            schema(list): Схема компактных документов
+        """
+        raise NotImplementedError
+
+    def get_schema(self):
+        """
+        Схема компактных документов, None, если схемы нет
+        """
+        raise NotImplementedError
+
+    def set_schema(self, fields):
+        """
+        Сохранение схемы компактных документов
+        """
+        raise NotImplementedError
+
+    def append(self, documents):
+        """
+        Добавление документов, документы с существующим ключом пропускаются
+
+        Returns:
+            int: Число пропущенных документов
+        """
+        raise NotImplementedError
+
+    def set_state(self, state, from_state=None, key_range=None):
+        """
+        Смена статуса документов
+
+        Args:
+            state(str): Новый статус
+            from_state(str): Статус изменяемых документов, None - любой
+            key_range(tuple): Диапазон ключей (first, last) включительно
+
+        Returns:
+            int: Число измененных документов
+        """
+        raise NotImplementedError
+
+    def find_existing(self, keys):
+        """
+        Существующие ключи из переданных
+
+        Returns:
+            set: Ключи
+        """
+        raise NotImplementedError
+
+    def iter_keys(self, state=None):
+        """
+        Ключи документов
+
+        Args:
+            state(str): Статус документов, None - любой
+
+        Returns:
+            iterator: Ключи
+        """
+        raise NotImplementedError
+
+    def scan(self, state=None, fields=None, batch_size=None):
+        """
+        Документы по возрастанию ключа
+
+        Args:
+            state(str): Статус документов, None - любой
+            fields(dict): Нужные поля документа, None - все
+            batch_size(int): Размер порции чтения
+
+        Returns:
+            iterator: Документы
+        """
+        raise NotImplementedError
+
+    def count(self, state=None):
+        """
+        Число документов
+        """
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """
+        Удаление документов по ключам
+        """
+        raise NotImplementedError
+
+    def drop(self):
+        """
+        Удаление коллекции
+        """
+        raise NotImplementedError
+
+
+class MongoStagingStore(StagingStore):
+    """
+    Промежуточное хранилище в коллекции Mongodb
+    """
+
+    def __init__(self, name, durability=None):
+        super(MongoStagingStore, self).__init__(name, durability)
+        self.connection = MongodbConnection(durability)
+        self.collection = self.connection.get_collection('etl', name)
+
+    @staticmethod
+    def get_query(state=None):
+        return {} if state is None else {'_state': state}
+
+    def create(self, indexes=None, schema=None):
+        if indexes:
+            self.connection.set_indexes(indexes)
+        if schema:
+            self.set_schema(schema)
+
+    def get_schema(self):
+        return self.connection.get_schema()
+
+    def set_schema(self, fields):
+        self.connection.set_schema(fields)
+
+    def append(self, documents):
+        if not documents:
+            return 0
+        return insert_documents(self.collection, documents)
+
+    def set_state(self, state, from_state=None, key_range=None):
+        query = self.get_query(from_state)
+        if key_range is not None:
+            query['_id'] = {'$gte': key_range[0], '$lte': key_range[1]}
+        return self.collection.update_many(
+            query, {'$set': {'_state': state}}).modified_count
+
+    def find_existing(self, keys):
+        if not keys:
+            return set()
+        return set(record['_id'] for record in self.collection.find(
+            {'_id': {'$in': keys}}, {'_id': 1}))
+
+    def iter_keys(self, state=None):
+        return (record['_id'] for record in self.collection.find(
+            self.get_query(state), {'_id': 1}))
+
+    def scan(self, state=None, fields=None, batch_size=None):
+        # индекс _id отдает документы в порядке сортировки
+        # без сортировки в памяти
+        cursor = self.collection.find(self.get_query(state), fields).sort(
+            '_id', ASCENDING).hint([('_id', ASCENDING)])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        try:
+            for document in cursor:
+                yield document
+        finally:
+            cursor.close()
+
+    def count(self, state=None):
+        return self.collection.count(self.get_query(state))
+
+    def delete(self, keys):
+        if keys:
+            self.collection.delete_many({'_id': {'$in': keys}})
+
+    def drop(self):
+        MongodbConnection.drop('etl', self.name)
+
+
+class SegmentStagingStore(StagingStore):
+    """
+    Промежуточное хранилище в файлах на локальном диске для установок
+    без Mongodb.
+
+    Документы (pickle) дописываются в текущий сегмент <номер>.seg,
+    пока его размер меньше settings.ETL_STAGING_SEGMENT_SIZE.
+    Индекс ключей один на коллекцию и хранится отсортированными частями:
+        <часть>.idx - ключ, сегмент, смещение и размер документа
+        <часть>.state - статусы документов по порядку части
+    Каждая запись добавляет часть, меньшая часть сливается с соседней,
+    пока она не вдвое меньше ее, поэтому частей не больше log2 числа
+    записей. После загрузки (`create` с индексами) части сливаются в одну.
+    Удаленные документы отмечаются статусом REMOVED, при доле удаленных
+    больше compact_ratio сегменты и индекс переписываются (`compact`).
+
+    Сегменты и части открываются через memory map при первом чтении.
+    Запись и смена статусов выполняются под исключительной файловой
+    блокировкой каталога коллекции, чтение - под разделяемой: запись
+    другого процесса сливает и удаляет части индекса
+    """
+    index_dtype = numpy.dtype(
+        [(str('key'), numpy.int64), (str('segment'), numpy.int64),
+         (str('offset'), numpy.int64), (str('size'), numpy.int64)])
+    # коды статусов документов, 0 - без статуса
+    states = [None, 'idle', 'loaded', 'new', 'synced', 'deleted']
+    REMOVED = 255
+    # доля удаленных документов, после которой коллекция переписывается
+    compact_ratio = 0.5
+    # документов в пакете записи при переписывании коллекции
+    compact_batch = 10000
+
+    _lock = threading.Lock()
+    _numbers = count()
+
+    def __init__(self, name, durability=None):
+        super(SegmentStagingStore, self).__init__(name, durability)
+        self.path = os.path.join(settings.ETL_STAGING_DIR, name)
+        self._runs = {}
+        self._segments = {}
+
+    def get_code(self, state):
+        return self.states.index(state)
+
+    def create(self, indexes=None, schema=None):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # каталог создан параллельной задачей
+                if not os.path.isdir(self.path):
+                    raise
+        if schema:
+            self.set_schema(schema)
+        # индексы полей не нужны, индекс ключей сливается в одну часть
+        if indexes:
+            with self.locked():
+                self.merge_runs(full=True)
+
+    def get_schema(self):
+        path = os.path.join(self.path, 'schema.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as schema_file:
+            return json.load(schema_file)
+
+    def set_schema(self, fields):
+        self.create()
+        path = os.path.join(self.path, 'schema.json')
+        with open(path + '.tmp', 'w') as schema_file:
+            json.dump(fields, schema_file)
+        os.rename(path + '.tmp', path)
+
+    def locked(self, shared=False):
+        """
+        Блокировка коллекции между потоками и процессами
+
+        Args:
+            shared(bool): Разделяемая блокировка для чтения
+        """
+        return StoreLock(self.path, self._lock, shared)
+
+    def get_runs(self):
+        """
+        Части индекса ключей коллекции
+
+        Returns:
+            list: `KeysRun` по убыванию размера
+        """
+        # после удаления коллекции список пуст, открытые части закрываются
+        names = [path[:-len('.idx')] for path in
+                 glob.glob(os.path.join(self.path, '*.idx'))]
+        for name in set(self._runs) - set(names):
+            self._runs.pop(name).close()
+        for name in names:
+            if name not in self._runs:
+                self._runs[name] = KeysRun(name, self.index_dtype)
+        return sorted([self._runs[name] for name in names],
+                      key=lambda x: (-x.size, x.name))
+
+    def get_segment(self, number):
+        """
+        Сегмент документов по номеру
+        """
+        segment = self._segments.get(number)
+        if segment is None:
+            segment = self._segments[number] = Segment(
+                os.path.join(self.path, '{0}.seg'.format(number)))
+        return segment
+
+    def get_segment_numbers(self):
+        return sorted(int(os.path.basename(path)[:-len('.seg')]) for path in
+                      glob.glob(os.path.join(self.path, '*.seg')))
+
+    def get_current_segment(self, first=0):
+        """
+        Номер сегмента для записи: последний, пока он меньше
+        settings.ETL_STAGING_SEGMENT_SIZE
+
+        Args:
+            first(int): Наименьший номер сегмента
+        """
+        numbers = [x for x in self.get_segment_numbers() if x >= first]
+        if not numbers:
+            return first
+        path = os.path.join(self.path, '{0}.seg'.format(numbers[-1]))
+        if os.path.getsize(path) < settings.ETL_STAGING_SEGMENT_SIZE:
+            return numbers[-1]
+        return numbers[-1] + 1
+
+    def append(self, documents):
+        if not documents:
+            return 0
+        self.create()
+        with self.locked():
+            existing = self._find_existing([x['_id'] for x in documents])
+            unique = {}
+            for document in documents:
+                key = document['_id']
+                if key not in existing and key not in unique:
+                    unique[key] = document
+            if unique:
+                index, states = self.write_documents(
+                    [unique[key] for key in sorted(unique)])
+                self.write_run(index, states)
+                self.merge_runs()
+        return len(documents) - len(unique)
+
+    def write_documents(self, documents, first_segment=0):
+        """
+        Дозапись документов в текущий сегмент
+
+        Args:
+            documents(list): Документы по возрастанию ключа
+            first_segment(int): Наименьший номер сегмента для записи
+
+        Returns:
+            tuple: Записи индекса и коды статусов документов
+        """
+        number = self.get_current_segment(first_segment)
+        index = numpy.zeros(len(documents), dtype=self.index_dtype)
+        states = numpy.zeros(len(documents), dtype=numpy.uint8)
+
+        path = os.path.join(self.path, '{0}.seg'.format(number))
+        with open(path, 'ab') as data_file:
+            offset = data_file.tell()
+            for pos, document in enumerate(documents):
+                document = dict(document)
+                states[pos] = self.get_code(document.pop('_state', None))
+                data = cPickle.dumps(document, cPickle.HIGHEST_PROTOCOL)
+                data_file.write(data)
+                index[pos] = (document['_id'], number, offset, len(data))
+                offset += len(data)
+        return index, states
+
+    def write_run(self, index, states):
+        """
+        Запись части индекса, часть видна после записи файла индекса
+        """
+        name = os.path.join(self.path, '{0}-{1}-{2}'.format(
+            int(time.time() * 10 ** 6), os.getpid(), next(self._numbers)))
+        states.tofile(name + '.state')
+        index.tofile(name + '.idx.tmp')
+        os.rename(name + '.idx.tmp', name + '.idx')
+
+    def merge_runs(self, full=False):
+        """
+        Слияние частей индекса, удаленные документы в часть не попадают
+
+        Args:
+            full(bool): Слить все части в одну
+        """
+        runs = self.get_runs()
+        while len(runs) > 1 and (full or runs[-1].size * 2 > runs[-2].size):
+            merged = runs[-2:]
+            index = numpy.concatenate([x.index for x in merged])
+            states = numpy.concatenate([x.states for x in merged])
+            live = numpy.flatnonzero(states != self.REMOVED)
+            order = live[numpy.argsort(index['key'][live], kind='mergesort')]
+            if len(order):
+                self.write_run(index[order], states[order])
+            for run in merged:
+                del self._runs[run.name]
+                run.remove()
+            runs = self.get_runs()
+
+    def get_mask(self, run, state=None):
+        """
+        Маска живых документов части с указанным статусом
+        """
+        if state is None:
+            return run.states != self.REMOVED
+        return run.states == self.get_code(state)
+
+    def set_state(self, state, from_state=None, key_range=None):
+        changed = 0
+        with self.locked():
+            for run in self.get_runs():
+                start, end = 0, run.size
+                if key_range is not None:
+                    start = numpy.searchsorted(run.keys, key_range[0])
+                    end = numpy.searchsorted(
+                        run.keys, key_range[1], side='right')
+                mask = self.get_mask(run, from_state)[start:end]
+                changed += int(mask.sum())
+                if mask.any():
+                    run.states[start:end][mask] = self.get_code(state)
+                    run.states.flush()
+        return changed
+
+    def lookup(self, run, keys):
+        """
+        Позиции ключей в части индекса
+
+        Returns:
+            tuple: Маска найденных живых ключей и их позиции
+        """
+        positions = numpy.searchsorted(run.keys, keys)
+        positions[positions == run.size] = 0
+        found = ((run.keys[positions] == keys) &
+                 (run.states[positions] != self.REMOVED))
+        return found, positions
+
+    def find_existing(self, keys):
+        with self.locked(shared=True):
+            return self._find_existing(keys)
+
+    def _find_existing(self, keys):
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        existing = set()
+        for run in self.get_runs():
+            found, positions = self.lookup(run, keys)
+            existing.update(keys[found].tolist())
+        return existing
+
+    def iter_keys(self, state=None):
+        # ключи копируются под блокировкой, блокировка не держится
+        # на время обхода: вызывающий может удалять документы коллекции
+        with self.locked(shared=True):
+            keys = [run.keys[self.get_mask(run, state)]
+                    for run in self.get_runs()]
+        for run_keys in keys:
+            for key in run_keys.tolist():
+                yield key
+
+    def iter_positions(self, run, state=None):
+        """
+        Ключи и позиции документов части по возрастанию ключа
+        """
+        positions = numpy.flatnonzero(self.get_mask(run, state))
+        for key, pos in izip(run.keys[positions].tolist(),
+                             positions.tolist()):
+            yield key, pos, run
+
+    def scan(self, state=None, fields=None, batch_size=None):
+        # блокировка держится до конца обхода или закрытия итератора
+        with self.locked(shared=True):
+            for document in self._scan(state):
+                yield document
+
+    def _scan(self, state=None):
+        # части индекса отсортированы, сливаем их в общий порядок
+        streams = [self.iter_positions(run, state) for run in self.get_runs()]
+        for key, pos, run in heapq.merge(*streams):
+            record = run.index[pos]
+            document = self.get_segment(int(record['segment'])).read(
+                int(record['offset']), int(record['size']))
+            document['_state'] = self.states[run.states[pos]]
+            yield document
+
+    def count(self, state=None):
+        with self.locked(shared=True):
+            return sum(int(self.get_mask(run, state).sum())
+                       for run in self.get_runs())
+
+    def delete(self, keys):
+        if not keys:
+            return
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        with self.locked():
+            removed = total = 0
+            for run in self.get_runs():
+                found, positions = self.lookup(run, keys)
+                if found.any():
+                    run.states[positions[found]] = self.REMOVED
+                    run.states.flush()
+                removed += int((run.states == self.REMOVED).sum())
+                total += run.size
+            if removed > total * self.compact_ratio:
+                self._compact()
+
+    def compact(self):
+        """
+        Переписывание живых документов в новые сегменты по возрастанию
+        ключа с индексом из одной части, прежние сегменты удаляются
+        """
+        with self.locked():
+            self._compact()
+
+    def _compact(self):
+        runs = self.get_runs()
+        numbers = self.get_segment_numbers()
+        first = numbers[-1] + 1 if numbers else 0
+
+        index_name = os.path.join(self.path, 'compact')
+        documents = self._scan()
+        with open(index_name + '.idx.tmp', 'wb') as index_file, \
+                open(index_name + '.state.tmp', 'wb') as states_file:
+            while True:
+                batch = list(islice(documents, self.compact_batch))
+                if not batch:
+                    break
+                index, states = self.write_documents(batch, first)
+                index.tofile(index_file)
+                states.tofile(states_file)
+
+        for run in runs:
+            del self._runs[run.name]
+            run.remove()
+        for number in numbers:
+            segment = self._segments.pop(number, None)
+            if segment is not None:
+                segment.close()
+            os.remove(os.path.join(self.path, '{0}.seg'.format(number)))
+
+        if os.path.getsize(index_name + '.idx.tmp'):
+            index = numpy.fromfile(index_name + '.idx.tmp',
+                                   dtype=self.index_dtype)
+            states = numpy.fromfile(index_name + '.state.tmp',
+                                    dtype=numpy.uint8)
+            self.write_run(index, states)
+        os.remove(index_name + '.idx.tmp')
+        os.remove(index_name + '.state.tmp')
+
+    def drop(self):
+        for run in self._runs.values():
+            run.close()
+        for segment in self._segments.values():
+            segment.close()
+        self._runs = {}
+        self._segments = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class KeysRun(object):
+    """
+    Отсортированная часть индекса ключей файлового хранилища,
+    открывается через memory map при первом обращении
+
+    Attributes:
+        name(str): Путь к файлам части без расширения
+        size(int): Число записей
+    """
+
+    def __init__(self, name, index_dtype):
+        self.name = name
+        self.index_dtype = index_dtype
+        self.size = os.path.getsize(name + '.idx') // index_dtype.itemsize
+        self._index = None
+        self._states = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = numpy.memmap(self.name + '.idx',
+                                       dtype=self.index_dtype, mode='r')
+        return self._index
+
+    @property
+    def keys(self):
+        return self.index['key']
+
+    @property
+    def states(self):
+        """
+        Коды статусов документов, изменяемые на месте
+        """
+        if self._states is None:
+            self._states = numpy.memmap(self.name + '.state',
+                                        dtype=numpy.uint8, mode='r+')
+        return self._states
+
+    def close(self):
+        self._index = self._states = None
+
+    def remove(self):
+        self.close()
+        os.remove(self.name + '.idx')
+        os.remove(self.name + '.state')
+
+
+class Segment(object):
+    """
+    Сегмент документов файлового хранилища, открывается через memory map
+    при первом чтении и переоткрывается, если документ дописан позже
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_file = None
+        self.data = None
+
+    def read(self, offset, size):
+        """
+        Документ по смещению в сегменте
+        """
+        if self.data is None or offset + size > len(self.data):
+            self.close()
+            self.data_file = open(self.path, 'rb')
+            self.data = mmap.mmap(
+                self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cPickle.loads(self.data[offset:offset + size])
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data_file.close()
+        self.data_file = self.data = None
+
+
+class StoreLock(object):
+    """
+    Блокировка каталога коллекции: при записи потоки процесса ждут общую
+    блокировку, процессы - исключительную файловую блокировку.
+    Читатели берут только разделяемую файловую блокировку, она открывается
+    отдельным файлом и поэтому исключает запись и других потоков процесса
+    """
+
+    def __init__(self, path, lock, shared=False):
+        self.dir_path = path
+        self.path = os.path.join(path, '.lock')
+        self.lock = lock
+        self.shared = shared
+        self.lock_file = None
+
+    def __enter__(self):
+        if self.shared:
+            # коллекции нет - читать нечего
+            if os.path.isdir(self.dir_path):
+                self.lock_file = open(self.path, 'a')
+                fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+            return self
+
+        self.lock.acquire()
+        try:
+            self.lock_file = open(self.path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        except Exception:
+            self.lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if self.lock_file is not None:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                self.lock_file.close()
+        finally:
+            if not self.shared:
+                self.lock.release()
+
+
+# реализации промежуточного хранилища по settings.ETL_STAGING_BACKEND
+STAGING_BACKENDS = {
+    'mongodb': MongoStagingStore,
+    'segments': SegmentStagingStore,
+}
+
+
+def get_staging_store(name, durability=None):
+    """
+    Промежуточное хранилище по настройкам
+
+    Args:
+        name(str): Название коллекции
+        durability(str): Профиль надежности записи
+
+    Returns:
+        `StagingStore`: Хранилище
+    """
+    return STAGING_BACKENDS[settings.ETL_STAGING_BACKEND](name, durability)
@@ -19,10 +19,16 @@ from etl.services.db.factory import DatabaseService
 from etl.services.middleware.base import (
     EtlEncoder, get_table_name)
 from etl.services.olap.base import send_xml
-from etl.services.queue.base import TLSE,  STSE, RPublish, RowKeysCreator, \
-    calc_key_for_row, TableCreateQuery, InsertQuery, MongodbConnection, \
-    DeleteQuery, AKTSE, DTSE, get_single_task, get_binary_types_list,\
-    process_binary_data, get_binary_types_dict
+from etl.services.queue.base import TLSE,  STSE, RPublish, RowKeyEngine, \
+    TableCreateQuery, CopyQuery, MongodbConnection, \
+    DeleteQuery, AKTSE, DTSE, get_single_task, \
+    get_binary_types_dict, get_rows_pager, \
+    get_root_key_column, get_group_tasks, BatchSizer, BatchPipeline, \
+    RowNormalizer, KeysBloomFilter, CdcApplyQuery, MergeQuery, \
+    collapse_changes, StagingReader, get_field_names, TableDropQuery, \
+    TableIndexQuery
+from etl.services.queue.snapshot import KeysSnapshot
+from etl.services.queue.staging import get_staging_store, STAGING_INDEXES
 from .helpers import (RedisSourceService, DataSourceService,
                       TaskService, TaskStatusEnum,
                       TaskErrorCodeEnum)
@@ -32,7 +38,7 @@ from core.models import (
 from django.conf import settings
 
 from djcelery import celery
-from itertools import groupby, izip
+from itertools import izip, islice, compress
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
@@ -45,8 +51,6 @@ client.connect()
 
 logger = logging.getLogger(__name__)
 
-ASCENDING = 1
-
 
 class TaskProcessing(object):
     """
@@ -64,6 +68,9 @@ class TaskProcessing(object):
         queue_storage(`QueueStorage`): Посыльный к redis о текущем статусе задачи
         key(str): Ключ
         next_task_params(tuple): Набор данных для след. задачи
+        batch_sizers(list): Адаптивные размеры пакетов задачи
+        row_normalizers(list): Преобразователи строк источника задачи
+        key_engines(list): Расчет ключей строк источника задачи
     """
 
     def __init__(self, task_id, channel, last_task=False):
@@ -83,6 +90,9 @@ class TaskProcessing(object):
         self.queue_storage = None
         self.key = None
         self.next_task_params = None
+        self.batch_sizers = []
+        self.row_normalizers = []
+        self.key_engines = []
 
     def prepare(self):
         """
@@ -126,6 +136,210 @@ class TaskProcessing(object):
         """
         raise NotImplementedError
 
+    def update_progress(self, rows_count):
+        """
+        Обновление информации о работе таска
+
+        Args:
+            rows_count(int): Число обработанных строк
+        """
+        self.queue_storage.update()
+        self.publisher.loaded_count += rows_count
+        self.publisher.publish(TLSE.PROCESSING)
+        self.queue_storage['percent'] = (
+            100 if self.publisher.is_complete else self.publisher.percent)
+
+    def get_batch_sizer(self, size=None):
+        """
+        Адаптивный размер пакета для цикла обработки задачи.
+        Выбранные размеры пишутся в лог по завершении задачи
+
+        Args:
+            size(int): Начальный размер пакета
+
+        Returns:
+            `BatchSizer`: Размер пакета
+        """
+        batch = BatchSizer(size)
+        self.batch_sizers.append(batch)
+        return batch
+
+    def get_row_normalizer(self, cols, col_types):
+        """
+        Преобразователь строк источника в документы Mongodb.
+        Скорость преобразования пишется в лог по завершении задачи
+
+        Args:
+            cols(list): Выбранные колонки
+            col_types(dict): Типы колонок
+
+        Returns:
+            `RowNormalizer`: Преобразователь строк
+        """
+        normalizer = RowNormalizer(
+            cols, col_types, settings.ETL_STAGING_COMPACT_DOCUMENTS)
+        self.row_normalizers.append(normalizer)
+        return normalizer
+
+    def get_key_engine(self, cols, meta_info):
+        """
+        Расчет ключей строк источника.
+        Число совпавших ключей пишется в лог по завершении задачи
+
+        Args:
+            cols(list): Выбранные колонки
+            meta_info(dict): Метаданные по таблицам
+
+        Returns:
+            `RowKeyEngine`: Расчет ключей
+        """
+        engine = RowKeyEngine(cols, meta_info)
+        self.key_engines.append(engine)
+        return engine
+
+    def get_staging_store(self, name):
+        """
+        Промежуточная коллекция с профилем надежности записи:
+        профиль источника, профиль задачи
+        из settings.ETL_STAGING_STAGE_DURABILITY, либо профиль по умолчанию
+
+        Args:
+            name(str): Название коллекции
+
+        Returns:
+            `StagingStore`: Хранилище settings.ETL_STAGING_BACKEND
+        """
+        durability = self.context.get('durability') or \
+            settings.ETL_STAGING_STAGE_DURABILITY.get(
+                self.__class__.__name__, settings.ETL_STAGING_DURABILITY)
+        return get_staging_store(name, durability)
+
+    def create_staging_store(self, table_prefix, schema=None):
+        """
+        Создание промежуточной коллекции перед пакетной загрузкой.
+        При settings.ETL_STAGING_DEFERRED_INDEXES индексы STAGING_INDEXES
+        строятся после загрузки в `build_staging_indexes`, а не
+        обновляются каждой вставкой
+
+        Args:
+            table_prefix(str): Префикс названия коллекции
+            schema(list): Схема компактных документов
+
+        Returns:
+            `StagingStore`: Хранилище
+        """
+        store = self.get_staging_store(get_table_name(table_prefix, self.key))
+        store.create(
+            None if settings.ETL_STAGING_DEFERRED_INDEXES else
+            STAGING_INDEXES[table_prefix], schema)
+        return store
+
+    def build_staging_indexes(self, table_prefix):
+        """
+        Построение отложенных индексов после пакетной загрузки
+
+        Args:
+            table_prefix(str): Префикс названия коллекции
+        """
+        if settings.ETL_STAGING_DEFERRED_INDEXES:
+            self.get_staging_store(get_table_name(
+                table_prefix, self.key)).create(STAGING_INDEXES[table_prefix])
+
+    @staticmethod
+    def create_table_index(table_name, index_name, columns):
+        """
+        Создание индекса таблицы хранилища, если его еще нет
+
+        Args:
+            table_name(str): Название таблицы
+            index_name(str): Суффикс названия индекса
+            columns(list): Колонки индекса
+        """
+        index_query = TableIndexQuery(DataSourceService())
+        index_query.set_query(
+            table_name=table_name, columns=columns,
+            index_name='{0}_{1}_index'.format(table_name, index_name))
+        index_query.execute()
+        index_query.release()
+
+    def regenerate_cube(self, legacy_tables, source_id):
+        """
+        Пересоздание размерностей и мер, построенных до появления
+        колонки cdc_key: их строки не изменить по ключу, таблицы удаляются
+        и строятся заново из таблицы хранилища
+
+        Args:
+            legacy_tables(list): Таблицы без колонки cdc_key
+            source_id(int): id источника
+        """
+        logger.info('%s: tables %s have no cdc_key, regenerate cube',
+                    self.__class__.__name__, ', '.join(legacy_tables))
+        drop_query = TableDropQuery(DataSourceService())
+        drop_query.set_query(table_names=[
+            get_table_name(x, self.key) for x in (DIMENSIONS, MEASURES)])
+        drop_query.execute()
+        drop_query.release()
+
+        context = dict(self.context, source_id=source_id)
+        self.next_task_params = (
+            GENERATE_DIMENSIONS, load_dimensions, context)
+
+    def get_watermark_column(self, source, structure, meta_info):
+        """
+        Ключ корневой таблицы для дозагрузки только новых строк.
+        Граница выборки - максимальный ключ на момент начала загрузки,
+        строки, добавленные во время загрузки, попадут в следующую.
+        Граница сохраняется в context['watermark'] и фиксируется
+        после успешной загрузки в базу
+
+        Args:
+            source(`Datasource`): Источник
+            structure(dict): Структура дерева таблиц
+            meta_info(dict): Метаданные по таблицам
+
+        Returns:
+            dict or None: Колонка ключа, None, если источник
+            не в режиме добавления строк или ключ не подходит
+        """
+        if (self.context.get('extract_mode') !=
+                DatasourceSettings.EXTRACT_APPEND):
+            return None
+        key_col = get_root_key_column(
+            structure, meta_info, json.loads(self.context['col_types']))
+        if key_col:
+            self.context['watermark'] = DataSourceService.get_key_range(
+                source, structure['val'], key_col)[1]
+        return key_col
+
+    def get_rows_number(self, source, structure, cols):
+        """
+        Число строк загрузки для прогресса задачи. Оценка считается один раз
+        за загрузку и передается по цепочке задач в контексте. В точном
+        режиме count-запрос выполняется в фоне, его результат заменяет
+        оценку в следующих задачах
+
+        Args:
+            source(`Datasource`): Источник
+            structure(dict): Структура дерева таблиц
+            cols(list): Выбранные колонки
+
+        Returns:
+            int: Число строк
+        """
+        if 'rows_count' not in self.context:
+            self.context['rows_count'] = (
+                DataSourceService.get_structure_rows_number(
+                    source, structure, cols))
+            if settings.ETL_EXACT_ROWS_COUNT:
+                RedisSourceService.delete_rows_count(self.key)
+                count_rows_exact.apply_async(
+                    (self.key, self.context['source'], structure, cols))
+        elif settings.ETL_EXACT_ROWS_COUNT:
+            rows_count = RedisSourceService.get_rows_count(self.key)
+            if rows_count is not None:
+                self.context['rows_count'] = rows_count
+        return self.context['rows_count']
+
     def error_handling(self, err_msg, err_code=None):
         """
         Обработка ошибки
@@ -166,6 +380,20 @@ class TaskProcessing(object):
             TaskService.update_task_status(self.task_id, TaskStatusEnum.DONE, )
             self.queue_storage.update(TaskStatusEnum.DONE)
 
+        for batch in self.batch_sizers:
+            logger.info('%s batch sizes: %s',
+                        self.__class__.__name__, batch.history)
+        for normalizer in self.row_normalizers:
+            logger.info('%s normalized %s rows, %s rows/s',
+                        self.__class__.__name__, normalizer.rows_count,
+                        normalizer.speed)
+        for engine in self.key_engines:
+            if engine.collisions:
+                logger.warning('%s key collisions: %s',
+                               self.__class__.__name__, engine.collisions)
+        logger.info('%s mongodb clients: %s', self.__class__.__name__,
+                    MongodbConnection.registry.get_stats())
+
         # удаляем инфу о работе таска
         RedisSourceService.delete_queue(self.task_id)
         # удаляем канал из списка каналов юзера
@@ -182,11 +410,21 @@ def load_mongo_db(task_id, channel):
     return LoadMongodb(task_id, channel).load_data()
 
 
+@celery.task(name=MONGODB_DATA_LOAD_PARTITION)
+def load_mongo_db_partition(task_id, channel):
+    return LoadMongodbPartition(task_id, channel).load_data()
+
+
 @celery.task(name=DB_DATA_LOAD)
 def load_db(task_id, channel):
     return LoadDb(task_id, channel).load_data()
 
 
+@celery.task(name=DB_DIRECT_LOAD)
+def load_db_direct(task_id, channel):
+    return LoadDbDirect(task_id, channel).load_data()
+
+
 @celery.task(name=GENERATE_DIMENSIONS)
 def load_dimensions(task_id, channel):
     return LoadDimensions(task_id, channel).load_data()
@@ -217,11 +455,28 @@ def create_triggers(task_id, channel):
     return CreateTriggers(task_id, channel).load_data()
 
 
+@celery.task(name=DB_CDC_APPLY)
+def apply_cdc(task_id, channel):
+    return ApplyCdc(task_id, channel).load_data()
+
+
 @celery.task(name=CREATE_CUBE)
 def create_cube(task_id, channel):
     return CreateCube(task_id, channel).load_data()
 
 
+@celery.task(name=ROWS_COUNT_EXACT)
+def count_rows_exact(key, source, structure, cols):
+    """
+    Точный подсчет числа строк загрузки в фоне
+    """
+    source_model = Datasource()
+    source_model.set_from_dict(**source)
+    RedisSourceService.set_rows_count(
+        key, DataSourceService.get_structure_rows_number(
+            source_model, structure, cols, exact=True))
+
+
 class CreateDataset(TaskProcessing):
     """
     Создание Dataset
@@ -235,13 +490,21 @@ class CreateDataset(TaskProcessing):
         is_meta_stats = self.context['is_meta_stats']
 
         if not is_meta_stats:
-            self.next_task_params = (
-                MONGODB_DATA_LOAD, load_mongo_db, self.context)
+            if self.context.get('load_mode') == DatasourceSettings.DIRECT:
+                self.next_task_params = (
+                    DB_DIRECT_LOAD, load_db_direct, self.context)
+            else:
+                self.next_task_params = (
+                    MONGODB_DATA_LOAD, load_mongo_db, self.context)
         else:
             self.context['db_update'] = True
 
-            self.next_task_params = (
-                MONGODB_DELTA_LOAD, update_mongo_db, self.context)
+            if self.context['cdc_type'] == DatasourceSettings.TRIGGERS:
+                self.next_task_params = (
+                    DB_CDC_APPLY, apply_cdc, self.context)
+            else:
+                self.next_task_params = (
+                    MONGODB_DELTA_LOAD, update_mongo_db, self.context)
 
 
 class LoadMongodb(TaskProcessing):
@@ -251,93 +514,208 @@ class LoadMongodb(TaskProcessing):
 
     def processing(self):
         cols = json.loads(self.context['cols'])
-        col_types = json.loads(self.context['col_types'])
         structure = self.context['tree']
         source_model = Datasource()
         source_model.set_from_dict(**self.context['source'])
-
-        page = 1
-        limit = settings.ETL_COLLECTION_LOAD_ROWS_LIMIT
+        meta_info = json.loads(self.context['meta_info'])
 
         # общее количество строк в запросе
-        self.publisher.rows_count = DataSourceService.get_structure_rows_number(
-            source_model, structure,  cols)
+        self.publisher.rows_count = self.get_rows_number(
+            source_model, structure, cols)
         self.publisher.publish(TLSE.START)
 
-        col_names = ['_id', '_state', '_date']
-        for t_name, col_group in groupby(cols, lambda x: x["table"]):
-            for x in col_group:
-                col_names.append(x["table"] + FIELD_NAME_SEP + x["col"])
-
-        # находим бинарные данные для 1) создания ключей 2) инсерта в монго
-        binary_types_list = get_binary_types_list(cols, col_types)
-
-        # создаем коллекцию и индексы в Mongodb
-        mc = MongodbConnection()
-        collection = mc.get_collection(
-            'etl', get_table_name(STTM_DATASOURCE, self.key))
-        mc.set_indexes([('_id', ASCENDING), ('_state', ASCENDING),
-                        ('_date', ASCENDING)])
-
-        # Коллекция с текущими данными
-        current_collection_name = get_table_name(STTM_DATASOURCE_KEYS, self.key)
-        MongodbConnection.drop('etl', current_collection_name)
-        current_mc = MongodbConnection()
-        current_collection = current_mc.get_collection(
-            'etl', current_collection_name)
-        current_mc.set_indexes([('_id', ASCENDING)])
-
-        query = DataSourceService.get_rows_query_for_loading_task(
-            source_model, structure, cols)
+        # создаем промежуточную коллекцию
+        self.create_staging_store(
+            STTM_DATASOURCE, get_field_names(cols)
+            if settings.ETL_STAGING_COMPACT_DOCUMENTS else None)
 
-        source_connection = DataSourceService.get_source_connection(source_model)
+        # снимок ключей текущего состояния источника
+        self.context['keys_snapshot'] = self.task_id
+        self.get_watermark_column(source_model, structure, meta_info)
 
-        tables_key_creator = []
-        for table, value in json.loads(self.context['meta_info']).iteritems():
-            rkc = RowKeysCreator(table=table, cols=cols)
-            rkc.set_primary_key(value)
-            tables_key_creator.append(rkc)
+        partitions = self.get_partitions(source_model, structure, meta_info)
+        if partitions:
+            self.run_partitions(partitions)
+            return
 
-        while True:
-            cursor = source_connection.cursor()
-            cursor.execute(query.format(limit, (page-1)*limit))
-            result = cursor.fetchall()
+        self.extract(source_model, structure, cols, meta_info)
+        KeysSnapshot(self.key, self.task_id).finish()
+        self.build_staging_indexes(STTM_DATASOURCE)
 
-            data_to_insert = []
-            data_to_current_insert = []
-            if not result:
-                break
+        self.next_task_params = (DB_DATA_LOAD, load_db, self.context)
 
-            for ind, record in enumerate(result):
-                row_key = calc_key_for_row(
-                        record, tables_key_creator, (page-1)*limit + ind,
-                        binary_types_list)
+    def get_partitions(self, source, structure, meta_info):
+        """
+        Условия выборки для параллельной загрузки по диапазонам
+        целочисленного первичного ключа корневой таблицы
 
-                # бинарные данные оборачиваем в Binary(), если они имеются
-                new_record = process_binary_data(record, binary_types_list)
+        Args:
+            source(`Datasource`): Источник
+            structure(dict): Структура дерева таблиц
+            meta_info(dict): Метаданные по таблицам
 
-                record_normalized = (
-                    [row_key, STSE.IDLE, EtlEncoder.encode(datetime.now())] +
-                    [EtlEncoder.encode(rec_field) for rec_field in new_record])
-                data_to_insert.append(dict(izip(col_names, record_normalized)))
-                data_to_current_insert.append(dict(_id=row_key))
-            try:
-                collection.insert_many(data_to_insert, ordered=False)
-                current_collection.insert_many(data_to_current_insert, ordered=False)
-                print 'inserted %d rows to mongodb' % len(data_to_insert)
-            except Exception as e:
-                self.error_handling(e.message)
+        Returns:
+            list: Условия выборки частей, пустой список,
+            если загрузка последовательная
+        """
+        parts = settings.ETL_EXTRACT_PARTITIONS
+        if (parts < 2 or self.publisher.rows_count <
+                settings.ETL_EXTRACT_PARTITION_MIN_ROWS):
+            return []
 
-            # обновляем информацию о работе таска
-            self.queue_storage.update()
-            self.publisher.loaded_count += limit
-            self.publisher.publish(TLSE.PROCESSING)
-            self.queue_storage['percent'] = (
-                100 if self.publisher.is_complete else self.publisher.percent)
+        # нумерация строк у каждой части своя, ключи нужны у всех таблиц
+        key_col = get_root_key_column(
+            structure, meta_info, json.loads(self.context['col_types']))
+        if not key_col:
+            return []
 
-            page += 1
+        return DataSourceService.get_key_range_conditions(
+            source, structure['val'], key_col, parts)
 
-        self.next_task_params = (DB_DATA_LOAD, load_db, self.context)
+    def run_partitions(self, conditions):
+        """
+        Запуск частей загрузки группой параллельных celery-задач.
+        Части публикуют прогресс в канал текущей задачи, последняя
+        завершившаяся часть запускает загрузку в базу, либо, если какая-то
+        часть завершилась с ошибкой, переводит текущую задачу в статус ошибки
+
+        Args:
+            conditions(list): Условия выборки частей
+        """
+        RedisSourceService.init_queue_partitions(self.task_id, len(conditions))
+
+        tasks_params = []
+        for condition in conditions:
+            context = dict(self.context)
+            context.update({
+                'parent_task_id': self.task_id,
+                'parent_channel': self.channel,
+                'partition_condition': condition,
+                'partitions_count': len(conditions),
+            })
+            tasks_params.append((MONGODB_DATA_LOAD_PARTITION,
+                                 load_mongo_db_partition, context))
+
+        partitions_group, channels = get_group_tasks(tasks_params)
+        partitions_group.apply_async()
+
+    def extract(self, source_model, structure, cols, meta_info,
+                condition=None):
+        """
+        Загрузка строк источника в коллекции Mongodb
+
+        Args:
+            source_model(`Datasource`): Источник
+            structure(dict): Структура дерева таблиц
+            cols(list): Выбранные колонки
+            meta_info(dict): Метаданные по таблицам
+            condition(str): Дополнительное условие выборки
+        """
+        col_types = json.loads(self.context['col_types'])
+        batch = self.get_batch_sizer()
+        normalizer = self.get_row_normalizer(cols, col_types)
+        key_engine = self.get_key_engine(cols, meta_info)
+
+        store = self.get_staging_store(
+            get_table_name(STTM_DATASOURCE, self.key))
+        keys_writer = KeysSnapshot(
+            self.key, self.context['keys_snapshot']).get_writer(self.task_id)
+
+        rows_pager = get_rows_pager(
+            DataSourceService(), source_model, structure, cols,
+            meta_info, batch, condition)
+
+        self.row_num = 0
+
+        def transform(result):
+            row_keys = key_engine.keys_for_batch(result, self.row_num)
+            self.row_num += len(result)
+
+            data_to_insert = normalizer.get_documents(
+                result, row_keys, STSE.IDLE, EtlEncoder.encode(datetime.now()))
+
+            batch.update(data_to_insert)
+            return data_to_insert, row_keys
+
+        def write(data):
+            data_to_insert, row_keys = data
+            # совпавшие с загруженными ключи считаем коллизиями
+            key_engine.add_collisions(store.append(data_to_insert))
+            keys_writer.write(row_keys)
+            print 'inserted %d rows to staging' % len(data_to_insert)
+            return len(data_to_insert)
+
+        # чтение источника, вычисление ключей и запись в Mongodb
+        # выполняются одновременно
+        BatchPipeline(transform, write).run(
+            rows_pager, on_written=self.update_progress,
+            on_error=lambda e: self.error_handling(e.message))
+        keys_writer.close()
+
+
+class LoadMongodbPartition(LoadMongodb):
+    """
+    Загрузка в Mongodb диапазона ключа источника
+    при параллельной первичной загрузке
+    """
+
+    def processing(self):
+        cols = json.loads(self.context['cols'])
+        structure = self.context['tree']
+        source_model = Datasource()
+        source_model.set_from_dict(**self.context['source'])
+        meta_info = json.loads(self.context['meta_info'])
+        parent_task_id = self.context['parent_task_id']
+
+        # прогресс всех частей сводится в канал родительской задачи
+        self.publisher = RPublish(self.context['parent_channel'], parent_task_id)
+        self.publisher.rows_count = self.context['rows_count']
+
+        try:
+            self.extract(source_model, structure, cols, meta_info,
+                         self.context['partition_condition'])
+        except Exception as e:
+            # часть с ошибкой тоже учитывается в счетчике частей,
+            # иначе загрузка не завершится ни успехом, ни ошибкой
+            self.error_handling(e.message)
+
+        # последняя завершившаяся часть запускает загрузку в базу
+        if not RedisSourceService.finish_queue_partition(
+                parent_task_id, self.was_error):
+            return
+        failed = RedisSourceService.get_failed_partitions(parent_task_id)
+        RedisSourceService.delete_queue_partitions(parent_task_id)
+        if failed:
+            # по неполной коллекции загрузка в базу и поиск удаленных
+            # строк удалили бы строки хранилища
+            err_msg = 'Части загрузки завершились с ошибкой: {0} из {1}'.format(
+                failed, self.context['partitions_count'])
+            TaskService.update_task_status(
+                parent_task_id, TaskStatusEnum.ERROR,
+                error_code=TaskErrorCodeEnum.DEFAULT_CODE, error_msg=err_msg)
+            self.error_handling(err_msg)
+            return
+
+        # части ключей пишут все воркеры загрузки
+        KeysSnapshot(self.key, self.context['keys_snapshot']).finish(
+            self.context['partitions_count'])
+        self.build_staging_indexes(STTM_DATASOURCE)
+        if not self.publisher.is_complete:
+            self.publisher.publish(TLSE.FINISH)
+
+        context = dict(self.context)
+        for key in ('parent_task_id', 'parent_channel',
+                    'partition_condition', 'partitions_count'):
+            del context[key]
+        self.next_task_params = (DB_DATA_LOAD, load_db, context)
+
+    def update_progress(self, rows_count):
+        self.queue_storage.update()
+        self.publisher.loaded_count = RedisSourceService.add_partition_loaded(
+            self.context['parent_task_id'], rows_count)
+        self.publisher.publish(TLSE.PROCESSING)
+        self.queue_storage['percent'] = (
+            100 if self.publisher.is_complete else self.publisher.percent)
 
 
 class LoadDb(TaskProcessing):
@@ -356,19 +734,11 @@ class LoadDb(TaskProcessing):
         source = Datasource()
         source.set_from_dict(**self.context['source'])
         # общее количество строк в запросе
-        self.publisher.rows_count = DataSourceService.get_structure_rows_number(
-            source, structure,  cols)
+        self.publisher.rows_count = self.get_rows_number(
+            source, structure, cols)
         self.publisher.publish(TLSE.START)
 
-        col_names = ['"cdc_key" text UNIQUE']
-        clear_col_names = ['cdc_key']
-        for obj in cols:
-            t = obj['table']
-            c = obj['col']
-            col_names.append('"{0}{1}{2}" {3}'.format(
-                t, FIELD_NAME_SEP, c,
-                TYPES_MAP.get(col_types['{0}.{1}'.format(t, c)])))
-            clear_col_names.append('{0}{1}{2}'.format(t, FIELD_NAME_SEP, c))
+        col_names, clear_col_names = self.get_table_columns(cols, col_types)
 
         # инфа о бинарных данных для инсерта в постгрес
         binary_types_dict = get_binary_types_dict(cols, col_types)
@@ -376,72 +746,152 @@ class LoadDb(TaskProcessing):
         # инфа для колонки cdc_key, о том, что она не binary
         binary_types_dict['0'] = False
 
-        source_collection = MongodbConnection().get_collection(
-            'etl', get_table_name(STTM_DATASOURCE, self.key))
+        store = self.get_staging_store(
+            get_table_name(STTM_DATASOURCE, self.key))
 
         source_table_name = get_table_name(STTM_DATASOURCE, self.key)
         if not db_update:
-            table_create_query = TableCreateQuery(DataSourceService())
-            table_create_query.set_query(
-                table_name=source_table_name, cols=col_names)
-            table_create_query.execute()
-
-        insert_query = InsertQuery(DataSourceService())
+            self.create_table(source_table_name, col_names)
+            insert_query = CopyQuery(DataSourceService())
+        else:
+            # при дозагрузке строки с существующим ключом обновляются
+            insert_query = MergeQuery(DataSourceService())
         insert_query.set_query(
-            table_name=source_table_name, cols_nums=len(clear_col_names))
+            table_name=source_table_name, cols_nums=len(clear_col_names),
+            col_names=clear_col_names,
+            col_types=self.get_table_types(cols, col_types))
 
-        limit = settings.ETL_COLLECTION_LOAD_ROWS_LIMIT
-        offset = 0
-        last_row = None
+        # документы переводятся в кортежи значений по порядку колонок
+        reader = StagingReader(clear_col_names[1:], store.get_schema())
+
+        batch = self.get_batch_sizer()
+        # один проход по возрастанию ключа вместо skip/limit
+        documents = store.scan(STSE.IDLE, reader.projection, batch.size)
+        first_key = last_row = None
         # Пишем данные в базу
         while True:
+            rows = [reader.get_row(record) for record in
+                    islice(documents, batch.size)]
+            if not rows:
+                break
             try:
-                collection_cursor = source_collection.find(
-                    {'_state': STSE.IDLE},
-                    limit=limit, skip=offset)
-                rows_dict = []
-                for record in collection_cursor:
-                    temp_dict = {}
-                    for ind, col_name in enumerate(clear_col_names):
-                        temp_dict.update(
-                            {str(ind): record['_id'] if col_name == 'cdc_key'
-                                else record[col_name]})
-                    rows_dict.append(temp_dict)
-                if not rows_dict:
-                    break
-                insert_query.execute(data=rows_dict,
+                insert_query.execute(data=rows,
                                      binary_types_dict=binary_types_dict)
-                print 'load in db %s records' % len(rows_dict)
-                offset += limit
             except Exception as e:
-                print 'Exception'
                 insert_query.connection.rollback()
-                self.was_error = True
                 # код и сообщение ошибки
                 pg_code = getattr(e, 'pgcode', None)
 
                 err_msg = '%s: ' % errorcodes.lookup(pg_code) if pg_code else ''
                 err_msg += e.message
                 self.error_handling(err_msg, pg_code)
-            else:
-                last_row = rows_dict[-1]  # получаем последнюю запись
-                # обновляем информацию о работе таска
-                self.queue_storage.update()
-                self.publisher.loaded_count += limit
-                self.publisher.publish(TLSE.PROCESSING)
-                self.queue_storage['percent'] = (
-                    100 if self.publisher.is_complete else self.publisher.percent)
+                # непереданные строки остаются в статусе IDLE
+                break
+            print 'load in db %s records' % len(rows)
+            if first_key is None:
+                first_key = rows[0][0]
+            last_row = rows[-1]  # получаем последнюю запись
+            batch.update(rows)
+            # обновляем информацию о работе таска
+            self.update_progress(len(rows))
+        documents.close()
 
-        source_collection.update_many(
-            {'_state': STSE.IDLE}, {'$set': {'_state': STSE.LOADED}})
+        insert_query.release()
+
+        # загруженными отмечается только переданный диапазон ключей
+        if last_row is not None:
+            store.set_state(STSE.LOADED, STSE.IDLE, (first_key, last_row[0]))
+
+        self.finish_load(source, cols, last_row)
+
+    @staticmethod
+    def get_table_columns(cols, col_types):
+        """
+        Колонки таблицы sttm_datasource_{key} в хранилище
+
+        Args:
+            cols(list): Выбранные колонки
+            col_types(dict): Типы колонок
+
+        Returns:
+            tuple: Описания колонок для создания таблицы и их названия
+        """
+        col_names = ['"cdc_key" text UNIQUE']
+        clear_col_names = ['cdc_key']
+        for obj in cols:
+            t = obj['table']
+            c = obj['col']
+            col_names.append('"{0}{1}{2}" {3}'.format(
+                t, FIELD_NAME_SEP, c,
+                TYPES_MAP.get(col_types['{0}.{1}'.format(t, c)])))
+            clear_col_names.append('{0}{1}{2}'.format(t, FIELD_NAME_SEP, c))
+        return col_names, clear_col_names
+
+    @staticmethod
+    def get_table_types(cols, col_types):
+        """
+        Типы колонок таблицы sttm_datasource_{key} в хранилище по порядку
+
+        Args:
+            cols(list): Выбранные колонки
+            col_types(dict): Типы колонок
+
+        Returns:
+            list: Типы колонок, первая - cdc_key
+        """
+        return ['text'] + [
+            TYPES_MAP.get(col_types['{0}.{1}'.format(x['table'], x['col'])])
+            for x in cols]
+
+    @staticmethod
+    def create_table(table_name, col_names):
+        """
+        Создание таблицы в хранилище
+        """
+        table_create_query = TableCreateQuery(DataSourceService())
+        table_create_query.set_query(
+            table_name=table_name, cols=col_names)
+        table_create_query.execute()
+        table_create_query.release()
+
+    def finish_load(self, source, cols, last_row):
+        """
+        Сохранение метаданных загрузки и выбор следующей задачи
+
+        Args:
+            source(`Datasource`): Источник
+            cols(list): Выбранные колонки
+            last_row(tuple): Последняя загруженная строка, первое
+                значение - cdc_key
+        """
+        # изменения триггеров удаляют строки по первичному ключу источника,
+        # индекс строится после пакетной загрузки
+        key_cols = ApplyCdc.get_key_cols(
+            cols, json.loads(self.context['meta_info']))
+        if key_cols:
+            self.create_table_index(
+                get_table_name(STTM_DATASOURCE, self.key), 'source_key',
+                ApplyCdc.get_sttm_key_cols(cols, key_cols))
+
+        # граница выборки фиксируется только после загрузки без ошибок
+        watermark = self.context.get('watermark')
+        if watermark is not None and not self.was_error:
+            watermark = (self.context['tree']['val'], watermark)
+        else:
+            watermark = None
 
         # работа с datasource_meta
         DataSourceService.update_datasource_meta(
             self.key, source, cols, json.loads(
-                self.context['meta_info']), last_row, self.context['dataset_id'])
+                self.context['meta_info']), last_row and last_row[1:],
+            self.context['dataset_id'], watermark)
         if last_row:
             DataSourceService.update_collections_stats(
-                self.context['collections_names'], last_row['0'])
+                self.context['collections_names'], last_row[0])
+
+        if self.context.get('incremental'):
+            # загружены только новые строки, удаленных строк нет
+            return
 
         if self.context['cdc_type'] != DatasourceSettings.TRIGGERS:
             self.next_task_params = (DB_DETECT_REDUNDANT, detect_redundant, {
@@ -452,8 +902,13 @@ class LoadDb(TaskProcessing):
                 'cols': self.context['cols'],
                 'col_types': self.context['col_types'],
                 'dataset_id': self.context['dataset_id'],
+                'keys_snapshot': self.context['keys_snapshot'],
+                'durability': self.context.get('durability'),
             })
         else:
+            # удаленные строки выявляют триггеры, снимок загрузки
+            # соответствует промежуточной коллекции
+            KeysSnapshot(self.key, self.context['keys_snapshot']).sync()
             self.next_task_params = (CREATE_TRIGGERS, create_triggers, {
                 'checksum': self.key,
                 'user_id': self.user_id,
@@ -465,6 +920,103 @@ class LoadDb(TaskProcessing):
             })
 
 
+class LoadDbDirect(LoadDb):
+    """
+    Первичная загрузка данных источника напрямую в базу, без промежуточной
+    коллекции Mongodb. В Mongodb пишутся только записи-ключи sttm_datasource
+    в статусе LOADED, по которым, как и по снимку ключей, последующие
+    дозагрузки выявляют новые и удаленные строки
+    """
+
+    def processing(self):
+        self.key = self.context['checksum']
+        self.user_id = self.context['user_id']
+        cols = json.loads(self.context['cols'])
+        col_types = json.loads(self.context['col_types'])
+        structure = self.context['tree']
+        meta_info = json.loads(self.context['meta_info'])
+
+        source = Datasource()
+        source.set_from_dict(**self.context['source'])
+        # общее количество строк в запросе
+        self.publisher.rows_count = self.get_rows_number(
+            source, structure, cols)
+        self.publisher.publish(TLSE.START)
+
+        col_names, clear_col_names = self.get_table_columns(cols, col_types)
+
+        # инфа о бинарных данных для инсерта в постгрес
+        binary_types_dict = get_binary_types_dict(cols, col_types)
+        binary_types_dict['0'] = False
+
+        source_table_name = get_table_name(STTM_DATASOURCE, self.key)
+        self.create_table(source_table_name, col_names)
+
+        insert_query = CopyQuery(DataSourceService())
+        insert_query.set_query(
+            table_name=source_table_name, cols_nums=len(clear_col_names),
+            col_types=self.get_table_types(cols, col_types))
+
+        # промежуточная коллекция ключей
+        keys_store = self.create_staging_store(STTM_DATASOURCE)
+
+        self.context['keys_snapshot'] = self.task_id
+        snapshot = KeysSnapshot(self.key, self.task_id)
+        keys_writer = snapshot.get_writer(self.task_id)
+        self.get_watermark_column(source, structure, meta_info)
+
+        batch = self.get_batch_sizer()
+        rows_pager = get_rows_pager(
+            DataSourceService(), source, structure, cols, meta_info, batch)
+
+        key_engine = self.get_key_engine(cols, meta_info)
+        normalizer = self.get_row_normalizer(cols, col_types)
+        self.row_num = 0
+        self.last_row = None
+
+        def transform(result):
+            row_keys = key_engine.keys_for_batch(result, self.row_num)
+            self.row_num += len(result)
+            # значения приводятся так же, как при загрузке через Mongodb
+            rows = normalizer.get_rows(result, row_keys)
+
+            batch.update(rows)
+            return rows
+
+        def write(rows):
+            try:
+                insert_query.execute(data=rows,
+                                     binary_types_dict=binary_types_dict)
+            except Exception:
+                insert_query.connection.rollback()
+                raise
+            row_keys = [x[0] for x in rows]
+            key_engine.add_collisions(keys_store.append(
+                [{'_id': x, '_state': STSE.LOADED} for x in row_keys]))
+            keys_writer.write(row_keys)
+            print 'load in db %s records' % len(rows)
+            self.last_row = rows[-1]
+            return len(rows)
+
+        def on_error(e):
+            # код и сообщение ошибки
+            pg_code = getattr(e, 'pgcode', None)
+            err_msg = '%s: ' % errorcodes.lookup(pg_code) if pg_code else ''
+            err_msg += e.message
+            self.error_handling(err_msg, pg_code)
+
+        # соединение хранилища одно, поэтому писатель один
+        BatchPipeline(transform, write, writers=1).run(
+            rows_pager, on_written=self.update_progress, on_error=on_error)
+
+        insert_query.release()
+        keys_writer.close()
+        snapshot.finish()
+        self.build_staging_indexes(STTM_DATASOURCE)
+
+        self.finish_load(source, cols, self.last_row)
+
+
 class LoadDimensions(TaskProcessing):
     """
     Создание рамерности, измерения олап куба
@@ -472,7 +1024,8 @@ class LoadDimensions(TaskProcessing):
     table_prefix = DIMENSIONS
     actual_fields_type = ['text']
 
-    def get_actual_fields(self, meta_data):
+    @classmethod
+    def get_actual_fields(cls, meta_data):
         """
         Фильтруем поля по необходимому нам типу
 
@@ -483,7 +1036,7 @@ class LoadDimensions(TaskProcessing):
         for record in meta_data:
 
             for field in json.loads(record['meta__fields'])['columns']:
-                if field['type'] in self.actual_fields_type:
+                if field['type'] in cls.actual_fields_type:
                     actual_fields.append((
                         record['meta__collection_name'], field))
 
@@ -518,7 +1071,8 @@ class LoadDimensions(TaskProcessing):
             value=self.key).values('meta__collection_name', 'meta__fields')
         self.actual_fields = self.get_actual_fields(meta_data)
 
-        col_names = []
+        # ключ строки нужен для удаления строк без пересоздания таблицы
+        col_names = ['"cdc_key" text']
         for table, field in self.actual_fields:
             col_names.append('"{0}{1}{2}" {3}'.format(
                 table, FIELD_NAME_SEP, field['name'], field['type']))
@@ -527,6 +1081,7 @@ class LoadDimensions(TaskProcessing):
         create_query.set_query(
             table_name=get_table_name(self.table_prefix, self.key), cols=col_names)
         create_query.execute()
+        create_query.release()
 
         try:
             self.save_fields()
@@ -538,6 +1093,11 @@ class LoadDimensions(TaskProcessing):
             err_msg += e.message
             self.error_handling(err_msg)
 
+        # строки размерностей и мер удаляются по cdc_key
+        self.create_table_index(
+            get_table_name(self.table_prefix, self.key), 'cdc_key',
+            ['cdc_key'])
+
         # Сохраняем метаданные
         self.save_meta_data(
             self.user_id, self.key, self.actual_fields, meta_tables)
@@ -594,7 +1154,7 @@ class LoadDimensions(TaskProcessing):
         Args:
             model: Модель к целевой таблице
         """
-        column_names = []
+        column_names = ['cdc_key']
         for table, field in self.actual_fields:
             column_names.append('{0}{1}{2}'.format(
                     table, FIELD_NAME_SEP, field['name']))
@@ -608,21 +1168,24 @@ class LoadDimensions(TaskProcessing):
         # инфа для колонки cdc_key, о том, что она не binary
         binary_types_dict['0'] = False
 
-        insert_query = InsertQuery(DataSourceService())
+        insert_query = CopyQuery(DataSourceService())
         insert_query.set_query(
             table_name=get_table_name(self.table_prefix, self.key),
-            cols_nums=len(column_names))
+            cols_nums=len(column_names),
+            col_types=['text'] + [
+                field['type'] for table, field in self.actual_fields])
         offset = 0
-        step = settings.ETL_COLLECTION_LOAD_ROWS_LIMIT
+        batch = self.get_batch_sizer()
         print 'load dim or measure'
         rows_query = self.rows_query(column_names)
 
-        connection = DataSourceService.get_local_instance().connection
+        # читаем из той же базы хранилища, что и пишем
+        connection = insert_query.connection
         while True:
             # index_to = offset+step
             cursor = connection.cursor()
 
-            cursor.execute(rows_query.format(step, offset))
+            cursor.execute(rows_query.format(batch.size, offset))
             rows = cursor.fetchall()
             if not rows:
                 break
@@ -635,10 +1198,13 @@ class LoadDimensions(TaskProcessing):
             insert_query.execute(data=rows_dict,
                                  binary_types_dict=binary_types_dict)
             print 'load in db %s records' % len(rows_dict)
-            offset += step
+            offset += len(rows_dict)
+            batch.update(rows_dict)
 
             self.queue_storage.update()
 
+        insert_query.release()
+
 
 class LoadMeasures(LoadDimensions):
     """
@@ -672,12 +1238,56 @@ class LoadMeasures(LoadDimensions):
 
 class UpdateMongodb(TaskProcessing):
 
+    def get_keys_filter(self, store):
+        """
+        Фильтр Блума по ключам загруженных строк
+
+        Args:
+            store(`StagingStore`): Коллекция загруженных строк
+
+        Returns:
+            `KeysBloomFilter`: Фильтр или None, если он отключен
+        """
+        if not settings.ETL_DELTA_BLOOM_FILTER:
+            return None
+        keys_filter = KeysBloomFilter(
+            store.count(), settings.ETL_DELTA_BLOOM_ERROR_RATE)
+        for key in store.iter_keys():
+            keys_filter.add(key)
+        return keys_filter
+
+    @staticmethod
+    def get_existing_keys(store, keys, keys_filter=None,
+                          snapshot_keys=None):
+        """
+        Ключи пакета, уже загруженные в коллекцию.
+        При наличии снимка ключей предыдущей загрузки проверка выполняется
+        по нему, иначе одним запросом на пакет, ключи,
+        отсутствующие в фильтре, не проверяются
+
+        Args:
+            store(`StagingStore`): Коллекция загруженных строк
+            keys(list): Ключи пакета
+            keys_filter(`KeysBloomFilter`): Фильтр загруженных ключей
+            snapshot_keys(numpy.ndarray): Ключи синхронизированного снимка
+
+        Returns:
+            set: Существующие ключи
+        """
+        if snapshot_keys is not None:
+            return set(compress(
+                keys, KeysSnapshot.contains(snapshot_keys, keys)))
+        if keys_filter is not None:
+            keys = [key for key in keys if key in keys_filter]
+        if not keys:
+            return set()
+        return store.find_existing(keys)
+
     def processing(self):
         """
         1. Процесс обновленения данных в коллекции `sttm_datasource_delta_{key}`
-        новыми данными с помощью `sttm_datasource_keys_{key}`
-        2. Создание коллекции `sttm_datasource_keys_{key}` c ключами для
-        текущего состояния источника
+        новыми данными с помощью снимка ключей предыдущей загрузки
+        2. Создание снимка ключей текущего состояния источника
         """
         self.key = self.context['checksum']
         cols = json.loads(self.context['cols'])
@@ -687,158 +1297,190 @@ class UpdateMongodb(TaskProcessing):
         source_model.set_from_dict(**self.context['source'])
 
         # общее количество строк в запросе
-        self.publisher.rows_count = DataSourceService.get_structure_rows_number(
-            source_model, structure,  cols)
+        self.publisher.rows_count = self.get_rows_number(
+            source_model, structure, cols)
         self.publisher.publish(TLSE.START)
 
-        col_names = ['_id', '_state', '_date']
-        for t_name, col_group in groupby(cols, lambda x: x["table"]):
-            for x in col_group:
-                col_names.append(x["table"] + FIELD_NAME_SEP + x["col"])
-
-        # находим бинарные данные для 1) создания ключей 2) инсерта в монго
-        binary_types_list = get_binary_types_list(cols, col_types)
-
-        collection = MongodbConnection().get_collection(
-            'etl', get_table_name(STTM_DATASOURCE, self.key))
-
-        # Коллекция с текущими данными
-        current_collection_name = get_table_name(STTM_DATASOURCE_KEYS, self.key)
-        MongodbConnection.drop('etl', current_collection_name)
-        current_mc = MongodbConnection()
-        current_collection = current_mc.get_collection(
-            'etl', current_collection_name)
-        current_mc.set_indexes([('_id', ASCENDING)])
+        normalizer = self.get_row_normalizer(cols, col_types)
+
+        store = self.get_staging_store(
+            get_table_name(STTM_DATASOURCE, self.key))
+        # новые документы переносятся в коллекцию, загруженную
+        # в прежнем формате, схема нужна для их чтения
+        if normalizer.compact:
+            store.set_schema(get_field_names(cols))
+
+        meta_info = json.loads(self.context['meta_info'])
+
+        # в режиме добавления строк читаем только строки с ключом
+        # больше сохраненной границы, удаленных строк в источнике нет
+        condition = None
+        key_col = self.get_watermark_column(
+            source_model, structure, meta_info)
+        watermark = DataSourceService.get_watermark(
+            source_model, structure['val'], self.key) if key_col else None
+        self.context['incremental'] = watermark is not None
+        if self.context['incremental']:
+            # граница не уменьшается, даже если строки источника удалили
+            self.context['watermark'] = max(
+                self.context['watermark'], watermark)
+            condition = DataSourceService.get_key_range_condition(
+                source_model, key_col, watermark + 1,
+                self.context['watermark'] + 1)
+            # снимок не содержал бы прежних ключей, новые строки
+            # сверяются с коллекцией
+            KeysSnapshot.delete(self.key)
+            self.context['keys_snapshot'] = None
+            snapshot = keys_writer = None
+        else:
+            # снимок ключей текущего состояния источника
+            self.context['keys_snapshot'] = self.task_id
+            snapshot = KeysSnapshot(self.key, self.task_id)
+            keys_writer = snapshot.get_writer(self.task_id)
 
         # Дельта-коллекция
-        delta_mc = MongodbConnection()
-        delta_collection = delta_mc.get_collection(
-            'etl', get_table_name(STTM_DATASOURCE_DELTA, self.key))
-        delta_mc.set_indexes([
-            ('_id', ASCENDING), ('_state', ASCENDING), ('_date', ASCENDING)])
-
-        query = DataSourceService.get_rows_query_for_loading_task(
-            source_model, structure, cols)
+        delta_store = self.create_staging_store(STTM_DATASOURCE_DELTA)
 
-        source_connection = DataSourceService.get_source_connection(source_model)
+        key_engine = self.get_key_engine(cols, meta_info)
 
-        tables_key_creator = []
-        for table, value in json.loads(self.context['meta_info']).iteritems():
-            rkc = RowKeysCreator(table=table, cols=cols)
-            rkc.set_primary_key(value)
-            tables_key_creator.append(rkc)
+        synced = KeysSnapshot.get_synced(self.key)
+        if synced is not None:
+            snapshot_keys = synced.load(KeysSnapshot.SYNCED)
+            keys_filter = None
+        else:
+            snapshot_keys = None
+            keys_filter = self.get_keys_filter(store)
 
         #  Выявляем новые записи в базе и записываем их в дельта-коллекцию
-        limit = settings.ETL_COLLECTION_LOAD_ROWS_LIMIT
-        page = 1
-        while True:
-            cursor = source_connection.cursor()
-            cursor.execute(query.format(limit, (page-1)*limit))
-            result = cursor.fetchall()
-            if not result:
-                break
-            data_to_insert = []
-            data_to_current_insert = []
-            for ind, record in enumerate(result):
-                row_key = calc_key_for_row(
-                    record, tables_key_creator, (page-1)*limit + ind,
-                    binary_types_list)
-
-                # бинарные данные оборачиваем в Binary(), если они имеются
-                new_record = process_binary_data(record, binary_types_list)
-
-                if not collection.find({'_id': row_key}).count():
-                    delta_rows = (
-                        [row_key, DTSE.NEW, EtlEncoder.encode(datetime.now())] +
-                        [EtlEncoder.encode(rec_field) for rec_field in new_record])
-                    data_to_insert.append(dict(izip(col_names, delta_rows)))
-
-                data_to_current_insert.append(dict(_id=row_key))
-            try:
-                if data_to_insert:
-                    delta_collection.insert_many(data_to_insert, ordered=False)
-                current_collection.insert_many(data_to_current_insert, ordered=False)
-            except Exception as e:
-                self.error_handling(e.message)
-            page += 1
+        batch = self.get_batch_sizer()
+        rows_pager = get_rows_pager(
+            DataSourceService(), source_model, structure, cols,
+            meta_info, batch, condition)
+
+        row_num = 0
+        # соединение источника возвращается в пул и при ошибке
+        pages = iter(rows_pager)
+        try:
+            for result in pages:
+                new_records = []
+                new_keys = []
+                row_keys = key_engine.keys_for_batch(result, row_num)
+                row_num += len(result)
+                existing_keys = self.get_existing_keys(
+                    store, row_keys, keys_filter, snapshot_keys)
+                for row_key, record in izip(row_keys, result):
+                    if row_key not in existing_keys:
+                        new_records.append(record)
+                        new_keys.append(row_key)
+
+                data_to_insert = normalizer.get_documents(
+                    new_records, new_keys, DTSE.NEW,
+                    EtlEncoder.encode(datetime.now()))
+                try:
+                    if data_to_insert:
+                        delta_store.append(data_to_insert)
+                    if keys_writer:
+                        keys_writer.write(row_keys)
+                except Exception as e:
+                    self.error_handling(e.message)
+                batch.update(result)
+        finally:
+            pages.close()
+
+        if snapshot:
+            keys_writer.close()
+            snapshot.finish()
+        self.build_staging_indexes(STTM_DATASOURCE_DELTA)
 
         # Обновляем основную коллекцию новыми данными
-        page = 1
+        batch = self.get_batch_sizer()
+        delta_data = delta_store.scan(DTSE.NEW, batch_size=batch.size)
         while True:
-            delta_data = delta_collection.find(
-                {'_state': DTSE.NEW},
-                limit=limit, skip=(page-1)*limit).sort('_date', ASCENDING)
             to_ins = []
-            for record in delta_data:
+            for record in islice(delta_data, batch.size):
                 record['_state'] = STSE.IDLE
                 to_ins.append(record)
             if not to_ins:
                 break
             try:
-                collection.insert_many(to_ins, ordered=False)
+                store.append(to_ins)
             except Exception as e:
                 self.error_handling(e.message)
-
-            page += 1
+            batch.update(to_ins)
+        delta_data.close()
 
         # Обновляем статусы дельты-коллекции
-        delta_collection.update_many(
-            {'_state': DTSE.NEW}, {'$set': {'_state': DTSE.SYNCED}})
+        delta_store.set_state(DTSE.SYNCED, DTSE.NEW)
 
         self.next_task_params = (DB_DATA_LOAD, load_db, self.context)
 
 
 class DetectRedundant(TaskProcessing):
 
+    @staticmethod
+    def get_missing_keys(keys, snapshot_keys, chunk_size=10000):
+        """
+        Ключи, отсутствующие в снимке. Ключи проверяются частями
+
+        Args:
+            keys(iterator): Проверяемые ключи
+            snapshot_keys(numpy.ndarray): Ключи снимка
+            chunk_size(int): Размер части
+
+        Returns:
+            generator: Отсутствующие ключи
+        """
+        while True:
+            chunk = list(islice(keys, chunk_size))
+            if not chunk:
+                break
+            for key, exists in izip(
+                    chunk, KeysSnapshot.contains(snapshot_keys, chunk)):
+                if not exists:
+                    yield key
+
     def processing(self):
         """
         Выявление записей на удаление
         """
         self.key = self.context['checksum']
-        source_collection = MongodbConnection().get_collection(
-                    'etl', get_table_name(STTM_DATASOURCE, self.key))
-        current_collection = MongodbConnection().get_collection(
-                    'etl', get_table_name(STTM_DATASOURCE_KEYS, self.key))
-
-        # Обновляем коллекцию всех ключей
-        all_keys_collection_name = get_table_name(STTM_DATASOURCE_KEYSALL, self.key)
-        ak_collection = MongodbConnection()
-        all_keys_collection = ak_collection.get_collection(
-            'etl', all_keys_collection_name)
-        ak_collection.set_indexes(
-            [('_state', ASCENDING), ('_deleted', ASCENDING)])
-
-        source_collection.aggregate(
-            [{"$match": {"_state": STSE.LOADED}},
-             {"$project": {"_id": "$_id", "_state": {"$literal": AKTSE.NEW}}},
-             {"$out": "%s" % all_keys_collection_name}])
-
-        limit = settings.ETL_COLLECTION_LOAD_ROWS_LIMIT
-        page = 1
-        while True:
+        store = self.get_staging_store(
+            get_table_name(STTM_DATASOURCE, self.key))
+
+        # Обновляем коллекцию удаленных ключей
+        self.get_staging_store(
+            get_table_name(STTM_DATASOURCE_KEYSALL, self.key)).drop()
+        all_keys_store = self.create_staging_store(STTM_DATASOURCE_KEYSALL)
+
+        current = KeysSnapshot(self.key, self.context['keys_snapshot'])
+        current_keys = current.load()
+        synced = KeysSnapshot.get_synced(self.key)
+
+        if synced is not None:
+            # удаленные ключи - разность снимков предыдущей и текущей загрузок
+            deleted_keys = iter(KeysSnapshot.difference(
+                synced.load(KeysSnapshot.SYNCED), current_keys).tolist())
+        else:
+            # без предыдущего снимка загруженные ключи сверяются с текущим
+            loaded_keys = store.iter_keys(STSE.LOADED)
+            deleted_keys = self.get_missing_keys(loaded_keys, current_keys)
 
-            to_delete = []
-            records_for_del = list(all_keys_collection.find(
-                    {'_state': AKTSE.NEW}, limit=limit, skip=(page-1)*limit))
-            if not len(records_for_del):
+        batch = self.get_batch_sizer()
+        while True:
+            to_delete = list(islice(deleted_keys, batch.size))
+            if not to_delete:
                 break
-            for record in records_for_del:
-                row_key = record['_id']
-                if not current_collection.find({'_id': row_key}).count():
-                    to_delete.append(row_key)
             try:
-                all_keys_collection.update_many(
-                    {'_id': {'$in': to_delete}},
-                    {'$set': {'_deleted': True}})
-
-                source_collection.delete_many({'_id': {'$in': to_delete}})
+                all_keys_store.append([
+                    {'_id': x, '_state': AKTSE.SYNCED, '_deleted': True}
+                    for x in to_delete])
+                store.delete(to_delete)
             except Exception as e:
                 self.error_handling(e.message)
+            batch.update([(x, ) for x in to_delete])
 
-            page += 1
-
-        all_keys_collection.update_many(
-            {'_state': AKTSE.NEW}, {'$set': {'_state': AKTSE.SYNCED}})
+        current.sync()
+        self.build_staging_indexes(STTM_DATASOURCE_KEYSALL)
 
         self.next_task_params = (
             DB_DELETE_REDUNDANT, delete_redundant, self.context)
@@ -848,32 +1490,201 @@ class DeleteRedundant(TaskProcessing):
 
     def processing(self):
         self.key = self.context['checksum']
-        del_collection = MongodbConnection().get_collection(
-                    'etl', get_table_name(STTM_DATASOURCE_KEYSALL, self.key))
+        del_store = self.get_staging_store(
+            get_table_name(STTM_DATASOURCE_KEYSALL, self.key))
 
-        source_table_name = get_table_name(STTM_DATASOURCE, self.key)
+        # строки удаляются из промежуточной таблицы, размерностей и мер,
+        # коллекция содержит только ключи удаленных строк
         delete_query = DeleteQuery(DataSourceService())
-        delete_query.set_query(
-            table_name=source_table_name)
+        deleted_keys = del_store.iter_keys(AKTSE.SYNCED)
+        batch = self.get_batch_sizer()
+        cube_tables = [get_table_name(x, self.key)
+                       for x in (DIMENSIONS, MEASURES)]
+        try:
+            delete_query.set_query(table_names=[
+                get_table_name(STTM_DATASOURCE, self.key)] + cube_tables)
+            # таблицы, построенные до индекса по cdc_key
+            for table_name in delete_query.table_names:
+                if table_name in cube_tables:
+                    self.create_table_index(
+                        table_name, 'cdc_key', ['cdc_key'])
+            while True:
+                keys = list(islice(deleted_keys, batch.size))
+                if not keys:
+                    break
+                delete_query.add_keys(keys)
+                batch.update([(x, ) for x in keys])
+            deleted = delete_query.execute()
+            logger.info('%s deleted rows: %s', self.__class__.__name__, deleted)
+        except Exception as e:
+            self.error_handling(e.message)
+        delete_query.release()
 
-        limit = 100
-        page = 1
-        while True:
-            delete_delta = del_collection.find(
-                {'_deleted': True},
-                limit=limit, skip=(page-1)*limit)
-            l = [record['_id'] for record in delete_delta]
-            if not l:
-                break
+        if delete_query.legacy_tables:
+            self.regenerate_cube(
+                delete_query.legacy_tables, self.context['source_id'])
+        elif not self.context['is_meta_stats']:
+            self.next_task_params = (
+                        GENERATE_DIMENSIONS, load_dimensions, self.context)
+
+
+class ApplyCdc(TaskProcessing):
+    """
+    Дозагрузка в режиме триггеров: изменения из таблиц изменений
+    источника применяются к таблице хранилища sttm_datasource_{key}.
+    Поддерживается набор из одной таблицы с первичным ключом среди
+    выбранных колонок, иначе дозагрузка идет через Mongodb
+    """
+
+    @staticmethod
+    def get_key_cols(cols, meta_info):
+        """
+        Колонки первичного ключа таблицы набора
+
+        Args:
+            cols(list): Выбранные колонки
+            meta_info(dict): Метаданные по таблицам
+
+        Returns:
+            list: Названия колонок, None, если изменения не применить
+        """
+        tables = set(x['table'] for x in cols)
+        if len(tables) != 1:
+            return None
+        primary = [x for x in meta_info[tables.pop()]['indexes']
+                   if x['is_primary']]
+        if not primary:
+            return None
+        selected = [x['col'] for x in cols]
+        if not all(x in selected for x in primary[0]['columns']):
+            return None
+        return primary[0]['columns']
+
+    @staticmethod
+    def get_sttm_key_cols(cols, key_cols):
+        """
+        Колонки первичного ключа источника в таблице хранилища
+
+        Args:
+            cols(list): Выбранные колонки
+            key_cols(list): Колонки первичного ключа таблицы набора
+
+        Returns:
+            list: Названия колонок
+        """
+        return ['{0}{1}{2}'.format(cols[0]['table'], FIELD_NAME_SEP, x)
+                for x in key_cols]
+
+    def get_cube_tables(self):
+        """
+        Колонки таблиц размерностей и мер набора данных
+
+        Returns:
+            dict: {<таблица>: [<колонки>], ...}
+        """
+        meta_data = list(DatasourceMetaKeys.objects.filter(
+            value=self.key).values('meta__collection_name', 'meta__fields'))
+        return {
+            get_table_name(task.table_prefix, self.key): ['cdc_key'] + [
+                '{0}{1}{2}'.format(table, FIELD_NAME_SEP, field['name'])
+                for table, field in task.get_actual_fields(meta_data)]
+            for task in (LoadDimensions, LoadMeasures)}
+
+    def processing(self):
+        self.key = self.context['checksum']
+        cols = json.loads(self.context['cols'])
+        col_types = json.loads(self.context['col_types'])
+        meta_info = json.loads(self.context['meta_info'])
+
+        key_cols = self.get_key_cols(cols, meta_info)
+        if key_cols is None:
+            logger.info('%s: changes of %s can not be applied by key, '
+                        'refresh through mongodb', self.__class__.__name__,
+                        self.key)
+            self.next_task_params = (
+                MONGODB_DELTA_LOAD, update_mongo_db, self.context)
+            return
+
+        source = Datasource()
+        source.set_from_dict(**self.context['source'])
+        table = cols[0]['table']
+        cdc_table_name = get_table_name(CDC_TABLE, table)
+        key_indexes = [ind for ind, x in enumerate(cols)
+                       if x['col'] in key_cols]
+
+        key_engine = self.get_key_engine(cols, meta_info)
+        normalizer = self.get_row_normalizer(cols, col_types)
+        binary_types_dict = get_binary_types_dict(cols, col_types)
+        binary_types_dict['0'] = False
+
+        # размерности и меры изменяются в транзакции пакета, удаленные
+        # и устаревшие строки удаляются, новые вставляются
+        sttm_table_name = get_table_name(STTM_DATASOURCE, self.key)
+        sttm_key_cols = self.get_sttm_key_cols(cols, key_cols)
+        apply_query = CdcApplyQuery(DataSourceService())
+        apply_query.set_query(
+            table_name=sttm_table_name,
+            cols_nums=len(cols) + 1,
+            col_types=LoadDb.get_table_types(cols, col_types),
+            key_cols=sttm_key_cols,
+            cube_tables=self.get_cube_tables())
+
+        # стоимость пакета зависит от числа изменений, а не размера таблиц:
+        # строки ищутся по индексам, таблицы, загруженные до их появления,
+        # дополняются индексами
+        self.create_table_index(sttm_table_name, 'source_key', sttm_key_cols)
+        for table_name in apply_query.cube_tables:
+            self.create_table_index(table_name, 'cdc_key', ['cdc_key'])
+
+        applied_count = 0
+        with DatabaseService.source_instance(source) as instance:
+            claimed_count = instance.claim_cdc_rows(cdc_table_name)
+            # история изменений ключа сворачивается до последней операции
+            # до передачи строк
+            self.publisher.rows_count = claimed_count - (
+                instance.compact_cdc_rows(cdc_table_name, key_cols)
+                if claimed_count else 0)
+            self.publisher.publish(TLSE.START)
+
+            batch = self.get_batch_sizer()
             try:
-                delete_query.execute(keys=l)
+                for rows in instance.stream_cdc_rows(
+                        cdc_table_name, [x['col'] for x in cols], batch):
+                    # по каждой записи применяется последняя операция
+                    changes = collapse_changes(rows, key_indexes)
+                    applied_count += len(changes)
+                    records = [values for operation, values in
+                               changes.itervalues() if operation != CDC_DELETE]
+                    # значения приводятся так же, как при загрузке
+                    data = normalizer.get_rows(records, [
+                        key_engine.key_for_row(x, 0) for x in records])
+
+                    apply_query.execute(
+                        keys=changes.keys(), data=data,
+                        binary_types_dict=binary_types_dict)
+                    batch.update(rows)
+                    self.update_progress(len(rows))
             except Exception as e:
-                self.error_handling(e.message)
-            page += 1
+                apply_query.connection.rollback()
+                pg_code = getattr(e, 'pgcode', None)
+                err_msg = '%s: ' % errorcodes.lookup(pg_code) if pg_code else ''
+                err_msg += e.message
+                self.error_handling(err_msg, pg_code)
+            apply_query.release()
 
-        if not self.context['is_meta_stats']:
-            self.next_task_params = (
-                        GENERATE_DIMENSIONS, load_dimensions, self.context)
+            logger.info(
+                '%s: %s changes of %s compacted to %s, ratio %.2f',
+                self.__class__.__name__, claimed_count, table, applied_count,
+                float(claimed_count) / applied_count if applied_count else 1.0)
+
+            # при ошибке строки остаются применяемыми до следующей дозагрузки
+            if not self.was_error:
+                instance.finish_cdc_rows(
+                    cdc_table_name, settings.ETL_CDC_PURGE_SYNCED)
+
+        # изменения в таблицы без cdc_key не применялись
+        if apply_query.legacy_tables and not self.was_error:
+            self.regenerate_cube(apply_query.legacy_tables, source.id)
 
 
 class CreateTriggers(TaskProcessing):
@@ -896,7 +1707,7 @@ class CreateTriggers(TaskProcessing):
 
         for table, columns in tables_info.iteritems():
 
-            table_name = '_etl_datasource_cdc_{0}'.format(table)
+            table_name = get_table_name(CDC_TABLE, table)
             tables_str = "('{0}')".format(table_name)
 
             cdc_cols_query = db_instance.db_map.cdc_cols_query.format(
@@ -958,15 +1769,16 @@ class CreateTriggers(TaskProcessing):
                 del_col_q = db_instance.db_map.del_column_query
 
                 for cdc_k, v in cdc_required_types.iteritems():
+                    add_type = v.get("add_type", v["type"])
                     if not cdc_k in existing_cols:
                         cursor.execute(add_col_q.format(
-                            table_name, cdc_k, v["type"], v["nullable"]))
+                            table_name, cdc_k, add_type, v["nullable"]))
                     else:
                         # если типы не совпадают
                         if not existing_cols[cdc_k].startswith(v["type"]):
                             cursor.execute(del_col_q.format(table_name, cdc_k))
                             cursor.execute(add_col_q.format(
-                                table_name, cdc_k, v["type"], v["nullable"]))
+                                table_name, cdc_k, add_type, v["nullable"]))
 
                 connection.commit()
 
@@ -988,6 +1800,10 @@ class CreateTriggers(TaskProcessing):
                 for index in exist_indexes:
                     index_name = index[index_name_i]
 
+                    # ключ автоинкремента cdc_id в mysql не удаляется
+                    if index[index_cols_i] == 'cdc_id':
+                        continue
+
                     if index_name not in required_indexes:
                         cursor.execute(drop_index_q.format(index_name, table_name))
                     else:
@@ -1040,7 +1856,7 @@ class CreateTriggers(TaskProcessing):
             connection.commit()
 
         cursor.close()
-        connection.close()
+        DatabaseService.release_instance(db_instance)
 
         self.next_task_params = (
             GENERATE_DIMENSIONS, load_dimensions, {
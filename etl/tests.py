@@ -1,19 +1,43 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import os
 import json
-from mock import patch
+import fcntl
+import shutil
+import tempfile
+import datetime
+from decimal import Decimal
+from bson.binary import Binary
+from mock import patch, MagicMock
+from pymongo.write_concern import WriteConcern
 
 from django.db import connections
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from etl.services.datasource.repository import r_server
+from MySQLdb.cursors import SSCursor
+from etl.services.db.interfaces import Database
+from etl.services.db.mysql import Mysql
 from etl.services.db.postgresql import Postgresql
 from etl.services.datasource.base import TablesTree, DataSourceService
 from core.models import Datasource, ConnectionChoices, DatasourceMeta, \
     DatasourceMetaKeys, Measure
-from etl.services.queue.base import TaskService
-from etl.constants import GENERATE_DIMENSIONS, GENERATE_MEASURES
-from etl.tasks import LoadDimensions, LoadMeasures
+from etl.services.queue.base import TaskService, get_keyset_columns, \
+    get_root_key_column, MongodbConnection, \
+    BatchSizer, BatchPipeline, CopyQuery, MergeQuery, RowNormalizer, \
+    RowKeyEngine, \
+    KeysBloomFilter, collapse_changes, StagingReader, CdcApplyQuery, \
+    TableIndexQuery, RowsPager
+from etl.services.middleware.base import split_key_range
+from core.exceptions import TaskError
+from etl.services.db.pool import ConnectionPool, MongoClientRegistry
+from etl.services.queue.snapshot import KeysSnapshot
+from etl.services.queue.staging import MongoStagingStore, \
+    SegmentStagingStore, get_staging_store, STAGING_INDEXES
+from etl.constants import GENERATE_DIMENSIONS, GENERATE_MEASURES, \
+    CDC_INSERT, CDC_UPDATE, CDC_DELETE, STTM_DATASOURCE_DELTA
+from etl.tasks import LoadDimensions, LoadMeasures, UpdateMongodb, ApplyCdc, \
+    LoadMongodbPartition
 
 """
 Тестирование etl методов
@@ -112,6 +136,782 @@ class DatabaseTest(TestCase):
                          },
                          "Результат статистики неверен!")
 
+    def test_keyset_rows_query(self):
+        structure = {'childs': [], 'joins': [], 'join_type': 'inner',
+                     'val': 'billing_bank_packet'}
+        cols = [{'table': 'billing_bank_packet', 'col': 'name'},
+                {'table': 'billing_bank_packet', 'col': 'id'}]
+        key_cols = [{'table': 'billing_bank_packet', 'col': 'id'},
+                    {'table': 'billing_bank_packet', 'col': 'num'}]
+
+        query = self.database.get_keyset_rows_query(cols, structure, key_cols)
+        self.assertEqual(
+            ' '.join(query.split()),
+            'SELECT "billing_bank_packet"."name", "billing_bank_packet"."id" '
+            'FROM "billing_bank_packet" {0} ORDER BY '
+            '"billing_bank_packet"."id", "billing_bank_packet"."num" '
+            'LIMIT {1};')
+
+        condition = self.database.get_keyset_condition(key_cols)
+        self.assertEqual(
+            condition,
+            '("billing_bank_packet"."id" > %s) OR '
+            '("billing_bank_packet"."id" = %s AND '
+            '"billing_bank_packet"."num" > %s)')
+        self.assertEqual(
+            self.database.get_keyset_params([10, 'a']), [10, 10, 'a'])
+
+    def test_cdc_compact_query(self):
+        query = self.database.get_cdc_compact_query(
+            '_etl_datasource_cdc_t', ['id', 'num'])
+        self.assertIn('FROM "_etl_datasource_cdc_t" n', query)
+        self.assertIn(
+            't."id" = n."id" AND t."num" = n."num" AND '
+            'n."cdc_id" > t."cdc_id"', query)
+        self.assertIn('t."cdc_synced" = 2 AND n."cdc_synced" = 2', query)
+
+    def test_stream_cdc_rows(self):
+        with patch.object(self.database, 'stream_query') as stream_query:
+            self.database.stream_cdc_rows('_etl_datasource_cdc_t', ['id'], 10)
+        # порядок записи по индексу (cdc_synced, cdc_id)
+        stream_query.assert_called_once_with(
+            'SELECT "id", "cdc_delta_flag" FROM "_etl_datasource_cdc_t" '
+            'WHERE "cdc_synced" = 2 ORDER BY "cdc_id"', 10)
+
+    def test_stream_query(self):
+        connection = self.database.connection = MagicMock()
+        cursor = connection.cursor.return_value
+        cursor.fetchmany.side_effect = [[(1, ), (2, )], [(3, )], []]
+        batch = MagicMock(size=2)
+        batches = []
+        for rows in self.database.stream_query('SELECT 1', batch):
+            batches.append(rows)
+            batch.size = 5
+        self.assertEqual(batches, [[(1, ), (2, )], [(3, )]])
+        # адаптивный размер пакета перечитывается перед каждым пакетом
+        self.assertEqual([x[0][0] for x in cursor.fetchmany.call_args_list],
+                         [2, 5, 5])
+        # именованный (серверный) курсор postgresql
+        self.assertTrue(connection.cursor.call_args[1]['name'].startswith(
+            'etl_stream_'))
+        self.assertEqual(cursor.itersize, 2)
+        cursor.close.assert_called_once_with()
+
+    def test_stream_query_close(self):
+        connection = self.database.connection = MagicMock()
+        cursor = connection.cursor.return_value
+        cursor.execute.side_effect = Exception('canceling statement')
+        self.assertRaises(
+            Exception, list, self.database.stream_query('SELECT 1', 10))
+        cursor.close.assert_called_once_with()
+
+        # курсор закрывается и при прерванном чтении
+        cursor.reset_mock()
+        cursor.execute.side_effect = None
+        cursor.fetchmany.return_value = [(1, )]
+        rows = self.database.stream_query('SELECT 1', 10)
+        next(rows)
+        rows.close()
+        cursor.close.assert_called_once_with()
+
+    def test_stream_cursor(self):
+        # небуферизованный курсор mysql
+        with patch.object(Mysql, 'get_connection', return_value=MagicMock()):
+            database = Mysql({})
+        cursor = database.get_stream_cursor(10)
+        database.connection.cursor.assert_called_once_with(SSCursor)
+        self.assertEqual(cursor.arraysize, 10)
+
+        # источники без серверных курсоров читают обычным курсором
+        # пакетами по arraysize
+        with patch.object(Database, 'get_connection',
+                          return_value=MagicMock()):
+            database = Database({})
+        cursor = database.get_stream_cursor(10)
+        database.connection.cursor.assert_called_once_with()
+        self.assertEqual(cursor.arraysize, 10)
+
+    def test_rows_pager_release(self):
+        source_service = MagicMock()
+        source_instance = source_service.source_instance.return_value
+        source_instance.__exit__.return_value = False
+        cursor = source_instance.__enter__.return_value.connection.cursor()
+        cursor.fetchall.side_effect = [[(1, )], Exception('connection lost')]
+        pager = RowsPager(
+            source_service, None, 'SELECT 1 LIMIT {0} OFFSET {1}', 1)
+        pages = iter(pager)
+        self.assertEqual(next(pages), [(1, )])
+        self.assertRaises(Exception, next, pages)
+        # соединение возвращается в пул и при ошибке чтения
+        self.assertEqual(source_instance.__exit__.call_count, 1)
+        self.assertIsNone(pager.connection)
+
+    def test_keyset_columns(self):
+        structure = {'childs': [{'childs': [], 'joins': [], 'join_type': 'inner',
+                                 'val': 'child'}],
+                     'joins': [], 'join_type': 'inner', 'val': 'root'}
+        meta_info = {
+            'root': {'indexes': [
+                {'is_primary': True, 'columns': ['id'], 'name': 'root_pkey'}]},
+            'child': {'indexes': [
+                {'is_primary': True, 'columns': ['a', 'b'], 'name': 'child_pkey'}]},
+        }
+        self.assertEqual(get_keyset_columns(structure, meta_info), [
+            {'table': 'root', 'col': 'id'},
+            {'table': 'child', 'col': 'a'},
+            {'table': 'child', 'col': 'b'},
+        ])
+
+        # без первичного ключа остается LIMIT/OFFSET
+        meta_info['child']['indexes'][0]['is_primary'] = False
+        self.assertIsNone(get_keyset_columns(structure, meta_info))
+
+    def test_root_key_column(self):
+        structure = {'childs': [], 'joins': [], 'join_type': 'inner',
+                     'val': 'root'}
+        meta_info = {'root': {'indexes': [
+            {'is_primary': True, 'columns': ['id'], 'name': 'root_pkey'}]}}
+        self.assertEqual(
+            get_root_key_column(structure, meta_info, {'root.id': 'integer'}),
+            {'table': 'root', 'col': 'id'})
+
+        # по текстовому ключу диапазоны не строятся
+        self.assertIsNone(
+            get_root_key_column(structure, meta_info, {'root.id': 'text'}))
+
+    def test_split_key_range(self):
+        """
+        Разбиение диапазона ключа на части для параллельной загрузки
+        """
+        self.assertEqual(split_key_range(1, 100, 4),
+                         [(1, 26), (26, 51), (51, 76), (76, None)])
+        # частей не больше, чем значений ключа
+        self.assertEqual(split_key_range(5, 6, 4), [(5, 6), (6, None)])
+        self.assertEqual(split_key_range(7, 7, 4), [(7, None)])
+
+    def test_catalog_rows_number(self):
+        """
+        Оценка числа строк по статистике каталога
+        """
+        structure = {'childs': [{'childs': [], 'joins': [], 'join_type': 'inner',
+                                 'val': 'child'}],
+                     'joins': [], 'join_type': 'inner', 'val': 'root'}
+        self.assertEqual(self.database.get_structure_tables(structure),
+                         ['root', 'child'])
+
+        with patch.object(self.database, 'get_statistic') as stats_mock:
+            stats_mock.return_value = {
+                'root': {'count': 10, 'size': 8192},
+                'child': {'count': 1000, 'size': 65536},
+            }
+            self.assertEqual(
+                self.database.get_catalog_rows_number(None, structure), 1000)
+            stats_mock.assert_called_once_with(None, ['root', 'child'])
+
+
+class ConnectionPoolTest(TestCase):
+    """
+    Тестирование пула подключений
+    """
+
+    def setUp(self):
+        self.pool = ConnectionPool(max_size=1, idle_timeout=60)
+        self.connection = {'host': 'localhost', 'port': 5432, 'db': 'test',
+                           'login': 'foo', 'password': 'bar', 'conn_type': 1}
+        self.factory = MagicMock(side_effect=lambda **kwargs: MagicMock())
+
+    def test_reuse(self):
+        instance = self.pool.acquire(self.connection, self.factory)
+        self.pool.release(instance)
+        self.assertIs(self.pool.acquire(self.connection, self.factory),
+                      instance)
+        self.assertEqual(self.factory.call_count, 1)
+        instance.connection.rollback.assert_called_once_with()
+
+    def test_max_size(self):
+        first = self.pool.acquire(self.connection, self.factory)
+        second = self.pool.acquire(self.connection, self.factory)
+        self.pool.release(first)
+        self.pool.release(second)
+        # сверх max_size соединение закрывается
+        second.connection.close.assert_called_once_with()
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_dead_connection(self):
+        instance = self.pool.acquire(self.connection, self.factory)
+        instance.is_alive.return_value = False
+        self.pool.release(instance)
+        self.assertIsNot(self.pool.acquire(self.connection, self.factory),
+                         instance)
+        instance.connection.close.assert_called_once_with()
+
+
+class MongoClientRegistryTest(TestCase):
+    """
+    Тестирование реестра клиентов Mongodb
+    """
+
+    def test_shared_client(self):
+        factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+        registry = MongoClientRegistry(factory, maxPoolSize=10, w=1)
+        client = registry.get_client('localhost', 27017)
+        self.assertIs(registry.get_client('localhost', '27017'), client)
+        factory.assert_called_once_with('localhost', 27017, maxPoolSize=10, w=1)
+        self.assertEqual(registry.get_stats(), {
+            'clients': 1, 'created': 1, 'borrowed': 2, 'pool_size': 10})
+
+        registry.clear()
+        client.close.assert_called_once_with()
+        self.assertIsNot(registry.get_client('localhost', 27017), client)
+
+
+class StagingDurabilityTest(TestCase):
+    """
+    Тестирование профилей надежности записи промежуточных коллекций
+    """
+
+    @override_settings(ETL_STAGING_DURABILITY_PROFILES={
+        'safe': {'w': 'majority', 'j': True}})
+    def test_profile(self):
+        client = MagicMock()
+        with patch.object(MongodbConnection.registry, 'get_client',
+                          return_value=client):
+            collection = MongodbConnection('safe').get_collection(
+                'etl', 'sttm_datasource_1')
+            self.assertIs(MongodbConnection().get_collection(
+                'etl', 'sttm_datasource_1'), client['etl']['sttm_datasource_1'])
+
+        client['etl']['sttm_datasource_1'].with_options.assert_called_once_with(
+            write_concern=WriteConcern(w='majority', j=True))
+        self.assertIs(
+            collection,
+            client['etl']['sttm_datasource_1'].with_options.return_value)
+
+
+@override_settings(ETL_ADAPTIVE_BATCH=True, ETL_BATCH_MIN_ROWS=10,
+                   ETL_BATCH_MAX_ROWS=10000, ETL_BATCH_TARGET_LATENCY=1.0)
+class BatchSizerTest(TestCase):
+    """
+    Тестирование адаптивного размера пакета
+    """
+
+    @patch('etl.services.queue.base.time.time')
+    def test_update(self, time_mock):
+        rows = [(1, 'a' * 1000)] * 100
+
+        time_mock.return_value = 0
+        with override_settings(ETL_BATCH_MEMORY_BUDGET=10 ** 9):
+            batch = BatchSizer(100)
+        # быстрый пакет: рост не больше чем вдвое
+        time_mock.return_value = 0.1
+        self.assertEqual(batch.update(rows), 200)
+        # медленный пакет: уменьшаем под целевое время
+        time_mock.return_value = 4.1
+        self.assertEqual(batch.update(rows), 25)
+        self.assertEqual([x[0] for x in batch.history], [200, 25])
+
+        # пакет ограничен бюджетом памяти
+        batch.memory_budget = BatchSizer.get_row_size(rows[0]) * 50
+        time_mock.return_value = 4.2
+        self.assertEqual(batch.update(rows), 50)
+
+
+class BatchPipelineTest(TestCase):
+    """
+    Тестирование конвейера чтение/преобразование/запись
+    """
+
+    def run_pipeline(self, batches, write):
+        written = []
+        errors = []
+        BatchPipeline(lambda x: [i * 2 for i in x], write,
+                      writers=2, depth=1).run(
+            batches, on_written=written.append, on_error=errors.append)
+        return written, errors
+
+    def test_run(self):
+        batches = [range(i, i + 3) for i in xrange(0, 30, 3)]
+        for threaded in (True, False):
+            with override_settings(ETL_PIPELINE_EXTRACTION=threaded):
+                written, errors = self.run_pipeline(batches, sum)
+            self.assertEqual(sorted(written),
+                             sorted(sum(x) * 2 for x in batches))
+            self.assertEqual(errors, [])
+
+    def test_write_error(self):
+        def write(data):
+            if data[0] == 6:
+                raise ValueError('write error')
+            return len(data)
+
+        with override_settings(ETL_PIPELINE_EXTRACTION=True):
+            written, errors = self.run_pipeline([[1], [3], [5]], write)
+        self.assertEqual(written, [1, 1])
+        self.assertEqual([e.message for e in errors], ['write error'])
+
+    def test_read_error(self):
+        def batches():
+            yield [1]
+            raise ValueError('read error')
+
+        with override_settings(ETL_PIPELINE_EXTRACTION=True):
+            with self.assertRaises(ValueError):
+                self.run_pipeline(batches(), len)
+
+
+class CopyQueryTest(TestCase):
+    """
+    Тестирование кодирования данных для COPY
+    """
+
+    def setUp(self):
+        self.query = CopyQuery(None)
+        self.query.cols_nums = 4
+
+    def test_text_stream(self):
+        rows = [{'0': 'key', '1': 'a\tb\\c', '2': None, '3': b'\x00\xff'},
+                ('key2', datetime.datetime(2016, 1, 2, 3, 4, 5), 1.5, None)]
+        stream = self.query.get_text_stream(rows, [False, False, False, True])
+        self.assertEqual(
+            stream.getvalue(),
+            b'key\ta\\tb\\\\c\t\\N\t\\\\x00ff\n'
+            b'key2\t2016-01-02T03:04:05\t1.5\t\\N\n')
+
+    def test_binary_stream(self):
+        self.query.col_types = ['text', 'integer', 'timestamp', 'bytea']
+        stream = self.query.get_binary_stream(
+            [('k', 1, datetime.datetime(2000, 1, 2), None)])
+        self.assertEqual(
+            stream.getvalue(),
+            CopyQuery.binary_header +
+            b'\x00\x04' +
+            b'\x00\x00\x00\x01k' +
+            b'\x00\x00\x00\x04\x00\x00\x00\x01' +
+            b'\x00\x00\x00\x08\x00\x00\x00\x14\x1d\xd7\x60\x00' +
+            b'\xff\xff\xff\xff' +
+            CopyQuery.binary_trailer)
+
+
+class RowKeyEngineTest(TestCase):
+    """
+    Тестирование расчета ключей строк
+    """
+
+    def setUp(self):
+        self.cols = [{'table': 'a', 'col': 'id'}, {'table': 'a', 'col': 'data'},
+                     {'table': 'b', 'col': 'name'}]
+        self.meta_info = {
+            'a': {'indexes': [{'is_primary': True, 'columns': ['id']}]},
+            'b': {'indexes': []},
+        }
+
+    def test_keys_for_batch(self):
+        engine = RowKeyEngine(self.cols, self.meta_info)
+        self.assertEqual(engine.plans, [([0, 1], True), ([2], False)])
+
+        rows = [(1, b'\x00\xff', 'x'), (1, b'\x00\xff', 'x'), (2, None, None)]
+        keys = engine.keys_for_batch(rows, 5)
+        # без первичного ключа у таблицы b одинаковые строки различаются
+        # по номеру
+        self.assertEqual(len(set(keys)), 3)
+        self.assertEqual(keys[0], engine.key_for_row(rows[0], 5))
+        self.assertTrue(all(-2 ** 63 <= x < 2 ** 63 for x in keys))
+        self.assertEqual(engine.collisions, 0)
+
+    def test_collisions(self):
+        engine = RowKeyEngine(self.cols[:2], {'a': self.meta_info['a']})
+        keys = engine.keys_for_batch([(1, 'x'), (1, 'x'), (2, 'x')], 0)
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(engine.collisions, 1)
+
+        engine.add_collisions(2)
+        self.assertEqual(engine.collisions, 3)
+
+
+class MergeQueryTest(TestCase):
+    """
+    Тестирование запросов вставки с обновлением
+    """
+
+    def get_query(self, server_version):
+        query = MergeQuery(None)
+        query.local_instance = MagicMock()
+        query.local_instance.connection.server_version = server_version
+        query.set_query(table_name='sttm', col_names=['cdc_key', 'a', 'b'],
+                        col_types=['text', 'integer', 'text'])
+        return query
+
+    def test_upsert(self):
+        query = self.get_query(90500)
+        self.assertEqual(query.query, 'COPY etl_merge_sttm FROM STDIN')
+        self.assertEqual(query.merge_queries, [
+            'INSERT INTO sttm SELECT s.* FROM '
+            '(SELECT DISTINCT ON (cdc_key) * FROM etl_merge_sttm) s '
+            'ON CONFLICT (cdc_key) DO UPDATE SET '
+            '"a" = EXCLUDED."a", "b" = EXCLUDED."b"'])
+
+    def test_update_insert(self):
+        query = self.get_query(90400)
+        self.assertEqual(len(query.merge_queries), 2)
+        self.assertTrue(query.merge_queries[0].startswith('UPDATE sttm t SET'))
+        self.assertIn('WHERE NOT EXISTS', query.merge_queries[1])
+
+
+class ExistingKeysTest(TestCase):
+    """
+    Тестирование проверки загруженных ключей при обновлении
+    """
+
+    def test_bloom_filter(self):
+        keys_filter = KeysBloomFilter(100, 0.01)
+        for key in xrange(-50, 50):
+            keys_filter.add(key * 2 ** 40)
+        self.assertTrue(all(key * 2 ** 40 in keys_filter
+                            for key in xrange(-50, 50)))
+        self.assertLess(
+            sum(key in keys_filter for key in xrange(1, 1001)), 50)
+
+    def test_get_existing_keys(self):
+        store = MagicMock()
+        store.find_existing.return_value = {1, 3}
+
+        self.assertEqual(
+            UpdateMongodb.get_existing_keys(store, [1, 2, 3]), {1, 3})
+        store.find_existing.assert_called_once_with([1, 2, 3])
+
+        # ключей нет в фильтре - запрос не выполняется
+        store.find_existing.reset_mock()
+        keys_filter = KeysBloomFilter(10, 0.01)
+        self.assertEqual(UpdateMongodb.get_existing_keys(
+            store, [1, 2, 3], keys_filter), set())
+        self.assertFalse(store.find_existing.called)
+
+
+class StagingStoreTest(TestCase):
+    """
+    Тестирование промежуточных хранилищ
+    """
+
+    def setUp(self):
+        self.staging_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.staging_dir)
+
+    def test_mongo_store(self):
+        client = MagicMock()
+        collection = client['etl']['sttm_datasource_1']
+        collection.find.return_value = [{'_id': 1}, {'_id': 3}]
+        with patch.object(MongodbConnection.registry, 'get_client',
+                          return_value=client):
+            store = MongoStagingStore('sttm_datasource_1')
+            self.assertEqual(store.find_existing([1, 2, 3]), {1, 3})
+            store.set_state('loaded', 'idle', (1, 3))
+
+        collection.find.assert_called_once_with(
+            {'_id': {'$in': [1, 2, 3]}}, {'_id': 1})
+        collection.update_many.assert_called_once_with(
+            {'_state': 'idle', '_id': {'$gte': 1, '$lte': 3}},
+            {'$set': {'_state': 'loaded'}})
+
+    def test_segment_store(self):
+        with override_settings(ETL_STAGING_DIR=self.staging_dir,
+                               ETL_STAGING_BACKEND='segments',
+                               ETL_STAGING_SEGMENT_SIZE=1):
+            store = get_staging_store('sttm_datasource_1')
+            self.assertIsInstance(store, SegmentStagingStore)
+            store.create(schema=['t__id'])
+            self.assertEqual(store.get_schema(), ['t__id'])
+
+            # каждая запись - часть индекса, повторы ключей пропускаются
+            self.assertEqual(store.append([
+                {'_id': x, '_state': 'idle', 'v': [x]}
+                for x in (5, 3, -2 ** 63)]), 0)
+            self.assertEqual(store.append([
+                {'_id': 3, '_state': 'idle', 'v': [0]},
+                {'_id': 7, '_state': 'idle', 'v': [7]}]), 1)
+            self.assertEqual(store.find_existing([3, 7, 9]), {3, 7})
+            self.assertEqual([x.size for x in store.get_runs()], [3, 1])
+            self.assertEqual(store.get_segment_numbers(), [0, 1])
+
+            # части читаются по возрастанию ключа
+            self.assertEqual([(x['_id'], x['v']) for x in store.scan('idle')],
+                             [(-2 ** 63, [-2 ** 63]), (3, [3]), (5, [5]),
+                              (7, [7])])
+
+            self.assertEqual(store.set_state('loaded', 'idle', (3, 5)), 2)
+            self.assertEqual(list(store.iter_keys('idle')), [-2 ** 63, 7])
+
+            # после загрузки индекс сливается в одну часть
+            store.create([('_state', 1)])
+            self.assertEqual([x.size for x in store.get_runs()], [4])
+
+            # удаление во время обхода ключей, как в DetectRedundant
+            for key in store.iter_keys():
+                if key in (5, 7):
+                    store.delete([key])
+            self.assertEqual(store.count(), 2)
+            self.assertEqual(store.get_segment_numbers(), [0, 1])
+
+            # удалено больше половины - коллекция переписывается
+            store.delete([-2 ** 63])
+            self.assertEqual(store.get_segment_numbers(), [2])
+            self.assertEqual([x.size for x in store.get_runs()], [1])
+            self.assertEqual([(x['_id'], x['_state'], x['v'])
+                              for x in store.scan()], [(3, 'loaded', [3])])
+
+            # обход держит разделяемую блокировку, запись других
+            # процессов ждет его окончания
+            documents = store.scan()
+            next(documents)
+            with open(os.path.join(store.path, '.lock')) as lock_file:
+                self.assertRaises(IOError, fcntl.flock, lock_file,
+                                  fcntl.LOCK_EX | fcntl.LOCK_NB)
+                documents.close()
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            store.drop()
+            self.assertEqual(store.count(), 0)
+            self.assertIsNone(store.get_schema())
+
+    @override_settings(ETL_STAGING_DEFERRED_INDEXES=True)
+    def test_deferred_indexes(self):
+        task = UpdateMongodb(1, 'channel')
+        task.context, task.key = {}, 'key'
+        store = MagicMock()
+        with patch('etl.tasks.get_staging_store', return_value=store):
+            # индексы строятся только после загрузки
+            task.create_staging_store(STTM_DATASOURCE_DELTA)
+            store.create.assert_called_once_with(None, None)
+            task.build_staging_indexes(STTM_DATASOURCE_DELTA)
+            store.create.assert_called_with([('_state', 1)])
+
+        # индексы полей, которые задачи не читают, не строятся
+        self.assertFalse([x for indexes in STAGING_INDEXES.values()
+                          for x in indexes if x[0] == '_date'])
+
+
+class LoadMongodbPartitionTest(TestCase):
+    """
+    Тестирование частей параллельной загрузки
+    """
+
+    def test_failed_partition(self):
+        task = LoadMongodbPartition(2, 'channel')
+        task.key, task.queue_storage = 'key', {}
+        task.context = {
+            'cols': '[]', 'tree': {}, 'source': {}, 'meta_info': '{}',
+            'rows_count': 10, 'parent_task_id': 1, 'parent_channel': 'parent',
+            'partition_condition': 'id < 10', 'partitions_count': 2,
+            'keys_snapshot': 1}
+        with patch.object(LoadMongodbPartition, 'extract',
+                          side_effect=Exception('connection lost')), \
+                patch('etl.tasks.RPublish'), \
+                patch('etl.tasks.TaskService') as task_service, \
+                patch('etl.tasks.RedisSourceService') as redis_service:
+            # часть с ошибкой завершается последней
+            redis_service.finish_queue_partition.return_value = True
+            redis_service.get_failed_partitions.return_value = 1
+            task.processing()
+
+        redis_service.finish_queue_partition.assert_called_once_with(1, True)
+        redis_service.delete_queue_partitions.assert_called_once_with(1)
+        # родительская задача переводится в статус ошибки,
+        # загрузка в базу не запускается
+        self.assertIn(1, [x[0][0] for x in
+                          task_service.update_task_status.call_args_list])
+        self.assertTrue(task.was_error)
+        self.assertIsNone(task.next_task_params)
+
+
+class KeysSnapshotTest(TestCase):
+    """
+    Тестирование снимков ключей строк
+    """
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_snapshots(self):
+        with override_settings(ETL_KEYS_SNAPSHOT_DIR=self.snapshot_dir):
+            self.assertIsNone(KeysSnapshot.get_synced('key'))
+
+            # части загрузки пишутся отдельно и собираются в один массив
+            snapshot = KeysSnapshot('key', 1)
+            writer = snapshot.get_writer(1)
+            writer.write([5, 3, -2 ** 63])
+            writer.close()
+            # часть второго воркера не видна: снимок не собирается
+            self.assertRaises(TaskError, snapshot.finish, 2)
+            writer = snapshot.get_writer(2)
+            writer.write([7, 3])
+            writer.close()
+            snapshot.finish(2)
+            self.assertEqual(snapshot.load().tolist(), [-2 ** 63, 3, 5, 7])
+            snapshot.sync()
+
+            current = KeysSnapshot('key', 2)
+            writer = current.get_writer(2)
+            writer.write([3, 7, 9])
+            writer.close()
+            current.finish()
+
+            synced = KeysSnapshot.get_synced('key')
+            self.assertEqual(synced.run, 1)
+            synced_keys = synced.load(KeysSnapshot.SYNCED)
+            self.assertEqual(KeysSnapshot.difference(
+                synced_keys, current.load()).tolist(), [-2 ** 63, 5])
+            self.assertEqual(KeysSnapshot.contains(
+                synced_keys, [9, 7, 2 ** 62]).tolist(), [False, True, False])
+
+            # синхронизация удаляет предыдущие снимки
+            current.sync()
+            self.assertEqual(KeysSnapshot.get_synced('key').run, 2)
+            self.assertFalse(os.path.exists(synced.get_path(KeysSnapshot.SYNCED)))
+
+
+class ApplyCdcTest(TestCase):
+    """
+    Тестирование применения изменений триггеров
+    """
+
+    def test_collapse_changes(self):
+        rows = [(1, 'a', CDC_INSERT), (2, 'b', CDC_INSERT),
+                (1, 'c', CDC_UPDATE), (2, 'b', CDC_DELETE),
+                (1, 'd', CDC_UPDATE)]
+        changes = collapse_changes(rows, [0])
+        self.assertEqual(changes.items(), [
+            ((2, ), (CDC_DELETE, (2, 'b'))),
+            ((1, ), (CDC_UPDATE, (1, 'd')))])
+
+    def test_key_cols(self):
+        cols = [{'table': 't', 'col': 'id'}, {'table': 't', 'col': 'name'}]
+        meta_info = {'t': {'indexes': [
+            {'is_primary': True, 'columns': ['id']}]}}
+        self.assertEqual(ApplyCdc.get_key_cols(cols, meta_info), ['id'])
+        # первичный ключ не выбран
+        self.assertIsNone(ApplyCdc.get_key_cols(cols[1:], meta_info))
+        # несколько таблиц
+        self.assertIsNone(ApplyCdc.get_key_cols(
+            cols + [{'table': 'u', 'col': 'id'}], meta_info))
+        self.assertEqual(ApplyCdc.get_sttm_key_cols(cols, ['id']), ['t__id'])
+
+    def test_table_index(self):
+        query = TableIndexQuery(None)
+        query.local_instance = MagicMock()
+        cursor = query.local_instance.connection.cursor.return_value
+        query.set_query(table_name='sttm', index_name='sttm_source_key_index',
+                        columns=['t__id'])
+        cursor.fetchall.return_value = []
+        query.execute()
+        self.assertEqual(
+            cursor.execute.call_args[0][0],
+            'CREATE INDEX sttm_source_key_index ON sttm ("t__id")')
+
+        # существующий индекс не пересоздается
+        cursor.execute.reset_mock()
+        cursor.fetchall.return_value = [(1, )]
+        query.execute()
+        self.assertEqual(cursor.execute.call_count, 1)
+
+    def test_cube_tables(self):
+        query = CdcApplyQuery(None)
+        query.local_instance = MagicMock()
+        connection = query.local_instance.connection
+        cursor = connection.cursor.return_value
+        # таблица мер построена без cdc_key, удаленная строка - k1
+        cursor.fetchall.side_effect = [
+            [('dims', True), ('measures', False)], [('k1', )]]
+        query.set_query(
+            table_name='sttm', cols_nums=3, col_types=None,
+            key_cols=['t__id'], cube_tables={
+                'dims': ['cdc_key', 't__name'], 'measures': ['cdc_key']})
+        self.assertEqual(query.legacy_tables, ['measures'])
+        self.assertEqual(query.cube_queries, [(
+            'DELETE FROM dims WHERE cdc_key IN %s',
+            'INSERT INTO dims ("cdc_key", "t__name") '
+            'SELECT "cdc_key", "t__name" FROM sttm WHERE cdc_key IN %s')])
+
+        cursor.execute.reset_mock()
+        with patch.object(CopyQuery, 'execute') as copy_execute:
+            query.execute(keys=[(1, )], data=[('k2', 1, 'b')])
+        copy_execute.assert_called_once_with(
+            data=[('k2', 1, 'b')], binary_types_dict=None, commit=False)
+        # размерности меняются в той же транзакции
+        self.assertEqual([x[0][1] for x in cursor.execute.call_args_list],
+                         [((1, ), ), (('k1', ), ), (('k2', ), )])
+        connection.commit.assert_called_once_with()
+
+
+class RowNormalizerTest(TestCase):
+    """
+    Тестирование приведения строк источника к документам Mongodb
+    """
+
+    def test_get_documents(self):
+        cols = [{'table': 't', 'col': 'id'}, {'table': 't', 'col': 'name'},
+                {'table': 't', 'col': 'price'}, {'table': 't', 'col': 'day'},
+                {'table': 't', 'col': 'data'}]
+        col_types = {'t.id': 'integer', 't.name': 'text',
+                     't.price': 'double precision', 't.day': 'timestamp',
+                     't.data': 'binary'}
+        normalizer = RowNormalizer(cols, col_types)
+        # целые и строки не преобразуются
+        self.assertEqual([x[0] for x in normalizer.converters], [2, 3, 4])
+
+        rows = [(1, 'a', Decimal('1.5'), datetime.date(2016, 1, 2), b'\x00'),
+                (2, None, None, None, None)]
+        docs = normalizer.get_documents(rows, [10, 20], 'idle', '01.01.2016')
+
+        self.assertEqual(docs[0]['_id'], 10)
+        self.assertEqual(docs[0]['_state'], 'idle')
+        self.assertEqual(docs[0]['t__price'], 1.5)
+        self.assertEqual(docs[0]['t__day'], '02.01.2016')
+        self.assertIsInstance(docs[0]['t__data'], Binary)
+        self.assertEqual(docs[1], {
+            '_id': 20, '_state': 'idle', '_date': '01.01.2016', 't__id': 2,
+            't__name': None, 't__price': None, 't__day': None,
+            't__data': None})
+        self.assertEqual(normalizer.rows_count, 2)
+        self.assertEqual(normalizer.get_documents([], [], 'idle', ''), [])
+
+    def test_get_rows(self):
+        cols = [{'table': 't', 'col': 'id'}, {'table': 't', 'col': 'day'}]
+        col_types = {'t.id': 'integer', 't.day': 'timestamp'}
+        normalizer = RowNormalizer(cols, col_types)
+        # значения приводятся так же, как в документах
+        self.assertEqual(normalizer.get_rows(
+            [(1, datetime.date(2016, 1, 2)), (2, None)], [10, 20]),
+            [(10, 1, '02.01.2016'), (20, 2, None)])
+        self.assertEqual(normalizer.get_rows([], []), [])
+
+    def test_compact_documents(self):
+        cols = [{'table': 't', 'col': 'id'}, {'table': 't', 'col': 'price'}]
+        col_types = {'t.id': 'integer', 't.price': 'double precision'}
+        normalizer = RowNormalizer(cols, col_types, compact=True)
+        docs = normalizer.get_documents(
+            [(1, Decimal('1.5')), (2, None)], [10, 20], 'idle', '01.01.2016')
+        self.assertEqual(docs, [
+            {'_id': 10, '_state': 'idle', '_date': '01.01.2016', 'v': [1, 1.5]},
+            {'_id': 20, '_state': 'idle', '_date': '01.01.2016', 'v': [2, None]}])
+
+    def test_staging_reader(self):
+        reader = StagingReader(['t__price', 't__id'], ['t__id', 't__price'])
+        self.assertEqual(reader.projection, {
+            '_id': True, 'v': True, 't__id': True, 't__price': True})
+        # компактный документ и документ прежнего формата
+        self.assertEqual(reader.get_row({'_id': 10, 'v': [1, 1.5]}),
+                         (10, 1.5, 1))
+        self.assertEqual(
+            reader.get_row({'_id': 20, 't__id': 2, 't__price': None}),
+            (20, None, 2))
+
+        reader = StagingReader(['t__id'])
+        self.assertEqual(reader.get_row({'_id': 10, 't__id': 1}), (10, 1))
+
 
 class TablesTreeTest(TestCase):
     """
@@ -561,6 +1361,7 @@ class DimCreateTest(TestCase):
             drop table if exists sttm_datasource_123456789;
 
             create table sttm_datasource_123456789(
+              cdc_key text UNIQUE,
               table1__id serial NOT NULL,
               table1__arguments text NOT NULL,
               table1__comment character varying(1024),
@@ -599,7 +1400,11 @@ class DimCreateTest(TestCase):
 
         measures_info = self.cursor.fetchall()
 
-        self.assertEqual(len(dim_info) + len(measures_info), 4)
+        # в обеих таблицах есть ключ строки cdc_key
+        self.assertIn(('cdc_key', 'text'), dim_info)
+        self.assertIn(('cdc_key', 'text'), measures_info)
+        measures_info.remove(('cdc_key', 'text'))
+        self.assertEqual(len(dim_info) + len(measures_info), 5)
 
         for el in dim_info:
             self.assertTrue(el[1] in ['text'])
@@ -729,3 +1534,22 @@ class DatasourceMetaTest(TestCase):
         }
         self.assertEqual(json.loads(dsm.stats), dsm_stats)
         self.assertEqual(json.loads(dsm.fields), dsm_fields)
+
+    def test_source_meta_watermark(self):
+        """
+        Граница ключа сохраняется у корневой таблицы и переживает
+        последующие загрузки без новой границы
+        """
+        key = str(self.key)
+        DataSourceService.update_datasource_meta(
+            key, self.source, self.cols, self.meta_info, self.last_row, 1,
+            watermark=('datasources', 4))
+        self.assertEqual(
+            DataSourceService.get_watermark(self.source, 'datasources', key), 4)
+        self.assertIsNone(DataSourceService.get_watermark(
+            self.source, 'datasources_meta', key))
+
+        DataSourceService.update_datasource_meta(
+            key, self.source, self.cols, self.meta_info, self.last_row, 1)
+        self.assertEqual(
+            DataSourceService.get_watermark(self.source, 'datasources', key), 4)
@@ -402,8 +402,9 @@ class LoadDataView(BaseEtlView):
         """
 
         # подключение к источнику данных
-        source_conn = helpers.DataSourceService.get_source_connection(source)
-        if not source_conn:
+        try:
+            helpers.DataSourceService.check_source_connection(source)
+        except ValueError:
             raise ResponseError(u'Не удалось подключиться к источнику данных!', ExceptionCode.ERR_CONNECT_TO_DATASOURCE)
 
         # копия, чтобы могли добавлять
@@ -417,7 +418,9 @@ class LoadDataView(BaseEtlView):
 
         # берем начальные типы очередей
         queue_ids = Queue.objects.filter(
-            name__in=[MONGODB_DATA_LOAD, MONGODB_DELTA_LOAD]).values_list(
+            name__in=[MONGODB_DATA_LOAD, MONGODB_DATA_LOAD_PARTITION,
+                      DB_DIRECT_LOAD, MONGODB_DELTA_LOAD,
+                      DB_CDC_APPLY]).values_list(
             'id', flat=True)
         # берем статусы (В ожидании, В обработке)
         queue_status_ids = QueueStatus.objects.filter(
@@ -449,10 +452,31 @@ class LoadDataView(BaseEtlView):
         except DatasourceSettings.DoesNotExist:
             raise ResponseError(u'Не определен тип дозагрузки данных', ExceptionCode.ERR_CDC_TYPE_IS_NOT_SET)
 
+        # режим первичной загрузки, по умолчанию через Mongodb
+        load_mode = DatasourceSettings.objects.filter(
+            datasource_id=source.id,
+            name=DatasourceSettings.SETTING_LOAD_MODE_NAME).values_list(
+            'value', flat=True).first() or DatasourceSettings.STAGING
+
+        # режим дозагрузки, по умолчанию выбираются все строки
+        extract_mode = DatasourceSettings.objects.filter(
+            datasource_id=source.id,
+            name=DatasourceSettings.SETTING_EXTRACT_MODE_NAME).values_list(
+            'value', flat=True).first() or DatasourceSettings.EXTRACT_FULL
+
+        # профиль надежности промежуточных коллекций, по умолчанию из настроек
+        durability = DatasourceSettings.objects.filter(
+            datasource_id=source.id,
+            name=DatasourceSettings.SETTING_DURABILITY_NAME).values_list(
+            'value', flat=True).first()
+
         user_id = request.user.id
         # Параметры для задач
         load_args = {
             'cdc_type': cdc_type,
+            'load_mode': load_mode,
+            'extract_mode': extract_mode,
+            'durability': durability,
             'cols': data.get('cols'),
             'tables': data.get('tables'),
             'col_types': json.dumps(